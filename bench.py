@@ -0,0 +1,446 @@
+"""Watchtower Bot 性能基准
+
+在本地 unix socket 上启动一个模拟 Docker Engine API 的假守护进程（可配置规模和延迟），
+并把 Telegram 传输层替换为桩实现，然后直接驱动 main.py 中的处理器，
+报告每个场景的耗时、守护进程往返次数、Telegram 请求数和内存占用。
+
+用法：
+    python bench.py --sizes 10,100,1000,5000 --latency 0.002 --iterations 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+BENCH_CHAT_ID = 1000
+
+class FakeDockerState:
+    """合成的容器、镜像和网络集合"""
+
+    def __init__(self):
+        self.resize(0)
+
+    def resize(self, size):
+        self.size = size
+        image_count = max(size // 3, 1)
+        self.images = []
+        for i in range(image_count):
+            dangling = i % 10 == 9
+            self.images.append({
+                'Id': f'sha256:{i:064x}',
+                'RepoTags': [] if dangling else [f'bench/app{i}:latest'],
+                'RepoDigests': [] if dangling else [f'bench/app{i}@sha256:{i + 1:064x}'],
+                'ParentId': '',
+                'Created': 1700000000 + i,
+                'Size': (50 + i % 200) * 1024 * 1024,
+                'SharedSize': 20 * 1024 * 1024,
+                'Containers': 0,
+                'Labels': {},
+            })
+        self.networks = [
+            {'Id': f'{i:064x}', 'Name': f'bench_net{i}', 'Driver': 'bridge', 'Containers': {}}
+            for i in range(max(size // 10, 1))
+        ] + [{'Id': 'b' * 64, 'Name': 'bridge', 'Driver': 'bridge', 'Containers': {}}]
+        self.containers = []
+        for i in range(size):
+            image = self.images[i % image_count]
+            image['Containers'] += 1
+            network = self.networks[i % len(self.networks)]
+            project = f'proj{i // 5}'
+            self.containers.append({
+                'Id': f'{i + 1:064x}',
+                'Names': [f'/bench-{i}'],
+                'Image': image['RepoTags'][0] if image['RepoTags'] else image['Id'],
+                'ImageID': image['Id'],
+                'Created': 1700000000 + i,
+                'State': 'running' if i % 10 < 7 else 'exited',
+                'Status': 'Up 1 hour',
+                'Labels': {
+                    'com.docker.compose.project': project,
+                    'com.docker.compose.service': f'svc{i % 5}',
+                },
+                'SizeRw': 1024 * 1024,
+                'NetworkSettings': {'Networks': {network['Name']: {'NetworkID': network['Id'], 'Aliases': None}}},
+            })
+        self.by_id = {c['Id']: c for c in self.containers}
+        self.by_name = {c['Names'][0][1:]: c for c in self.containers}
+        self.images_by_id = {image['Id']: image for image in self.images}
+
+    def find_container(self, ref):
+        return self.by_id.get(ref) or self.by_name.get(ref) or next(
+            (c for c in self.containers if c['Id'].startswith(ref)), None
+        )
+
+    def inspect_container(self, container):
+        return {
+            'Id': container['Id'],
+            'Name': container['Names'][0],
+            'Image': container['ImageID'],
+            'Created': '2024-01-01T00:00:00.000000000Z',
+            'State': {'Status': container['State'], 'Running': container['State'] == 'running',
+                      'StartedAt': '2024-01-01T00:00:00.000000000Z'},
+            'Config': {'Image': container['Image'], 'Labels': container['Labels'], 'Env': [], 'Cmd': [], 'Tty': True},
+            'HostConfig': {'NetworkMode': 'bridge'},
+            'NetworkSettings': container['NetworkSettings'],
+        }
+
+    def system_df(self):
+        return {
+            'LayersSize': sum(image['Size'] for image in self.images),
+            'Images': self.images,
+            'Containers': self.containers,
+            'Volumes': [],
+            'BuildCache': [],
+        }
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """按路径分发的 Docker Engine API 子集"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, content_type='application/json'):
+        payload = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _dispatch(self, method):
+        daemon = self.server.daemon
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[\d.]+', '', url.path)
+        query = parse_qs(url.query)
+        template = re.sub(r'/[0-9a-f]{12,64}|/bench-\d+|/sha256:[0-9a-f]{64}', '/{id}', path)
+        daemon.round_trips[f'{method} {template}'] += 1
+        if daemon.latency:
+            time.sleep(daemon.latency)
+        state = daemon.state
+
+        if path == '/events':
+            # 事件流：保持连接直到基准结束
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.flush()
+            daemon.stopping.wait()
+            return
+        if path == '/_ping':
+            return self._send(200, b'OK', 'text/plain')
+        if path == '/version':
+            return self._send(200, {'ApiVersion': '1.44', 'Version': '25.0.0', 'MinAPIVersion': '1.24'})
+        if path == '/containers/json':
+            containers = state.containers
+            if query.get('all', ['0'])[0] in ('0', 'false'):
+                containers = [c for c in containers if c['State'] == 'running']
+            filters = json.loads(query.get('filters', ['{}'])[0] or '{}')
+            if 'status' in filters:
+                containers = [c for c in containers if c['State'] in filters['status']]
+            return self._send(200, containers)
+        if path == '/images/json':
+            filters = json.loads(query.get('filters', ['{}'])[0] or '{}')
+            images = state.images
+            if filters.get('dangling') in (['true'], ['1']):
+                images = [image for image in images if not image['RepoTags']]
+            return self._send(200, images)
+        if path == '/networks':
+            return self._send(200, state.networks)
+        if path == '/system/df':
+            return self._send(200, state.system_df())
+        if path.endswith('/prune'):
+            kind = path.split('/')[1].capitalize()
+            return self._send(200, {f'{kind}Deleted': [], 'SpaceReclaimed': 0})
+
+        match = re.match(r'^/containers/([^/]+)(?:/(\w+))?$', path)
+        if match:
+            container = state.find_container(match.group(1))
+            if container is None:
+                return self._send(404, {'message': 'No such container'})
+            action = match.group(2)
+            if method == 'GET' and action == 'json':
+                return self._send(200, state.inspect_container(container))
+            if method == 'GET' and action == 'logs':
+                lines = ''.join(f'2024-01-01T00:00:{i % 60:02d}.000000000Z log line {i}\n' for i in range(100))
+                return self._send(200, lines.encode(), 'text/plain')
+            if method in ('POST', 'DELETE'):
+                return self._send(204)
+        match = re.match(r'^/images/(.+?)(?:/json)?$', path)
+        if match:
+            image = state.images_by_id.get(match.group(1))
+            if method == 'DELETE':
+                return self._send(200, [{'Deleted': match.group(1)}])
+            if image is None:
+                return self._send(404, {'message': 'No such image'})
+            return self._send(200, image)
+        if path.startswith('/networks/') and method == 'DELETE':
+            return self._send(204)
+        return self._send(404, {'message': f'bench: unsupported {method} {path}'})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+class FakeDockerDaemon(socketserver.ThreadingUnixStreamServer):
+    """在 unix socket 上提供模拟的 Docker Engine API"""
+
+    daemon_threads = True
+
+    def __init__(self, path, latency=0.0):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, FakeDockerHandler)
+        self.daemon = self
+        self.path = path
+        self.latency = latency
+        self.state = FakeDockerState()
+        self.round_trips = Counter()
+        self.stopping = threading.Event()
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-dockerd', daemon=True)
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('fake-dockerd', 0)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
+
+def make_stub_request():
+    """替换 Telegram 传输层：不发网络请求，只计数并返回合法的响应"""
+    from telegram.request import BaseRequest
+
+    class StubTelegramRequest(BaseRequest):
+        def __init__(self):
+            self.calls = Counter()
+            self._message_id = 0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, *args, **kwargs):
+            endpoint = url.rsplit('/', 1)[-1]
+            self.calls[endpoint] += 1
+            params = request_data.parameters if request_data else {}
+            if endpoint == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+            elif endpoint in ('sendMessage', 'editMessageText'):
+                self._message_id += 1
+                result = {
+                    'message_id': params.get('message_id') or self._message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': int(params.get('chat_id', BENCH_CHAT_ID)), 'type': 'private'},
+                    'text': params.get('text', ''),
+                }
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return StubTelegramRequest()
+
+class Driver:
+    """构造 Update 并直接调用处理器"""
+
+    def __init__(self, main, bot):
+        self.main = main
+        self.bot = bot
+        self.chat_data = {}
+        self._update_id = 0
+
+    def _user(self):
+        return {'id': BENCH_CHAT_ID, 'is_bot': False, 'first_name': 'bench'}
+
+    def _message(self, text=''):
+        return {
+            'message_id': 1, 'date': int(time.time()), 'text': text,
+            'chat': {'id': BENCH_CHAT_ID, 'type': 'private'}, 'from': self._user(),
+        }
+
+    def _context(self, args):
+        return SimpleNamespace(args=args, bot=self.bot, chat_data=self.chat_data)
+
+    async def command(self, handler, text):
+        from telegram import Update
+        self._update_id += 1
+        update = Update.de_json({'update_id': self._update_id, 'message': self._message(text)}, self.bot)
+        await handler(update, self._context(text.split()[1:]))
+
+    async def button(self, data):
+        from telegram import Update
+        self._update_id += 1
+        update = Update.de_json({
+            'update_id': self._update_id,
+            'callback_query': {
+                'id': str(self._update_id), 'from': self._user(), 'chat_instance': 'bench',
+                'data': data, 'message': self._message(),
+            },
+        }, self.bot)
+        await self.main.button_handler(update, self._context([]))
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+async def run_scenario(name, func, daemon, stub, iterations):
+    """预热一次后执行 iterations 次，返回统计结果"""
+    await func()
+    daemon.round_trips.clear()
+    stub.calls.clear()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    _, peak = tracemalloc.get_traced_memory()
+    return {
+        'name': name,
+        'p50': percentile(timings, 0.5),
+        'p95': percentile(timings, 0.95),
+        'max': max(timings),
+        'round_trips': sum(daemon.round_trips.values()) / iterations,
+        'endpoints': dict(daemon.round_trips),
+        'telegram': sum(stub.calls.values()) / iterations,
+        'peak_kb': (peak - base) / 1024,
+    }
+
+async def bench(args, main, daemon):
+    from telegram import Bot
+
+    stub = make_stub_request()
+    bot = Bot(token='1:bench', request=stub, get_updates_request=stub)
+    await bot.initialize()
+    driver = Driver(main, bot)
+
+    async def menu_flip():
+        # 打开菜单后翻到第二页（令牌经回调路由解析）
+        _, markup, _ = await main.render_container_menu('', 0)
+        await driver.button(markup.inline_keyboard[-1][-1].callback_data)
+
+    async def container_detail():
+        _, markup, _ = await main.render_container_menu('', 0)
+        await driver.button(markup.inline_keyboard[0][0].callback_data)
+
+    scenarios = [
+        ('inventory.resync', main.inventory.resync),
+        ('/status', lambda: driver.command(main.status, '/status')),
+        ('/allcontainers', lambda: driver.command(main.all_containers, '/allcontainers')),
+        ('/allcontainers status=exited', lambda: driver.command(main.all_containers, '/allcontainers status=exited')),
+        ('/images', lambda: driver.command(main.images_list, '/images')),
+        ('/images size>100MB sort=size', lambda: driver.command(main.images_list, '/images size>100MB sort=size')),
+        ('/cleanup', lambda: driver.command(main.cleanup, '/cleanup')),
+        ('/cleanupcontainers', lambda: driver.command(main.cleanup_containers, '/cleanupcontainers')),
+        ('/cleanupimages', lambda: driver.command(main.cleanup_images, '/cleanupimages')),
+        ('/cleanupall', lambda: driver.command(main.cleanup_all, '/cleanupall')),
+        # 确认按钮才是真正删除容器、镜像和网络的路径
+        ('button cleanup_confirm', lambda: driver.button(main.callback_data('cleanup_confirm'))),
+        ('button cleanup_force_confirm', lambda: driver.button(main.callback_data('cleanup_force_confirm'))),
+        ('button menu page', menu_flip),
+        ('button container', container_detail),
+    ]
+
+    results = []
+    for size in args.sizes:
+        daemon.state.resize(size)
+        await main.inventory.resync()
+        for name, func in scenarios:
+            result = await run_scenario(name, func, daemon, stub, args.iterations)
+            result['size'] = size
+            results.append(result)
+
+    await main.inventory.stop()
+    await bot.shutdown()
+    return results
+
+def format_results(results, args):
+    lines = [
+        f"# Watchtower Bot 基准  延迟 {args.latency * 1000:.1f} ms/请求  每场景 {args.iterations} 次",
+        f"{'规模':>6}  {'场景':<32}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'往返/次':>8}{'TG/次':>7}{'峰值 KB':>9}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['size']:>6}  {r['name']:<32}{r['p50'] * 1000:>9.1f}{r['p95'] * 1000:>9.1f}{r['max'] * 1000:>9.1f}"
+            f"{r['round_trips']:>8.1f}{r['telegram']:>7.1f}{r['peak_kb']:>9.0f}"
+        )
+    lines.append(f"最大常驻内存：{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if args.verbose:
+        lines.append("")
+        for r in results:
+            lines.append(f"{r['size']:>6}  {r['name']}: {json.dumps(r['endpoints'], ensure_ascii=False)}")
+    return "\n".join(lines)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Watchtower Bot 性能基准')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        type=lambda text: [int(part) for part in text.split(',')], help='容器数量，逗号分隔')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个 Docker API 请求的模拟延迟（秒）')
+    parser.add_argument('--iterations', type=int, default=5, help='每个场景的执行次数（另有一次预热）')
+    parser.add_argument('--output', default='bench_output.txt', help='结果文件，传空字符串则只打印')
+    parser.add_argument('--verbose', action='store_true', help='列出每个场景访问的 API 端点')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='watchtower-bench-')
+    daemon = FakeDockerDaemon(os.path.join(workdir, 'docker.sock'), args.latency)
+    daemon.start()
+
+    # main.py 在导入时读取配置并连接 Docker，因此先准备好环境
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '1:bench',
+        'ALLOWED_CHAT_ID': str(BENCH_CHAT_ID),
+        'DOCKER_SOCKET_PATH': daemon.path,
+        'HISTORY_DB_PATH': '',
+        'STATS_ENABLED': 'false',
+        'ALERTS_ENABLED': 'false',
+        'METRICS_PORT': '0',
+        'MESSAGE_SEND_INTERVAL': '0',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot_main
+
+    tracemalloc.start()
+    try:
+        results = asyncio.run(bench(args, bot_main, daemon))
+    finally:
+        daemon.stop()
+        bot_main.docker_executor.shutdown()
+        os.rmdir(workdir)
+
+    report = format_results(results, args)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,31 @@
 import os
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.request import HTTPXRequest
 import docker
-from datetime import datetime
+import pytz
+from datetime import datetime, timedelta, timezone, time as dtime
 import asyncio
+import time
+import threading
+import functools
+import sqlite3
+import secrets
+import shutil
+import codecs
+import fnmatch
+import re
+import bisect
+import shlex
+import requests
+from requests.adapters import HTTPAdapter
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 # 配置日志
 logging.basicConfig(
@@ -17,9 +38,3292 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ALLOWED_CHAT_ID = os.getenv('ALLOWED_CHAT_ID')
 DOCKER_SOCKET_PATH = os.getenv('DOCKER_SOCKET_PATH', '/var/run/docker.sock')
+DOCKER_HOST_NAME = os.getenv('DOCKER_HOST_NAME', 'local')
+DOCKER_HOSTS = os.getenv('DOCKER_HOSTS', '')
+HOST_CHECK_TIMEOUT = float(os.getenv('HOST_CHECK_TIMEOUT', '5'))
+HOST_QUERY_TIMEOUT = float(os.getenv('HOST_QUERY_TIMEOUT', '15'))
+HOST_MAX_WORKERS = int(os.getenv('HOST_MAX_WORKERS', '2'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9105'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+DOCKER_MAX_WORKERS = int(os.getenv('DOCKER_MAX_WORKERS', '8'))
+DOCKER_CALL_TIMEOUT = float(os.getenv('DOCKER_CALL_TIMEOUT', '30'))
+DOCKER_QUEUE_WARN = int(os.getenv('DOCKER_QUEUE_WARN', str(DOCKER_MAX_WORKERS * 4)))
+CONTAINER_OP_TIMEOUT = float(os.getenv('CONTAINER_OP_TIMEOUT', '60'))
+PRUNE_TIMEOUT = float(os.getenv('PRUNE_TIMEOUT', '600'))
+RUNONCE_TIMEOUT = float(os.getenv('RUNONCE_TIMEOUT', '3600'))
+INVENTORY_MAX_AGE = float(os.getenv('INVENTORY_MAX_AGE', '600'))
+INVENTORY_EVENT_BATCH = float(os.getenv('INVENTORY_EVENT_BATCH', '0.2'))
+INVENTORY_RECONNECT_DELAY = float(os.getenv('INVENTORY_RECONNECT_DELAY', '5'))
+CLEANUP_CONCURRENCY = int(os.getenv('CLEANUP_CONCURRENCY', '4'))
+DF_TIMEOUT = float(os.getenv('DF_TIMEOUT', '120'))
+LOG_PAGE_LINES = int(os.getenv('LOG_PAGE_LINES', '30'))
+LOG_PAGE_CHARS = int(os.getenv('LOG_PAGE_CHARS', '3500'))
+LOG_PAGE_WINDOW = float(os.getenv('LOG_PAGE_WINDOW', '300'))
+LOG_CURSOR_CACHE_SIZE = int(os.getenv('LOG_CURSOR_CACHE_SIZE', '64'))
+FOLLOW_MAX = int(os.getenv('FOLLOW_MAX', '3'))
+FOLLOW_INTERVAL = float(os.getenv('FOLLOW_INTERVAL', '3'))
+FOLLOW_BUFFER_LINES = int(os.getenv('FOLLOW_BUFFER_LINES', '200'))
+FOLLOW_WINDOW_CHARS = int(os.getenv('FOLLOW_WINDOW_CHARS', '3500'))
+FOLLOW_MAX_DURATION = float(os.getenv('FOLLOW_MAX_DURATION', '1800'))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '4'))
+BULK_EDIT_INTERVAL = float(os.getenv('BULK_EDIT_INTERVAL', '2'))
+STATS_ENABLED = os.getenv('STATS_ENABLED', 'true').lower() == 'true'
+STATS_HISTORY = int(os.getenv('STATS_HISTORY', '120'))
+STATS_SAMPLE_INTERVAL = float(os.getenv('STATS_SAMPLE_INTERVAL', '5'))
+STATS_SYNC_INTERVAL = float(os.getenv('STATS_SYNC_INTERVAL', '15'))
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', '/var/log/watchtower/history.db')
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', '90'))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '2'))
+MESSAGE_CHUNK_CHARS = int(os.getenv('MESSAGE_CHUNK_CHARS', '4000'))
+MESSAGE_MAX_CHUNKS = int(os.getenv('MESSAGE_MAX_CHUNKS', '3'))
+MESSAGE_SEND_INTERVAL = float(os.getenv('MESSAGE_SEND_INTERVAL', '1'))
+CONTAINER_MENU_PAGE_SIZE = int(os.getenv('CONTAINER_MENU_PAGE_SIZE', '8'))
+CALLBACK_TOKEN_CACHE_SIZE = int(os.getenv('CALLBACK_TOKEN_CACHE_SIZE', '2048'))
+CALLBACK_TOKEN_TTL = float(os.getenv('CALLBACK_TOKEN_TTL', '21600'))
+MESSAGE_PAGE_CACHE_SIZE = int(os.getenv('MESSAGE_PAGE_CACHE_SIZE', '32'))
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'watchtower')
+UPDATE_PARALLELISM = int(os.getenv('UPDATE_PARALLELISM', '1'))
+UPDATE_HEALTH_TIMEOUT = float(os.getenv('UPDATE_HEALTH_TIMEOUT', '120'))
+UPDATE_STABLE_SECONDS = float(os.getenv('UPDATE_STABLE_SECONDS', '10'))
+UPDATE_PULL_TIMEOUT = float(os.getenv('UPDATE_PULL_TIMEOUT', '600'))
+REGISTRY_OVERRIDES = os.getenv('REGISTRY_OVERRIDES', '')
+REGISTRY_CACHE_TTL = float(os.getenv('REGISTRY_CACHE_TTL', '900'))
+REGISTRY_CONCURRENCY = int(os.getenv('REGISTRY_CONCURRENCY', '8'))
+REGISTRY_TIMEOUT = float(os.getenv('REGISTRY_TIMEOUT', '10'))
+ALERTS_ENABLED = os.getenv('ALERTS_ENABLED', 'true').lower() == 'true'
+ALERT_COALESCE_WINDOW = float(os.getenv('ALERT_COALESCE_WINDOW', '10'))
+ALERT_COOLDOWN = float(os.getenv('ALERT_COOLDOWN', '300'))
+ALERT_RESTART_COUNT = int(os.getenv('ALERT_RESTART_COUNT', '3'))
+ALERT_RESTART_WINDOW = float(os.getenv('ALERT_RESTART_WINDOW', '600'))
+ALERT_DISK_PERCENT = float(os.getenv('ALERT_DISK_PERCENT', '90'))
+ALERT_DISK_PATH = os.getenv('ALERT_DISK_PATH', '/')
+ALERT_IGNORE = os.getenv('ALERT_IGNORE', '')
+SCHEDULED_JOBS = os.getenv('SCHEDULED_JOBS', 'resync=every:30m,diskcheck=every:1h,hostcheck=every:5m,compact=daily:04:30')
+SCHEDULE_JITTER = float(os.getenv('SCHEDULE_JITTER', '60'))
+BOT_TIMEZONE = os.getenv('TZ', 'UTC')
+RUNONCE_COMMAND = os.getenv('RUNONCE_COMMAND', '/watchtower --run-once --cleanup')
+RUNONCE_PROGRESS_INTERVAL = float(os.getenv('RUNONCE_PROGRESS_INTERVAL', '5'))
+JOB_HISTORY_SIZE = int(os.getenv('JOB_HISTORY_SIZE', '20'))
+JOB_OUTPUT_LINES = int(os.getenv('JOB_OUTPUT_LINES', '200'))
 
 # Docker 客户端
-docker_client = docker.DockerClient(base_url=f'unix://{DOCKER_SOCKET_PATH}')
+docker_client = docker.DockerClient(base_url=f'unix://{DOCKER_SOCKET_PATH}', max_pool_size=DOCKER_MAX_WORKERS)
+
+class Histogram:
+    """固定分桶的延迟直方图（秒）"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """按分桶上界估算分位数，落在最后一个桶时返回 inf"""
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """进程内指标：计数器和延迟直方图，按 (名称, 标签) 区分，可导出为 Prometheus 文本格式"""
+
+    PREFIX = 'watchtower_bot_'
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, /, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, /, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def series(self, name):
+        """返回某个直方图的 [(标签字典, Histogram)]"""
+        with self._lock:
+            return [(dict(labels), h) for (n, labels), h in self.histograms.items() if n == name]
+
+    def counter_series(self, name):
+        with self._lock:
+            return [(dict(labels), v) for (n, labels), v in self.counters.items() if n == name]
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self, gauges=None):
+        """导出为 Prometheus 文本格式（0.0.4）"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            snapshot = [(key, list(h.counts), h.sum, h.count) for key, h in histograms]
+        typed = set()
+        for (name, labels), value in counters:
+            full = self.PREFIX + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} counter")
+                typed.add(full)
+            lines.append(f"{full}{self._labels(labels)} {value}")
+        for (name, labels), counts, total, count in snapshot:
+            full = self.PREFIX + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} histogram")
+                typed.add(full)
+            cumulative = 0
+            for bound, bucket in zip(Histogram.BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f"{full}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{full}_sum{self._labels(labels)} {total}")
+            lines.append(f"{full}_count{self._labels(labels)} {count}")
+        for name, value in (gauges or {}).items():
+            full = self.PREFIX + name
+            lines.append(f"# TYPE {full} gauge")
+            lines.append(f"{full} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class ErrorCountHandler(logging.Handler):
+    """按函数名统计 ERROR 日志：处理器里被 except 吞掉的错误也能计数"""
+
+    def emit(self, record):
+        metrics.inc('log_errors_total', function=record.funcName)
+
+logger.addHandler(ErrorCountHandler(level=logging.ERROR))
+
+class InstrumentedRequest(HTTPXRequest):
+    """记录每个 Telegram Bot API 方法的请求耗时"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.monotonic()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('telegram_request_errors_total', method=endpoint)
+            raise
+        finally:
+            metrics.observe('telegram_request_seconds', time.monotonic() - started, method=endpoint)
+        if status >= 400:
+            metrics.inc('telegram_request_errors_total', method=endpoint)
+        return status, payload
+
+def instrument_handler(name, callback):
+    """包装处理器：记录耗时，未被捕获的异常计入错误数后继续抛出"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('handler_seconds', time.monotonic() - started, handler=name)
+    return wrapper
+
+class DockerExecutor:
+    """Docker 调用执行器 - 在有界线程池中运行阻塞的 SDK 调用，避免卡住事件循环"""
+
+    def __init__(self, max_workers, default_timeout, queue_warn, name='docker'):
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self.queue_warn = queue_warn
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def _run(self, func, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def _on_done(self, future):
+        # 尚未开始执行就被取消的任务不会进入 _run，需要在这里归还排队计数
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def call(self, func, *args, call_timeout=None, **kwargs):
+        """在线程池中执行 func，超过 call_timeout 秒抛出 asyncio.TimeoutError"""
+        timeout = self.default_timeout if call_timeout is None else call_timeout
+        with self._lock:
+            self.queued += 1
+            queued = self.queued
+        if queued > self.queue_warn:
+            logger.warning(f"Docker 调用排队过多: 排队 {queued} 个, 执行中 {self.in_flight} 个")
+
+        future = self._pool.submit(self._run, func, args, kwargs)
+        future.add_done_callback(self._on_done)
+        name = getattr(func, '__qualname__', repr(func))
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            metrics.inc('docker_call_errors_total', endpoint=name, kind='timeout')
+            logger.warning(f"Docker 调用超时 ({timeout:.0f}s): {name}")
+            raise
+        except Exception:
+            metrics.inc('docker_call_errors_total', endpoint=name, kind='error')
+            raise
+        finally:
+            metrics.observe('docker_call_seconds', time.monotonic() - started, endpoint=name)
+
+    def stats(self):
+        """返回线程池当前状态快照"""
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+docker_executor = DockerExecutor(DOCKER_MAX_WORKERS, DOCKER_CALL_TIMEOUT, DOCKER_QUEUE_WARN)
+
+async def run_docker(func, *args, **kwargs):
+    """在 Docker 线程池中执行阻塞调用"""
+    return await docker_executor.call(func, *args, **kwargs)
+
+@dataclass
+class DockerHost:
+    """一台被管理的 Docker 守护进程"""
+    name: str
+    url: str
+    client: object = None
+    executor: DockerExecutor = None
+    healthy: bool = None
+    latency: float = 0.0
+    error: str = ''
+    checked: float = 0.0
+
+class HostRegistry:
+    """命名主机注册表：每台主机一个常驻的带连接池的客户端
+
+    本机（DOCKER_SOCKET_PATH）始终是主主机并复用 docker_client；
+    DOCKER_HOSTS 以 名称=地址 的形式追加远程主机（unix://、tcp://、ssh://），
+    远程客户端在第一次使用时才连接，连接失败不影响其他主机。
+    每台远程主机有自己的小线程池（HOST_MAX_WORKERS），
+    卡住的远程主机只会占满自己的线程，不会拖慢本机的 Docker 调用。
+    """
+
+    def __init__(self, primary_name, primary_url, primary_client, spec):
+        self.primary = DockerHost(primary_name, primary_url, client=primary_client, executor=docker_executor)
+        self.hosts = OrderedDict([(primary_name, self.primary)])
+        for entry in filter(None, (item.strip() for item in spec.split(','))):
+            name, sep, url = entry.partition('=')
+            name = name.strip()
+            if not sep or not name or not url.strip():
+                logger.error(f"忽略无效的主机配置: {entry}")
+                continue
+            if name in self.hosts or name == 'all':
+                logger.error(f"忽略重复的主机名称: {name}")
+                continue
+            executor = DockerExecutor(HOST_MAX_WORKERS, HOST_QUERY_TIMEOUT, DOCKER_QUEUE_WARN, name=f'docker-{name}')
+            self.hosts[name] = DockerHost(name, url.strip(), executor=executor)
+
+    def _connect(self, host):
+        client = docker.DockerClient(
+            base_url=host.url,
+            max_pool_size=HOST_MAX_WORKERS,
+            timeout=HOST_CHECK_TIMEOUT,
+            use_ssh_client=host.url.startswith('ssh://')
+        )
+        # 建立连接最多等 HOST_CHECK_TIMEOUT 秒，之后的读取按查询超时；
+        # 远程主机只做查询，不会用到 stop/restart 中对 timeout 的数值运算
+        client.api.timeout = (HOST_CHECK_TIMEOUT, HOST_QUERY_TIMEOUT)
+        return client
+
+    async def client(self, host):
+        """返回主机的客户端，必要时先建立连接"""
+        if host.client is None:
+            host.client = await host.executor.call(self._connect, host, call_timeout=HOST_CHECK_TIMEOUT)
+        return host.client
+
+    async def check(self, host):
+        """ping 一台主机并记录健康状态和延迟"""
+        started = time.monotonic()
+        try:
+            client = await self.client(host)
+            await host.executor.call(client.ping, call_timeout=HOST_CHECK_TIMEOUT)
+            host.healthy, host.error = True, ''
+        except Exception as e:
+            host.healthy, host.error = False, str(e) or type(e).__name__
+        host.latency = time.monotonic() - started
+        host.checked = time.time()
+        return host
+
+    async def check_all(self):
+        return await asyncio.gather(*(self.check(host) for host in self.hosts.values()))
+
+    def resolve(self, args):
+        """从参数中取出 @主机 / @all，返回 (主机列表, 剩余参数)；未指定时为主主机"""
+        hosts, rest = [], []
+        for arg in args:
+            if not arg.startswith('@'):
+                rest.append(arg)
+            elif arg == '@all':
+                hosts.extend(self.hosts.values())
+            elif arg[1:] in self.hosts:
+                hosts.append(self.hosts[arg[1:]])
+            else:
+                raise ValueError(f"未知主机：{arg[1:]}，可选：{', '.join(self.hosts)}")
+        hosts = list(OrderedDict((host.name, host) for host in hosts).values())
+        return hosts or [self.primary], rest
+
+    async def collect(self, hosts, func):
+        """对多台主机并发执行 func(host)，返回 [(主机, 结果, 错误)]
+
+        只查询主主机时异常照常抛出；多主机时单台超时或出错
+        只记录在该主机的结果里，不影响其他主机。
+        """
+        if hosts == [self.primary]:
+            return [(self.primary, await func(self.primary), None)]
+
+        async def one(host):
+            try:
+                return host, await asyncio.wait_for(func(host), HOST_QUERY_TIMEOUT), None
+            except asyncio.TimeoutError:
+                return host, None, f"{HOST_QUERY_TIMEOUT:g} 秒内未响应"
+            except Exception as e:
+                return host, None, str(e) or type(e).__name__
+
+        return await asyncio.gather(*(one(host) for host in hosts))
+
+host_registry = HostRegistry(DOCKER_HOST_NAME, f'unix://{DOCKER_SOCKET_PATH}', docker_client, DOCKER_HOSTS)
+
+def format_host_heading(host, count, error, unit='个容器'):
+    """多主机列表中每台主机的小标题"""
+    if error:
+        return f"⚠️ 🖥️ {host.name}：{error}"
+    return f"🖥️ {host.name}（{count} {unit}）"
+
+def run_in_thread(func, *args, name=None):
+    """在独立线程中运行长时间阻塞的调用（如流式 exec），不占用 Docker 调用池"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+    return future
+
+async def safe_edit(bot, chat_id, message_id, text, final=False, **kwargs):
+    """编辑消息：触发限流时按要求等待，忽略内容未变化的错误
+
+    进度类编辑限流时等待后直接放弃（下一次编辑会带上最新内容）；
+    final=True 的最终结果没有下一次，等待后最多重试 3 次，与 send_with_retry 一致。
+    """
+    for attempt in range(3 if final else 1):
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+            return
+        except RetryAfter as e:
+            if final and attempt == 2:
+                raise
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                raise
+            return
+
+def format_bytes(size):
+    """把字节数格式化为易读的大小"""
+    size = float(size)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+def format_duration(seconds):
+    """把秒数格式化为易读的时长"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}秒"
+    if seconds < 3600:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds // 3600}小时{seconds % 3600 // 60}分"
+
+def telegram_length(text):
+    """Telegram 按 UTF-16 码元计算消息长度（emoji 占 2 个）"""
+    return len(text.encode('utf-16-le')) // 2
+
+def escape_md(text):
+    """转义 Markdown（v1）中的实体字符，用于容器名、镜像名等外部文本"""
+    return escape_markdown(str(text), version=1)
+
+def _split_oversized(record, limit):
+    """单条记录超出上限时按行（必要时按字符）拆开"""
+    pieces, current = [], []
+    for line in record.split('\n'):
+        while telegram_length(line) > limit:
+            cut = limit
+            while telegram_length(line[:cut]) > limit:
+                cut -= 1
+            pieces.append('\n'.join(current + [line[:cut]]))
+            current, line = [], line[cut:]
+        if current and telegram_length('\n'.join(current + [line])) > limit:
+            pieces.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        pieces.append('\n'.join(current))
+    return pieces
+
+def chunk_records(header, records, limit=None, separator='\n\n'):
+    """把记录按边界切分成多页，每页都带上标题且不超过 limit"""
+    limit = limit or MESSAGE_CHUNK_CHARS
+    budget = limit - telegram_length(header) - 32
+    pages, current, size = [], [], 0
+    for record in records:
+        for piece in _split_oversized(record, budget) if telegram_length(record) > budget else [record]:
+            piece_size = telegram_length(piece) + telegram_length(separator)
+            if current and size + piece_size > budget:
+                pages.append(current)
+                current, size = [], 0
+            current.append(piece)
+            size += piece_size
+    if current or not pages:
+        pages.append(current)
+
+    total = len(pages)
+    return [
+        header + (f"（第 {index}/{total} 页）" if total > 1 else '') + '\n\n' + separator.join(page)
+        for index, page in enumerate(pages, 1)
+    ]
+
+class CallbackTokens:
+    """按钮 callback_data 中的短令牌 → 实际值（有界 LRU，带过期时间）
+
+    Telegram 限制 callback_data 最长 64 字节，而容器名可能更长，
+    因此按钮里只放短令牌。同一个值在有效期内复用同一个令牌；
+    令牌带有进程级随机前缀，机器人重启后旧按钮一定会被识别为过期。
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._prefix = secrets.token_hex(2)
+        self._counter = 0
+        self._entries = OrderedDict()
+        self._tokens = {}
+
+    def issue(self, value):
+        expires = time.monotonic() + self.ttl
+        token = self._tokens.get(value)
+        if token is None:
+            self._counter += 1
+            token = f"{self._prefix}{self._counter:x}"
+            self._tokens[value] = token
+        self._entries[token] = (value, expires)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.size:
+            _, (old_value, _) = self._entries.popitem(last=False)
+            self._tokens.pop(old_value, None)
+        return token
+
+    def resolve(self, token):
+        """返回令牌对应的值，未知或已过期时返回 None"""
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[token]
+            self._tokens.pop(value, None)
+            return None
+        self._entries.move_to_end(token)
+        return value
+
+callback_tokens = CallbackTokens(CALLBACK_TOKEN_CACHE_SIZE, CALLBACK_TOKEN_TTL)
+
+def callback_data(action, value=None):
+    """生成按钮的 callback_data：动作[:令牌]"""
+    if value is None:
+        return action
+    return f"{action}:{callback_tokens.issue(value)}"
+
+class PageCache:
+    """分页消息内容的有界 LRU，按钮翻页时从这里取页"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._counter = 0
+
+    def put(self, pages, parse_mode=None):
+        self._counter += 1
+        token = format(self._counter, 'x')
+        self._entries[token] = (pages, parse_mode)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return token
+
+    def get(self, token):
+        entry = self._entries.get(token)
+        if entry is not None:
+            self._entries.move_to_end(token)
+        return entry
+
+page_cache = PageCache(MESSAGE_PAGE_CACHE_SIZE)
+
+def page_markup(token, index, total):
+    """分页按钮"""
+    if total <= 1:
+        return None
+    buttons = []
+    if index > 0:
+        buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"chunk:{token}:{index - 1}"))
+    buttons.append(InlineKeyboardButton(f"{index + 1}/{total}", callback_data=f"chunk:{token}:{index}"))
+    if index < total - 1:
+        buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"chunk:{token}:{index + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+async def send_with_retry(send, *args, **kwargs):
+    """发送消息，触发限流时按 Telegram 要求的时间等待后重试"""
+    for attempt in range(3):
+        try:
+            return await send(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == 2:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def reply_chunked(message, header, records, parse_mode=None, separator='\n\n'):
+    """按记录边界分页回复
+
+    页数不超过 MESSAGE_MAX_CHUNKS 时逐条发送（间隔 MESSAGE_SEND_INTERVAL 秒），
+    否则只发第一页并附带翻页按钮，避免一次刷出大量消息。
+    """
+    pages = chunk_records(header, records, separator=separator)
+    if len(pages) <= MESSAGE_MAX_CHUNKS:
+        for index, page in enumerate(pages):
+            if index:
+                await asyncio.sleep(MESSAGE_SEND_INTERVAL)
+            await send_with_retry(message.reply_text, page, parse_mode=parse_mode)
+        return
+    token = page_cache.put(pages, parse_mode)
+    await send_with_retry(
+        message.reply_text, pages[0], parse_mode=parse_mode, reply_markup=page_markup(token, 0, len(pages))
+    )
+
+async def show_page(query, token, index):
+    """翻页按钮回调：原地编辑为指定页"""
+    entry = page_cache.get(token)
+    if entry is None:
+        await query.edit_message_text("⌛ 该列表已过期，请重新执行命令")
+        return
+    pages, parse_mode = entry
+    index = max(0, min(index, len(pages) - 1))
+    await safe_edit(
+        query.get_bot(), query.message.chat_id, query.message.message_id, pages[index],
+        parse_mode=parse_mode, reply_markup=page_markup(token, index, len(pages))
+    )
+
+@dataclass
+class ContainerInfo:
+    """容器摘要（来自列表接口，无需逐个 inspect）"""
+    id: str
+    name: str
+    status: str
+    image: str
+    image_id: str
+    created: str
+    labels: dict = field(default_factory=dict)
+    networks: list = field(default_factory=list)
+    image_ref: str = ''
+
+    @property
+    def short_id(self):
+        return self.id[:12]
+
+@dataclass
+class ImageInfo:
+    """镜像摘要"""
+    id: str
+    tags: list
+    size: int
+    created: int
+    parent_id: str = ''
+    digests: list = field(default_factory=list)
+
+    @property
+    def short_id(self):
+        return self.id.split(':', 1)[-1][:12]
+
+    @property
+    def tag(self):
+        return self.tags[0] if self.tags else 'N/A'
+
+@dataclass
+class NetworkInfo:
+    """网络摘要"""
+    id: str
+    name: str
+    driver: str
+
+def _network_ids(raw):
+    networks = (raw.get('NetworkSettings') or {}).get('Networks') or {}
+    return [net['NetworkID'] for net in networks.values() if net.get('NetworkID')]
+
+def _image_from_raw(raw):
+    # 旧版本守护进程会用 <none>:<none> 表示无标签
+    tags = [t for t in (raw.get('RepoTags') or []) if t != '<none>:<none>']
+    return ImageInfo(
+        id=raw['Id'],
+        tags=tags,
+        size=raw.get('Size', 0),
+        created=raw.get('Created', 0),
+        parent_id=raw.get('ParentId', ''),
+        digests=raw.get('RepoDigests') or []
+    )
+
+def _container_from_raw(raw, images_by_id):
+    image = images_by_id.get(raw.get('ImageID'))
+    names = raw.get('Names') or ['/' + raw['Id'][:12]]
+    created = datetime.fromtimestamp(raw.get('Created', 0), timezone.utc)
+    return ContainerInfo(
+        id=raw['Id'],
+        name=names[0].lstrip('/'),
+        status=raw.get('State', ''),
+        image=image.tag if image else 'N/A',
+        image_id=raw.get('ImageID', ''),
+        created=created.strftime('%Y-%m-%dT%H:%M:%S'),
+        labels=raw.get('Labels') or {},
+        networks=_network_ids(raw),
+        image_ref=raw.get('Image', '')
+    )
+
+async def list_images(filters=None, client=None, executor=None):
+    """列出镜像（一次 API 调用）"""
+    client = client or docker_client
+    executor = executor or docker_executor
+    raw_images = await executor.call(client.api.images, filters=filters)
+    return [_image_from_raw(raw) for raw in raw_images]
+
+async def list_containers(all=False, filters=None, client=None, executor=None):
+    """列出容器并在内存中按镜像 ID 关联标签
+
+    固定两次 API 调用（containers/json + images/json），
+    不会因 container.image 懒加载而对每个容器多发一次请求。
+    """
+    client = client or docker_client
+    executor = executor or docker_executor
+    raw_containers, images = await asyncio.gather(
+        executor.call(client.api.containers, all=all, filters=filters),
+        list_images(client=client, executor=executor)
+    )
+    images_by_id = {image.id: image for image in images}
+    return [_container_from_raw(raw, images_by_id) for raw in raw_containers]
+
+async def get_container_info(name):
+    """按名称获取单个容器摘要，找不到时抛出 docker.errors.NotFound"""
+    raw = await run_docker(docker_client.api.inspect_container, name)
+    image = _image_from_raw(await run_docker(docker_client.api.inspect_image, raw['Image']))
+    return ContainerInfo(
+        id=raw['Id'],
+        name=raw['Name'].lstrip('/'),
+        status=raw['State']['Status'],
+        image=image.tag,
+        image_id=image.id,
+        created=raw['Created'][:19],
+        labels=raw['Config'].get('Labels') or {},
+        networks=_network_ids(raw),
+        image_ref=raw['Config'].get('Image', '')
+    )
+
+# Docker API 原生支持的过滤条件直接下推到 filters=，其余在本地过滤
+CONTAINER_SERVER_FILTERS = (
+    'status', 'label', 'name', 'id', 'ancestor', 'before', 'since', 'exited',
+    'health', 'network', 'volume', 'publish', 'expose', 'is-task',
+)
+IMAGE_SERVER_FILTERS = ('dangling', 'label', 'before', 'since', 'reference')
+
+# 排序字段：(取值函数, 默认是否倒序)
+CONTAINER_SORT_KEYS = {
+    'created': (lambda c: c.created, True),
+    'name': (lambda c: c.name, False),
+    'status': (lambda c: c.status, False),
+    'image': (lambda c: c.image, False),
+}
+IMAGE_SORT_KEYS = {
+    'created': (lambda i: i.created, True),
+    'size': (lambda i: i.size, True),
+    'tag': (lambda i: i.tag, False),
+}
+
+QUERY_OPERATORS = ('>=', '<=', '>', '<', '=')
+
+def parse_size(text):
+    """解析 500MB / 1.5G / 2048 形式的大小，返回字节数"""
+    units = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2,
+             'g': 1024 ** 3, 'gb': 1024 ** 3, 't': 1024 ** 4, 'tb': 1024 ** 4}
+    text = text.strip().lower()
+    number = text.rstrip('kmgtb')
+    unit = text[len(number):]
+    try:
+        return float(number) * units[unit]
+    except (KeyError, ValueError):
+        raise ValueError(f"无法识别的大小：{text}")
+
+@dataclass
+class ListQuery:
+    """列表命令的查询条件"""
+    server: dict = field(default_factory=dict)
+    client: list = field(default_factory=list)
+    sort: str = ''
+    reverse: bool = False
+    limit: int = 0
+
+    def __bool__(self):
+        return bool(self.server or self.client or self.sort or self.limit)
+
+    def describe(self):
+        parts = [f"{key}={value}" for key, values in self.server.items() for value in values]
+        parts += [f"{key}{op}{value}" for key, op, value in self.client]
+        if self.sort:
+            parts.append(f"sort={'-' if self.reverse else ''}{self.sort}")
+        if self.limit:
+            parts.append(f"limit={self.limit}")
+        return ' '.join(parts)
+
+def parse_list_query(args, server_keys, client_keys, sort_keys):
+    """解析 key=value / size>500MB / sort=-size / limit=20 形式的查询参数
+
+    client_keys 为本地过滤字段到允许运算符的映射，参数不合法时抛出 ValueError。
+    """
+    query = ListQuery()
+    for arg in args:
+        # 取最靠前的运算符，值里可以再出现 =（如 label=key=value）
+        found = [(arg.find(op), -len(op), op) for op in QUERY_OPERATORS if op in arg]
+        if not found:
+            raise ValueError(f"无法识别的条件：{arg}")
+        op = min(found)[2]
+        key, value = arg.split(op, 1)
+        key = key.strip().lower()
+        if key == 'sort' and op == '=':
+            query.reverse = value.startswith('-')
+            query.sort = value.lstrip('-')
+            if query.sort not in sort_keys:
+                raise ValueError(f"不支持按 {query.sort} 排序，可选：{', '.join(sort_keys)}")
+        elif key == 'limit' and op == '=':
+            query.limit = int(value)
+        elif key in server_keys and op == '=':
+            query.server.setdefault(key, []).append(value)
+        elif key in client_keys and op in client_keys[key]:
+            query.client.append((key, op, value))
+        else:
+            raise ValueError(f"不支持的条件：{arg}")
+    return query
+
+def _compare(actual, op, expected):
+    if op == '>':
+        return actual > expected
+    if op == '<':
+        return actual < expected
+    if op == '>=':
+        return actual >= expected
+    if op == '<=':
+        return actual <= expected
+    return actual == expected
+
+def apply_list_query(items, query, matchers, sort_keys, default_sort):
+    """在本地执行过滤、排序和数量限制"""
+    for key, op, value in query.client:
+        items = [item for item in items if matchers[key](item, op, value)]
+    getter, reverse = sort_keys[query.sort or default_sort]
+    items = sorted(items, key=getter, reverse=reverse != query.reverse)
+    return items[:query.limit] if query.limit else items
+
+CONTAINER_CLIENT_FILTERS = {'image': ('=',)}
+CONTAINER_MATCHERS = {
+    'image': lambda c, op, value: fnmatch.fnmatchcase(c.image, value),
+}
+IMAGE_CLIENT_FILTERS = {'size': QUERY_OPERATORS, 'tag': ('=',)}
+IMAGE_MATCHERS = {
+    'size': lambda i, op, value: _compare(i.size, op, parse_size(value)),
+    'tag': lambda i, op, value: any(fnmatch.fnmatchcase(tag, value) for tag in i.tags or ['<none>']),
+}
+
+async def host_containers(host, all=True, filters=None):
+    """列出某台主机的容器：主主机无过滤条件时走清单缓存，其余直接调用 API"""
+    if host is host_registry.primary and not filters:
+        return (await inventory.snapshot()).container_list(running_only=not all)
+    return await list_containers(all=all, filters=filters, client=await host_registry.client(host), executor=host.executor)
+
+async def host_images(host, filters=None):
+    """列出某台主机的镜像：主主机无过滤条件时走清单缓存，其余直接调用 API"""
+    if host is host_registry.primary and not filters:
+        return (await inventory.snapshot()).image_list()
+    return await list_images(filters=filters, client=await host_registry.client(host), executor=host.executor)
+
+def parse_container_query(args):
+    return parse_list_query(args, CONTAINER_SERVER_FILTERS, CONTAINER_CLIENT_FILTERS, CONTAINER_SORT_KEYS)
+
+def parse_image_query(args):
+    return parse_list_query(args, IMAGE_SERVER_FILTERS, IMAGE_CLIENT_FILTERS, IMAGE_SORT_KEYS)
+
+async def query_containers(query, host):
+    """按查询条件列出一台主机上的所有容器"""
+    containers = await host_containers(host, all=True, filters=query.server or None)
+    return apply_list_query(containers, query, CONTAINER_MATCHERS, CONTAINER_SORT_KEYS, 'created')
+
+async def query_images(query, host):
+    """按查询条件列出一台主机上的镜像"""
+    images = await host_images(host, filters=query.server or None)
+    return apply_list_query(images, query, IMAGE_MATCHERS, IMAGE_SORT_KEYS, 'created')
+
+class DockerInventory:
+    """容器/镜像/网络清单缓存
+
+    启动时全量加载一次，之后由后台任务跟随 Docker 事件流增量更新。
+    generation 每次变更递增；事件流中断或缓存超过 max_age 时，
+    下一次读取会强制全量重新同步。
+    """
+
+    def __init__(self, max_age, batch_delay, reconnect_delay):
+        self.max_age = max_age
+        self.batch_delay = batch_delay
+        self.reconnect_delay = reconnect_delay
+        self.containers = {}
+        self.images = {}
+        self.networks = {}
+        self.generation = 0
+        self._sorted = {}
+        self.synced_at = 0.0
+        self.updated_at = 0.0
+        self.stale = True
+        self._since = 0
+        self._stream = None
+        self._queue = None
+        self._task = None
+        self._lock = None
+        self._stopping = False
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """注册事件监听器，每批原始 Docker 事件应用后以列表形式回调"""
+        self._listeners.append(callback)
+
+    @property
+    def age(self):
+        """距上次全量同步的秒数"""
+        return time.monotonic() - self.synced_at
+
+    async def start(self):
+        """加载初始清单并启动事件跟随任务"""
+        self._queue = asyncio.Queue()
+        self._lock = self._lock or asyncio.Lock()
+        self._stopping = False
+        self._since = int(time.time())
+        try:
+            await self.resync()
+        finally:
+            # 即使首次加载失败也启动跟随任务，它会负责重连和重新同步
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._stream is not None:
+            self._stream.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def resync(self):
+        """全量重新加载（三次 API 调用）"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            since = int(time.time())
+            raw_containers, raw_images, raw_networks = await asyncio.gather(
+                run_docker(docker_client.api.containers, all=True),
+                run_docker(docker_client.api.images),
+                run_docker(docker_client.api.networks)
+            )
+            self.images = {raw['Id']: _image_from_raw(raw) for raw in raw_images}
+            self.containers = {raw['Id']: _container_from_raw(raw, self.images) for raw in raw_containers}
+            self.networks = {raw['Id']: NetworkInfo(raw['Id'], raw['Name'], raw.get('Driver', '')) for raw in raw_networks}
+            self._since = since
+            self.synced_at = self.updated_at = time.monotonic()
+            self.generation += 1
+            self.stale = False
+            logger.info(
+                f"清单已同步 (第 {self.generation} 代): {len(self.containers)} 个容器, "
+                f"{len(self.images)} 个镜像, {len(self.networks)} 个网络"
+            )
+
+    async def snapshot(self):
+        """返回可直接读取的清单，必要时先强制重新同步"""
+        if self._task is None:
+            await self.start()
+        elif self.stale or self.age > self.max_age:
+            await self.resync()
+        return self
+
+    def container_list(self, running_only=False):
+        """按创建时间倒序返回容器（与 docker ps 一致）
+
+        排序结果按 generation 缓存，清单未变化时翻页等重复调用不再重新排序；
+        调用方不应修改返回的列表。
+        """
+        key = (self.generation, running_only)
+        cached = self._sorted.get(key)
+        if cached is not None:
+            return cached
+        containers = self.containers.values()
+        if running_only:
+            containers = [c for c in containers if c.status in ('running', 'restarting', 'paused')]
+        result = sorted(containers, key=lambda c: c.created, reverse=True)
+        self._sorted = {k: v for k, v in self._sorted.items() if k[0] == self.generation}
+        self._sorted[key] = result
+        return result
+
+    def image_list(self):
+        return sorted(self.images.values(), key=lambda i: i.created, reverse=True)
+
+    def _follow_events(self, loop, since):
+        # 运行在独立线程中：事件流是无限阻塞的生成器，不能占用 Docker 调用池
+        try:
+            self._stream = docker_client.events(decode=True, since=since)
+            for event in self._stream:
+                loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        except Exception as e:
+            if not self._stopping:
+                logger.warning(f"Docker 事件流中断: {e}")
+        finally:
+            self._stream = None
+            try:
+                loop.call_soon_threadsafe(self._queue.put_nowait, None)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            threading.Thread(
+                target=self._follow_events, args=(loop, self._since), name='docker-events', daemon=True
+            ).start()
+            await self._consume()
+            if self._stopping:
+                break
+            # 事件流断开期间可能漏掉事件，重连后必须全量同步
+            self.stale = True
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self.resync()
+            except Exception as e:
+                logger.error(f"清单重新同步失败: {e}")
+
+    async def _consume(self):
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            # 短暂聚合，合并同一批事件引起的刷新
+            batch = [event]
+            await asyncio.sleep(self.batch_delay)
+            ended = False
+            while not self._queue.empty():
+                event = self._queue.get_nowait()
+                if event is None:
+                    ended = True
+                    break
+                batch.append(event)
+            try:
+                async with self._lock:
+                    await self._apply(batch)
+            except Exception as e:
+                logger.warning(f"应用 Docker 事件失败，将在下次读取时重新同步: {e}")
+                self.stale = True
+            for callback in self._listeners:
+                try:
+                    callback(batch)
+                except Exception as e:
+                    logger.warning(f"Docker 事件监听器错误: {e}")
+            if ended:
+                return
+
+    async def _apply(self, events):
+        dirty_containers = set()
+        refresh_images = False
+        refresh_networks = False
+        for event in events:
+            kind = event.get('Type')
+            action = (event.get('Action') or '').split(':')[0]
+            actor = event.get('Actor') or {}
+            actor_id = actor.get('ID') or event.get('id')
+            if kind == 'container':
+                if action.startswith('exec_'):
+                    continue
+                if action == 'destroy':
+                    self.containers.pop(actor_id, None)
+                    dirty_containers.discard(actor_id)
+                else:
+                    dirty_containers.add(actor_id)
+            elif kind == 'image':
+                refresh_images = True
+            elif kind == 'network':
+                refresh_networks = True
+                container_id = (actor.get('Attributes') or {}).get('container')
+                if container_id:
+                    dirty_containers.add(container_id)
+
+        if refresh_images:
+            raw_images = await run_docker(docker_client.api.images)
+            self.images = {raw['Id']: _image_from_raw(raw) for raw in raw_images}
+            for container in self.containers.values():
+                image = self.images.get(container.image_id)
+                container.image = image.tag if image else 'N/A'
+        if dirty_containers:
+            raw_containers = await run_docker(
+                docker_client.api.containers, all=True, filters={'id': list(dirty_containers)}
+            )
+            for raw in raw_containers:
+                self.containers[raw['Id']] = _container_from_raw(raw, self.images)
+                dirty_containers.discard(raw['Id'])
+            # 列表中查不到的容器已被删除
+            for container_id in dirty_containers:
+                self.containers.pop(container_id, None)
+        if refresh_networks:
+            raw_networks = await run_docker(docker_client.api.networks)
+            self.networks = {raw['Id']: NetworkInfo(raw['Id'], raw['Name'], raw.get('Driver', '')) for raw in raw_networks}
+
+        self.generation += 1
+        self.updated_at = time.monotonic()
+
+inventory = DockerInventory(INVENTORY_MAX_AGE, INVENTORY_EVENT_BATCH, INVENTORY_RECONNECT_DELAY)
+
+# 系统内置网络不可删除
+BUILTIN_NETWORKS = ('bridge', 'host', 'none', 'ingress', 'docker_gwbridge')
+# 可清理的已停止容器状态（与 docker container prune 一致）
+STOPPED_STATES = ('exited', 'created', 'dead')
+RESOURCE_LABELS = {'container': '容器', 'image': '镜像', 'network': '网络'}
+
+@dataclass
+class CleanupItem:
+    """单个待清理资源及其结果"""
+    kind: str
+    id: str
+    name: str
+    size: int = 0
+    status: str = 'pending'
+    error: str = ''
+    force: bool = False
+
+@dataclass
+class CleanupResult:
+    """清理结果汇总"""
+    items: list = field(default_factory=list)
+    elapsed: float = 0.0
+    # 清理前后 /system/df 的实测差值（取不到时为 None）
+    measured: int = None
+
+    @property
+    def freed(self):
+        """实际释放空间：优先使用实测值，否则按各条目独占大小估算"""
+        return self.measured if self.measured is not None else self.reclaimed
+
+    def count(self, kind=None, status='removed'):
+        return sum(1 for item in self.items if item.status == status and (kind is None or item.kind == kind))
+
+    @property
+    def reclaimed(self):
+        return sum(item.size for item in self.items if item.status == 'removed')
+
+    @property
+    def failures(self):
+        return [item for item in self.items if item.status == 'failed']
+
+@dataclass
+class DiskUsage:
+    """一次 /system/df 的分析结果（字节）"""
+    layers_size: int = 0
+    image_count: int = 0
+    dangling_count: int = 0
+    unused_tagged_count: int = 0
+    # 确定可回收：未使用镜像的独占层之和；最多可回收：再加上可能只被未使用镜像共享的层
+    image_reclaimable: int = 0
+    image_reclaimable_max: int = 0
+    container_size: int = 0
+    stopped_count: int = 0
+    container_reclaimable: int = 0
+    volume_size: int = 0
+    unused_volume_count: int = 0
+    volume_reclaimable: int = 0
+    cache_size: int = 0
+    cache_reclaimable: int = 0
+    unique_sizes: dict = field(default_factory=dict)
+
+    @property
+    def total_reclaimable(self):
+        return self.image_reclaimable + self.container_reclaimable + self.volume_reclaimable + self.cache_reclaimable
+
+def analyze_disk_usage(raw):
+    """从 /system/df 结果计算真实可回收空间
+
+    镜像的 Size 包含与其他镜像共享的层，直接相加会重复计算；
+    这里用 Size - SharedSize 得到每个镜像的独占大小。
+    """
+    usage = DiskUsage(layers_size=raw.get('LayersSize') or 0)
+    used_unique = 0
+    for image in raw.get('Images') or []:
+        size = image.get('Size', 0)
+        shared = image.get('SharedSize', -1)
+        unique = size - shared if shared >= 0 else size
+        usage.unique_sizes[image['Id']] = unique
+        usage.image_count += 1
+        if image.get('Containers', 0) > 0:
+            used_unique += unique
+            continue
+        usage.image_reclaimable += unique
+        tags = [t for t in (image.get('RepoTags') or []) if t != '<none>:<none>']
+        if tags:
+            usage.unused_tagged_count += 1
+        else:
+            usage.dangling_count += 1
+    # 与 docker system df 的算法一致：总层大小减去被使用镜像的独占层
+    usage.image_reclaimable_max = max(usage.layers_size - used_unique, usage.image_reclaimable)
+
+    for container in raw.get('Containers') or []:
+        size = container.get('SizeRw') or 0
+        usage.container_size += size
+        if container.get('State') in STOPPED_STATES:
+            usage.stopped_count += 1
+            usage.container_reclaimable += size
+
+    for volume in raw.get('Volumes') or []:
+        data = volume.get('UsageData') or {}
+        size = max(data.get('Size', 0), 0)
+        usage.volume_size += size
+        if data.get('RefCount', 1) == 0:
+            usage.unused_volume_count += 1
+            usage.volume_reclaimable += size
+
+    for record in raw.get('BuildCache') or []:
+        if record.get('Shared'):
+            continue
+        usage.cache_size += record.get('Size', 0)
+        if not record.get('InUse'):
+            usage.cache_reclaimable += record.get('Size', 0)
+    return usage
+
+async def disk_usage():
+    """一次 /system/df 调用获取全部磁盘占用"""
+    return analyze_disk_usage(await run_docker(docker_client.api.df, call_timeout=DF_TIMEOUT))
+
+async def try_disk_usage():
+    """获取磁盘占用，失败时返回 None（用于清理前后的实测，不影响清理本身）"""
+    try:
+        return await disk_usage()
+    except Exception as e:
+        logger.warning(f"获取磁盘占用失败: {e}")
+        return None
+
+def _image_waves(images):
+    """按父子关系分层：子镜像先删，父镜像在后续批次删除"""
+    pending = {image.id: image for image in images}
+    waves = []
+    while pending:
+        parents = {image.parent_id for image in pending.values()}
+        wave = [image for image_id, image in pending.items() if image_id not in parents]
+        if not wave:
+            # 理论上不会出现环，保险起见一次性处理剩余镜像
+            wave = list(pending.values())
+        for image in wave:
+            del pending[image.id]
+        waves.append(wave)
+    return waves
+
+def plan_cleanup(snapshot, containers=True, images=True, networks=True, include_tagged=False, usage=None):
+    """根据清单生成分阶段的清理计划
+
+    顺序：已停止的容器 → 镜像（子镜像先于父镜像）→ 网络。
+    仍被保留容器引用的镜像和网络会标记为跳过。
+    include_tagged 为 True 时同时清理没有任何容器使用的带标签镜像；
+    传入 usage（DiskUsage）时，条目大小使用独占层大小而非含共享层的总大小。
+    返回 [[CleanupItem, ...], ...]，同一阶段内的条目可以并发删除。
+    """
+    stages = []
+    removed_ids = set()
+    if containers:
+        stopped = [c for c in snapshot.containers.values() if c.status in STOPPED_STATES]
+        if stopped:
+            stages.append([CleanupItem('container', c.id, c.name) for c in stopped])
+            removed_ids = {c.id for c in stopped}
+    remaining = [c for c in snapshot.containers.values() if c.id not in removed_ids]
+
+    if images:
+        in_use = {c.image_id for c in remaining}
+        sizes = usage.unique_sizes if usage is not None else {}
+        dangling = [img for img in snapshot.images.values() if not img.tags]
+        skipped = [
+            CleanupItem('image', img.id, img.short_id, sizes.get(img.id, img.size), 'skipped', '仍被容器使用')
+            for img in dangling if img.id in in_use
+        ]
+        candidates = [
+            img for img in snapshot.images.values()
+            if img.id not in in_use and (include_tagged or not img.tags)
+        ]
+        for wave in _image_waves(candidates):
+            stages.append([
+                # 带多个标签的镜像按 ID 删除需要 force（仅移除标签，已确认无容器使用）
+                CleanupItem('image', img.id, img.tag if img.tags else img.short_id,
+                            sizes.get(img.id, img.size), force=len(img.tags) > 1)
+                for img in wave
+            ])
+        if skipped:
+            stages.append(skipped)
+
+    if networks:
+        in_use = {net_id for c in remaining for net_id in c.networks}
+        unused = [
+            net for net in snapshot.networks.values()
+            if net.id not in in_use and net.name not in BUILTIN_NETWORKS
+        ]
+        if unused:
+            stages.append([CleanupItem('network', net.id, net.name) for net in unused])
+    return stages
+
+async def _remove_item(item):
+    if item.kind == 'container':
+        await run_docker(docker_client.api.remove_container, item.id)
+    elif item.kind == 'image':
+        await run_docker(docker_client.api.remove_image, item.id, force=item.force)
+    elif item.kind == 'network':
+        await run_docker(docker_client.api.remove_network, item.id)
+
+async def execute_cleanup(stages, concurrency=None):
+    """按阶段执行清理计划，阶段内以有限并发删除"""
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(concurrency or CLEANUP_CONCURRENCY)
+    result = CleanupResult()
+
+    async def remove(item):
+        async with semaphore:
+            try:
+                await _remove_item(item)
+                item.status = 'removed'
+            except docker.errors.NotFound:
+                item.status = 'skipped'
+                item.error = '已不存在'
+            except Exception as e:
+                item.status = 'failed'
+                item.error = str(getattr(e, 'explanation', None) or e)
+                logger.warning(f"无法删除{RESOURCE_LABELS[item.kind]} {item.name}: {item.error}")
+
+    for stage in stages:
+        result.items.extend(stage)
+        pending = [item for item in stage if item.status == 'pending']
+        await asyncio.gather(*(remove(item) for item in pending))
+    result.elapsed = time.monotonic() - started
+    return result
+
+@dataclass
+class LogPage:
+    """一页日志及其时间边界（Unix 时间戳）"""
+    lines: list
+    first_ts: float = None
+    last_ts: float = None
+
+def _parse_log_timestamp(line):
+    """解析 timestamps=True 时的行首 RFC3339Nano 时间戳"""
+    stamp = line.split(' ', 1)[0]
+    if not stamp.endswith('Z'):
+        return None
+    seconds, _, fraction = stamp[:-1].partition('.')
+    try:
+        base = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return base.timestamp() + float(f"0.{fraction or 0}")
+
+def _read_log_lines(container_id, limit, newest, **kwargs):
+    """流式读取日志行并增量解码；newest 为 True 时保留最后 limit 行，否则读满 limit 行即关闭流"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    collected = deque(maxlen=limit) if newest else []
+    # follow 必须显式关闭，否则 stream=True 时默认会持续跟随
+    stream = docker_client.api.logs(container_id, stream=True, follow=False, timestamps=True, **kwargs)
+    try:
+        for chunk in stream:
+            pending += decoder.decode(chunk)
+            *complete, pending = pending.split('\n')
+            collected.extend(line for line in complete if line)
+            if not newest and len(collected) >= limit:
+                break
+    finally:
+        stream.close()
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        collected.append(pending)
+    return list(collected)[-limit:] if newest else collected[:limit]
+
+def read_log_page(container_id, direction='latest', cursor=None, lines=None, max_chars=None):
+    """流式读取一页日志（阻塞，需在线程池中调用）
+
+    direction: latest 最新一页；older 早于 cursor 的一页；newer 晚于 cursor 的一页。
+    增量解码，不会截断多字节字符。json-file/local 驱动先对整个文件应用 tail
+    再按 since/until 过滤，所以 older 不用 tail，而是从 cursor 往前按时间窗口
+    读取（窗口每次翻倍），直到凑满一页或到达容器创建时间，
+    每次只传输窗口内的日志，而不是从头读到 cursor。
+    """
+    lines = lines or LOG_PAGE_LINES
+    max_chars = max_chars or LOG_PAGE_CHARS
+    if direction == 'older' and cursor:
+        created = _parse_log_timestamp(docker_client.api.inspect_container(container_id)['Created']) or 0
+        collected = []
+        # since/until 均包含边界，偏移 1 微秒避免重复
+        upper = cursor - 1e-6
+        window = LOG_PAGE_WINDOW
+        while len(collected) < lines and upper > created:
+            lower = max(upper - window, created)
+            collected = _read_log_lines(
+                container_id, lines - len(collected), True,
+                since=lower if lower > 0 else None, until=upper
+            ) + collected
+            upper = lower - 1e-6
+            window *= 2
+    elif direction == 'newer' and cursor:
+        collected = _read_log_lines(container_id, lines, False, tail='all', since=cursor + 1e-6)
+    else:
+        collected = _read_log_lines(container_id, lines, True, tail=lines)
+
+    # 按字符上限裁剪，只在行边界截断；向后翻页保留最早的行，其余保留最新的行
+    total = 0
+    kept = []
+    ordered = collected if direction == 'newer' else reversed(collected)
+    for line in ordered:
+        total += len(line) + 1
+        if total > max_chars and kept:
+            break
+        kept.append(line[:max_chars])
+    if direction != 'newer':
+        kept.reverse()
+
+    stamps = [ts for ts in map(_parse_log_timestamp, kept) if ts is not None]
+    return LogPage(kept, stamps[0] if stamps else None, stamps[-1] if stamps else None)
+
+class LogCursorCache:
+    """每个容器当前所在日志页的时间边界（有界 LRU）"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is not None:
+            self._entries.move_to_end(name)
+        return entry
+
+    def put(self, name, page):
+        self._entries[name] = (page.first_ts, page.last_ts)
+        self._entries.move_to_end(name)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+log_cursors = LogCursorCache(LOG_CURSOR_CACHE_SIZE)
+
+async def load_log_page(container_name, direction='latest'):
+    """读取一页日志并更新游标，返回 (LogPage, 提示文本)"""
+    cursor = log_cursors.get(container_name)
+    note = ''
+    if direction == 'older' and cursor and cursor[0]:
+        page = await run_docker(read_log_page, container_name, 'older', cursor[0])
+        if not page.lines:
+            note = '⏮️ 没有更早的日志了'
+    elif direction == 'newer' and cursor and cursor[1]:
+        page = await run_docker(read_log_page, container_name, 'newer', cursor[1])
+        if not page.lines:
+            note = '⏭️ 已是最新日志'
+    else:
+        page = await run_docker(read_log_page, container_name)
+    if page.first_ts is not None:
+        log_cursors.put(container_name, page)
+    return page, note
+
+def format_log_page(container_name, page, note=''):
+    """渲染日志页消息和翻页按钮"""
+    def fmt(ts):
+        return datetime.fromtimestamp(ts, timezone.utc).strftime('%m-%d %H:%M:%S') if ts else '?'
+
+    # 代码块中不能出现反引号
+    body = '\n'.join(page.lines).replace('`', "'") or '(无日志)'
+    message = f"📋 **{escape_md(container_name)} 日志:**\n🕐 {fmt(page.first_ts)} ~ {fmt(page.last_ts)} (UTC)\n"
+    if note:
+        message += f"{note}\n"
+    message += f"```\n{body}\n```"
+    keyboard = [
+        [
+            InlineKeyboardButton("⬅️ 更早", callback_data=callback_data('logsprev', container_name)),
+            InlineKeyboardButton("➡️ 更新", callback_data=callback_data('logsnext', container_name))
+        ],
+        [InlineKeyboardButton("🔙 返回", callback_data=callback_data('container', container_name))]
+    ]
+    return message, InlineKeyboardMarkup(keyboard)
+
+class LogFollower:
+    """跟随单个容器的实时日志，按时间批量编辑同一条消息"""
+
+    def __init__(self, manager, container_name, bot, chat_id, message_id):
+        self.manager = manager
+        self.container_name = container_name
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.started_at = time.monotonic()
+        # 待发送的新行有上限，写入过快时丢弃最旧的行（只显示最新窗口）
+        self.pending = deque(maxlen=FOLLOW_BUFFER_LINES)
+        self.window = deque(maxlen=FOLLOW_BUFFER_LINES)
+        self.dropped = 0
+        self.received = 0
+        self._stream = None
+        self._task = None
+        self._stopping = False
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        threading.Thread(
+            target=self._read, args=(loop,), name=f'follow-{self.container_name}', daemon=True
+        ).start()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def _read(self, loop):
+        # 阻塞读取实时日志流，运行在独立线程中
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ''
+        try:
+            self._stream = docker_client.api.logs(
+                self.container_name, stream=True, follow=True, tail=0, timestamps=False
+            )
+            for chunk in self._stream:
+                pending += decoder.decode(chunk)
+                *complete, pending = pending.split('\n')
+                if complete:
+                    loop.call_soon_threadsafe(self._push, complete)
+        except Exception as e:
+            if not self._stopping:
+                logger.warning(f"跟踪 {self.container_name} 日志中断: {e}")
+        finally:
+            try:
+                loop.call_soon_threadsafe(self._push, None)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _push(self, lines):
+        if lines is None:
+            if not self._stopping:
+                self._finish('📴 日志流已结束')
+            return
+        self.received += len(lines)
+        overflow = len(self.pending) + len(lines) - FOLLOW_BUFFER_LINES
+        if overflow > 0:
+            self.dropped += overflow
+        self.pending.extend(lines)
+
+    def render(self, footer):
+        total = 0
+        shown = []
+        for line in reversed(self.window):
+            total += len(line) + 1
+            if total > FOLLOW_WINDOW_CHARS:
+                break
+            shown.append(line)
+        body = '\n'.join(reversed(shown)).replace('`', "'") or '(等待新日志...)'
+        message = f"📡 **实时日志: {escape_md(self.container_name)}**\n{footer}\n"
+        if self.dropped:
+            message += f"⚠️ 输出过快，已丢弃 {self.dropped} 行\n"
+        return message + f"```\n{body}\n```"
+
+    async def _edit(self, text, reply_markup=None, final=False):
+        # 触发限流时 safe_edit 会等待，期间新行继续累积
+        await safe_edit(
+            self.bot, self.chat_id, self.message_id, text, final=final,
+            parse_mode='Markdown', reply_markup=reply_markup
+        )
+
+    async def _flush_loop(self):
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("⏹️ 停止跟踪", callback_data=callback_data('unfollow', self.container_name))]]
+        )
+        try:
+            while True:
+                await asyncio.sleep(FOLLOW_INTERVAL)
+                if time.monotonic() - self.started_at > FOLLOW_MAX_DURATION:
+                    self._finish('⏰ 已达到最长跟踪时间')
+                    return
+                if not self.pending:
+                    continue
+                self.window.extend(self.pending)
+                self.pending.clear()
+                await self._edit(self.render(f"🟢 跟踪中，共 {self.received} 行"), reply_markup)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"更新实时日志消息错误: {e}")
+            self._finish('❌ 更新消息失败')
+
+    def _finish(self, reason):
+        # 由跟踪自身触发的结束，需确认管理器中登记的仍是自己
+        if self.manager.followers.get(self.container_name) is self:
+            asyncio.ensure_future(self.manager.stop(self.container_name, reason))
+
+    async def stop(self, reason):
+        self._stopping = True
+        if self._stream is not None:
+            self._stream.close()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self.window.extend(self.pending)
+        self.pending.clear()
+        try:
+            await self._edit(self.render(f"{reason}，共 {self.received} 行"), final=True)
+        except Exception as e:
+            logger.warning(f"结束实时日志消息错误: {e}")
+
+class FollowManager:
+    """管理所有实时日志跟踪，限制并发数量"""
+
+    def __init__(self, max_follows):
+        self.max_follows = max_follows
+        self.followers = {}
+
+    async def start(self, container_name, bot, chat_id, message_id):
+        follower = LogFollower(self, container_name, bot, chat_id, message_id)
+        self.followers[container_name] = follower
+        follower.start()
+        return follower
+
+    async def stop(self, container_name, reason='⏹️ 已停止跟踪'):
+        follower = self.followers.pop(container_name, None)
+        if follower is None:
+            return False
+        await follower.stop(reason)
+        return True
+
+    async def stop_all(self, reason='⏹️ 已停止跟踪'):
+        for container_name in list(self.followers):
+            await self.stop(container_name, reason)
+
+follow_manager = FollowManager(FOLLOW_MAX)
+
+@dataclass
+class Job:
+    """后台任务记录"""
+    id: int
+    name: str
+    description: str
+    started_at: float = field(default_factory=time.time)
+    finished_at: float = None
+    status: str = 'running'
+    exit_code: int = None
+    error: str = ''
+    line_count: int = 0
+    output: deque = field(default_factory=lambda: deque(maxlen=JOB_OUTPUT_LINES))
+    task: asyncio.Task = None
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def add_lines(self, lines):
+        self.line_count += len(lines)
+        self.output.extend(lines)
+
+class JobTracker:
+    """跟踪后台任务，保留最近的任务记录"""
+
+    def __init__(self, history_size):
+        self.jobs = deque(maxlen=history_size)
+        self._next_id = 1
+
+    def running(self, name):
+        for job in self.jobs:
+            if job.name == name and job.status == 'running':
+                return job
+        return None
+
+    def create(self, name, description):
+        job = Job(self._next_id, name, description)
+        self._next_id += 1
+        self.jobs.append(job)
+        return job
+
+    def finish(self, job, status, exit_code=None, error=''):
+        job.status = status
+        job.exit_code = exit_code
+        job.error = error
+        job.finished_at = time.time()
+
+job_tracker = JobTracker(JOB_HISTORY_SIZE)
+
+@dataclass
+class Operation:
+    """正在进行的破坏性操作：同名请求共享同一个任务和结果"""
+    name: str
+    description: str
+    keys: tuple
+    started_at: float = field(default_factory=time.time)
+    attached: int = 0
+    task: asyncio.Task = None
+
+    @property
+    def duration(self):
+        return time.time() - self.started_at
+
+class OperationLocks:
+    """按资源键加锁并对重复请求去重
+
+    资源键如 cleanup、container:<名称>、runonce。操作名相同的请求在前一个
+    完成前到达时直接等待同一个任务的结果，不会再次执行；操作名不同但资源键
+    重叠的请求排队，按键名顺序加锁以避免死锁。
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self._locks = {}
+
+    def active(self, key, exclude=None):
+        """返回占用（或正在等待）该资源键的操作"""
+        for op in self.operations.values():
+            if op is not exclude and key in op.keys:
+                return op
+        return None
+
+    def attach(self, name):
+        """附加到进行中的同名操作，没有时返回 None"""
+        op = self.operations.get(name)
+        if op is not None:
+            op.attached += 1
+            metrics.inc('operations_deduplicated_total', operation=name.partition(':')[0])
+        return op
+
+    def start(self, name, keys, description, factory, on_wait=None):
+        """启动操作并立即返回 (Operation, 是否附加到已有操作)，不等待完成"""
+        op = self.attach(name)
+        if op is not None:
+            return op, True
+        op = Operation(name, description, tuple(sorted(set(keys))))
+        self.operations[name] = op
+        op.task = asyncio.create_task(self._execute(op, factory, on_wait))
+        return op, False
+
+    async def run(self, name, keys, description, factory, on_wait=None):
+        """执行操作并等待结果，返回 (结果, 是否附加到已有操作)
+
+        调用方被取消时不会取消共享的任务，其他等待者仍能拿到结果。
+        """
+        op, attached = self.start(name, keys, description, factory, on_wait)
+        return await asyncio.shield(op.task), attached
+
+    async def _execute(self, op, factory, on_wait):
+        acquired = []
+        held = []
+        try:
+            blocker = next(filter(None, (self.active(key, exclude=op) for key in op.keys)), None)
+            if blocker is not None and on_wait is not None:
+                try:
+                    await on_wait(blocker)
+                except Exception as e:
+                    logger.warning(f"发送排队提示错误: {e}")
+            for key in op.keys:
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                acquired.append(key)
+                await entry[0].acquire()
+                held.append(key)
+            return await factory()
+        finally:
+            for key in acquired:
+                entry = self._locks[key]
+                if key in held:
+                    entry[0].release()
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+            self.operations.pop(op.name, None)
+
+operation_locks = OperationLocks()
+
+OPERATION_ATTACHED_NOTE = "♻️ 相同的操作已在进行，未重复执行，以下是它的结果\n\n"
+
+def operation_waiter(send):
+    """排队时的提示：send 为发送/编辑消息的协程函数"""
+    async def on_wait(op):
+        await send(f"⏳ 等待「{op.description}」完成（已进行 {format_duration(op.duration)}）...")
+    return on_wait
+
+JOB_STATUS_LABELS = {'running': '🟢 运行中', 'succeeded': '✅ 成功', 'failed': '❌ 失败'}
+
+def parse_duration(text):
+    """解析 30s / 15m / 24h / 7d 形式的时长，返回秒数"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def parse_go_duration(text):
+    """解析 Go 风格的时长（1h30m、90s、500ms），返回秒数"""
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001, 'us': 1e-6, 'µs': 1e-6, 'ns': 1e-9}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|us|µs|ns|h|m|s)', text)
+    if not parts or ''.join(number + unit for number, unit in parts) != text.strip():
+        raise ValueError(f"无法解析的时长: {text}")
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def _next_bit(mask, start):
+    """mask 中 >= start 的最小置位，没有时返回 None"""
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+class CronSchedule:
+    """Watchtower（robfig/cron）格式的 6 段 cron：秒 分 时 日 月 周
+
+    每个字段预先编译成整数位图，求下次触发时间时逐字段用位运算跳到下一个
+    命中值，而不是逐秒/逐分钟试探。也支持 5 段写法（秒补 0）、
+    @daily 等预定义描述符和 @every <时长>。
+    """
+
+    FIELDS = (
+        ('second', 0, 59, {}),
+        ('minute', 0, 59, {}),
+        ('hour', 0, 23, {}),
+        ('day', 1, 31, {}),
+        ('month', 1, 12, {name: i for i, name in enumerate(
+            ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}),
+        ('weekday', 0, 7, {name: i for i, name in enumerate(('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))}),
+    )
+    DESCRIPTORS = {
+        '@yearly': '0 0 0 1 1 *',
+        '@annually': '0 0 0 1 1 *',
+        '@monthly': '0 0 0 1 * *',
+        '@weekly': '0 0 0 * * 0',
+        '@daily': '0 0 0 * * *',
+        '@midnight': '0 0 0 * * *',
+        '@hourly': '0 0 * * * *',
+    }
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        self.every = None
+        text = self.DESCRIPTORS.get(self.expression.lower(), self.expression)
+        if text.lower().startswith('@every '):
+            self.every = parse_go_duration(text[len('@every '):].strip())
+            if self.every < 1:
+                raise ValueError(f"@every 间隔过短: {text}")
+            return
+        parts = text.split()
+        if len(parts) == 5:
+            parts.insert(0, '0')
+        if len(parts) != 6:
+            raise ValueError(f"cron 表达式应为 6 段（秒 分 时 日 月 周）: {expression}")
+        self.parts = parts
+        self.masks = {}
+        for (name, low, high, names), part in zip(self.FIELDS, parts):
+            self.masks[name] = self._parse_field(part, low, high, names)
+        # 周日可以写成 0 或 7
+        if self.masks['weekday'] & (1 << 7):
+            self.masks['weekday'] = (self.masks['weekday'] | 1) & ~(1 << 7)
+        # 与 robfig/cron 相同：日和周都受限时任一命中即可，否则两者都要命中
+        self.day_star = parts[3] in ('*', '?')
+        self.weekday_star = parts[5] in ('*', '?')
+
+    @staticmethod
+    def _parse_field(part, low, high, names):
+        mask = 0
+        for item in part.lower().split(','):
+            value, _, step = item.partition('/')
+            if value in ('*', '?'):
+                start, end = low, high
+            else:
+                first, dash, last = value.partition('-')
+                start = int(names.get(first, first))
+                end = int(names.get(last, last)) if dash else (high if step else start)
+            step = int(step) if step else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"cron 字段超出范围: {part}")
+            for number in range(start, end + 1, step):
+                mask |= 1 << number
+        return mask
+
+    def _day_matches(self, day):
+        day_hit = bool(self.masks['day'] >> day.day & 1)
+        weekday_hit = bool(self.masks['weekday'] >> ((day.weekday() + 1) % 7) & 1)
+        if self.day_star or self.weekday_star:
+            return day_hit and weekday_hit
+        return day_hit or weekday_hit
+
+    def next_after(self, after):
+        """after（当地时间，不带时区）之后的下一次触发时间，5 年内无触发时返回 None"""
+        masks = self.masks
+        t = after.replace(microsecond=0) + timedelta(seconds=1)
+        limit = t.year + 5
+        while t.year <= limit:
+            month = _next_bit(masks['month'], t.month)
+            if month is None:
+                t = datetime(t.year + 1, 1, 1)
+                continue
+            if month != t.month:
+                t = datetime(t.year, month, 1)
+            if not self._day_matches(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            hour = _next_bit(masks['hour'], t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+            minute = _next_bit(masks['minute'], t.minute)
+            if minute is None:
+                t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+            second = _next_bit(masks['second'], t.second)
+            if second is None:
+                t = t.replace(second=0) + timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+        return None
+
+    def forecast(self, now, tz, count, anchor=None):
+        """从 now（带时区）起的后 count 次触发时间（tz 时区）
+
+        @every 从 anchor（通常是容器启动时间）起按固定间隔推算。
+        """
+        runs = []
+        if self.every is not None:
+            anchor = anchor or now
+            elapsed = max((now - anchor).total_seconds(), 0)
+            first = anchor + timedelta(seconds=(elapsed // self.every + 1) * self.every)
+            return [(first + timedelta(seconds=self.every * i)).astimezone(tz) for i in range(count)]
+        local = now.astimezone(tz).replace(tzinfo=None)
+        while len(runs) < count:
+            local = self.next_after(local)
+            if local is None:
+                break
+            runs.append(tz.localize(local))
+        return runs
+
+    def describe(self):
+        """常见形式的中文描述"""
+        if self.every is not None:
+            return f"🔁 每 {format_duration(self.every)} 执行一次"
+        second, minute, hour, day, month, weekday = self.parts
+        daily = day in ('*', '?') and month == '*' and weekday in ('*', '?')
+        if daily and all(part.isdigit() for part in (second, minute, hour)):
+            return f"📅 每天 {int(hour):02d}:{int(minute):02d}:{int(second):02d}"
+        if daily and hour == '*' and second.isdigit() and minute.isdigit():
+            return f"🕐 每小时第 {int(minute)} 分"
+        if daily and hour.startswith('*/') and second.isdigit() and minute.isdigit():
+            return f"🕕 每 {hour[2:]} 小时执行一次"
+        return "⚙️ 自定义计划"
+
+def watchtower_schedule_config(attrs):
+    """从 watchtower 容器的命令行参数和环境变量中读取调度配置
+
+    返回 (CronSchedule, 来源说明, 时区)。命令行参数优先于环境变量；
+    两者都没有时与 watchtower 一致，默认每 24 小时轮询一次。
+    """
+    command = attrs['Config'].get('Cmd') or []
+    env = dict(item.split('=', 1) for item in attrs['Config'].get('Env') or [] if '=' in item)
+    tz = pytz.timezone(env.get('TZ', 'UTC'))
+
+    def flag(*names):
+        for i, arg in enumerate(command):
+            for name in names:
+                if arg == name and i + 1 < len(command):
+                    return command[i + 1]
+                if arg.startswith(name + '='):
+                    return arg.split('=', 1)[1]
+        return None
+
+    expression = flag('--schedule', '-s')
+    if expression:
+        return CronSchedule(expression), '命令行 --schedule', tz
+    interval = flag('--interval', '-i')
+    if interval:
+        return CronSchedule(f"@every {interval}s"), '命令行 --interval', tz
+    if env.get('WATCHTOWER_SCHEDULE'):
+        return CronSchedule(env['WATCHTOWER_SCHEDULE']), '环境变量 WATCHTOWER_SCHEDULE', tz
+    if env.get('WATCHTOWER_POLL_INTERVAL'):
+        return CronSchedule(f"@every {env['WATCHTOWER_POLL_INTERVAL']}s"), '环境变量 WATCHTOWER_POLL_INTERVAL', tz
+    return CronSchedule('@every 86400s'), 'watchtower 默认值', tz
+
+class HistoryStore:
+    """更新记录和容器事件的本地持久化存储（SQLite WAL，仅追加）
+
+    所有数据库操作都在单独的单线程执行器中串行执行；
+    事件先在内存中缓冲，定期批量写入。
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            type TEXT NOT NULL,
+            action TEXT NOT NULL,
+            container TEXT,
+            image TEXT,
+            detail TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_events_container_ts ON events (container, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)",
+        "CREATE INDEX IF NOT EXISTS idx_events_type_ts ON events (type, ts)",
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL,
+            duration REAL,
+            status TEXT,
+            exit_code INTEGER,
+            summary TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_runs_name_started ON runs (name, started)",
+        """CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            last_run REAL,
+            status TEXT,
+            duration REAL,
+            message TEXT
+        )""",
+    )
+
+    # 高频且无记录价值的事件
+    IGNORED_ACTIONS = ('exec_create', 'exec_start', 'exec_die', 'exec_detach', 'top', 'attach', 'resize')
+
+    def __init__(self, path, retention_days, flush_interval):
+        self.path = path
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._executor = None
+        self._buffer = []
+        self._tasks = []
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # auto_vacuum 只对新建的数据库生效，必须在建表前设置
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        self._conn = conn
+
+    async def start(self):
+        if not self.path:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        try:
+            await self._call(self._open)
+        except Exception as e:
+            logger.error(f"打开历史数据库失败，历史记录已禁用: {e}")
+            return
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        logger.info(f"历史数据库已打开: {self.path}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.enabled:
+            await self.flush()
+            await self._call(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def add_events(self, events):
+        """缓冲一批原始 Docker 事件（作为清单监听器使用）"""
+        if not self.enabled:
+            return
+        for event in events:
+            kind = event.get('Type')
+            action = (event.get('Action') or '').split(':')[0]
+            if kind not in ('container', 'image') or action in self.IGNORED_ACTIONS:
+                continue
+            attributes = (event.get('Actor') or {}).get('Attributes') or {}
+            ts = event['timeNano'] / 1e9 if event.get('timeNano') else event.get('time', time.time())
+            if kind == 'container':
+                container, image = attributes.get('name'), attributes.get('image')
+            else:
+                container, image = None, attributes.get('name') or (event.get('Actor') or {}).get('ID')
+            detail = event.get('Action') if event.get('Action') != action else attributes.get('exitCode')
+            self._buffer.append((ts, kind, action, container, image, detail))
+
+    def _insert_events(self, rows):
+        self._conn.executemany(
+            "INSERT INTO events (ts, type, action, container, image, detail) VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        self._conn.commit()
+
+    async def flush(self):
+        if not self._buffer or not self.enabled:
+            return
+        rows, self._buffer = self._buffer, []
+        await self._call(self._insert_events, rows)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"写入历史事件失败: {e}")
+
+    def _insert_run(self, row):
+        self._conn.execute(
+            "INSERT INTO runs (name, started, finished, duration, status, exit_code, summary) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", row
+        )
+        self._conn.commit()
+
+    async def record_run(self, job, summary=''):
+        """记录一次已结束的后台任务"""
+        if not self.enabled:
+            return
+        row = (job.name, job.started_at, job.finished_at, job.duration, job.status, job.exit_code, summary)
+        try:
+            await self._call(self._insert_run, row)
+        except Exception as e:
+            logger.error(f"写入任务记录失败: {e}")
+
+    def _select(self, sql, params):
+        return self._conn.execute(sql, params).fetchall()
+
+    async def query_events(self, container=None, since=None, limit=30):
+        """按容器和/或起始时间查询事件，按时间倒序"""
+        await self.flush()
+        clauses, params = [], []
+        if container:
+            clauses.append("container = ?")
+            params.append(container)
+        if since:
+            clauses.append("ts >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return await self._call(
+            self._select,
+            f"SELECT ts, type, action, container, image, detail FROM events {where} ORDER BY ts DESC LIMIT ?",
+            params + [limit]
+        )
+
+    async def query_runs(self, name=None, since=None, limit=10):
+        """查询任务记录，按开始时间倒序"""
+        clauses, params = [], []
+        if name:
+            clauses.append("name = ?")
+            params.append(name)
+        if since:
+            clauses.append("started >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return await self._call(
+            self._select,
+            f"SELECT started, duration, status, exit_code, summary, name FROM runs {where} "
+            f"ORDER BY started DESC LIMIT ?",
+            params + [limit]
+        )
+
+    def _compact(self, cutoff):
+        events = self._conn.execute("DELETE FROM events WHERE ts < ?", (cutoff,)).rowcount
+        runs = self._conn.execute("DELETE FROM runs WHERE started < ?", (cutoff,)).rowcount
+        self._conn.commit()
+        # execute() 只执行一步，incremental_vacuum 每步只释放一页（fetchall 也不会继续）；
+        # executescript 会把语句执行到底，清空全部空闲页
+        self._conn.executescript("PRAGMA incremental_vacuum;")
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return events, runs
+
+    async def compact(self):
+        """删除超过保留期的数据并回收空间"""
+        if not self.enabled:
+            return 0, 0
+        await self.flush()
+        cutoff = time.time() - self.retention_days * 86400
+        events, runs = await self._call(self._compact, cutoff)
+        logger.info(f"历史数据已压缩: 删除 {events} 条事件, {runs} 条任务记录")
+        return events, runs
+
+    def _save_job_state(self, row):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO job_state (name, last_run, status, duration, message) VALUES (?, ?, ?, ?, ?)", row
+        )
+        self._conn.commit()
+
+    async def save_job_state(self, task):
+        """保存定时任务的最近一次运行信息"""
+        if not self.enabled:
+            return
+        row = (task.name, task.last_run, task.last_status, task.last_duration, task.last_message)
+        try:
+            await self._call(self._save_job_state, row)
+        except Exception as e:
+            logger.error(f"保存定时任务状态失败: {e}")
+
+    async def load_job_states(self):
+        """读取所有定时任务的最近一次运行信息：{name: (last_run, status, duration, message)}"""
+        if not self.enabled:
+            return {}
+        rows = await self._call(self._select, "SELECT name, last_run, status, duration, message FROM job_state", ())
+        return {row[0]: row[1:] for row in rows}
+
+history = HistoryStore(HISTORY_DB_PATH, HISTORY_RETENTION_DAYS, HISTORY_FLUSH_INTERVAL)
+
+def summarize_job_output(job):
+    """提取 watchtower 输出中的会话汇总行"""
+    for line in reversed(job.output):
+        if 'Session done' in line:
+            return line[-300:]
+    return '\n'.join(list(job.output)[-3:])[-300:]
+
+def exec_stream(loop, job, container_name, cmd):
+    """执行容器内命令并流式收集输出，返回退出码（阻塞，在独立线程中运行）"""
+    exec_id = docker_client.api.exec_create(container_name, cmd)['Id']
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    for chunk in docker_client.api.exec_start(exec_id, stream=True):
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split('\n')
+        if complete:
+            loop.call_soon_threadsafe(job.add_lines, complete)
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        loop.call_soon_threadsafe(job.add_lines, [pending])
+    return docker_client.api.exec_inspect(exec_id).get('ExitCode')
+
+def format_job_output(job, lines=15):
+    """渲染任务输出末尾若干行"""
+    tail = list(job.output)[-lines:]
+    body = '\n'.join(tail).replace('`', "'")[-3000:] or '(暂无输出)'
+    return f"```\n{body}\n```"
+
+async def _report_progress(job, bot, chat_id, message_id):
+    last_count = -1
+    while True:
+        await asyncio.sleep(RUNONCE_PROGRESS_INTERVAL)
+        if job.line_count == last_count:
+            continue
+        last_count = job.line_count
+        try:
+            await safe_edit(
+                bot, chat_id, message_id,
+                f"🔄 **{job.description}进行中** (#{job.id})\n"
+                f"⏱️ 已运行：{format_duration(job.duration)}，输出 {job.line_count} 行\n"
+                + format_job_output(job),
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.warning(f"更新任务进度消息错误: {e}")
+
+async def run_exec_job(job, container_name, cmd, bot, chat_id, message_id):
+    """以后台任务执行容器内命令，定期推送进度并在结束时汇报"""
+    loop = asyncio.get_running_loop()
+    progress = asyncio.create_task(_report_progress(job, bot, chat_id, message_id))
+    try:
+        exit_code = await asyncio.wait_for(
+            run_in_thread(exec_stream, loop, job, container_name, cmd, name=f'job-{job.id}'),
+            RUNONCE_TIMEOUT
+        )
+        job_tracker.finish(job, 'succeeded' if exit_code == 0 else 'failed', exit_code)
+    except asyncio.TimeoutError:
+        job_tracker.finish(job, 'failed', error=f'超过 {format_duration(RUNONCE_TIMEOUT)} 未完成')
+    except Exception as e:
+        logger.error(f"后台任务 #{job.id} 执行错误: {e}")
+        job_tracker.finish(job, 'failed', error=str(e))
+    finally:
+        progress.cancel()
+    await history.record_run(job, summarize_job_output(job))
+    text, parse_mode = format_job_result(job)
+    try:
+        await safe_edit(bot, chat_id, message_id, text, final=True, parse_mode=parse_mode)
+    except Exception as e:
+        logger.error(f"发送任务结果错误: {e}")
+    return job
+
+def format_job_result(job):
+    """后台任务结束后的汇报文本，返回 (文本, parse_mode)"""
+    if job.status == 'succeeded':
+        text = f"✅ {job.description}已完成 (#{job.id})\n⏱️ 耗时：{format_duration(job.duration)}"
+        parse_mode = None
+    elif job.exit_code is not None:
+        text = (
+            f"⚠️ {job.description}完成，但有警告或错误 (#{job.id}, 退出码 {job.exit_code}):\n"
+            + format_job_output(job)
+        )
+        parse_mode = 'Markdown'
+    else:
+        text = f"❌ 执行{job.description}时出错 (#{job.id}): {job.error}"
+        parse_mode = None
+    return text, parse_mode
+
+async def report_attached_job(op, bot, chat_id, message_id):
+    """重复请求不再执行命令，等同一任务结束后把结果写到自己的消息里"""
+    try:
+        job = await asyncio.shield(op.task)
+        text, parse_mode = format_job_result(job)
+        await safe_edit(bot, chat_id, message_id, OPERATION_ATTACHED_NOTE + text, final=True, parse_mode=parse_mode)
+    except Exception as e:
+        logger.error(f"发送任务结果错误: {e}")
+
+COMPOSE_PROJECT_LABEL = 'com.docker.compose.project'
+COMPOSE_SERVICE_LABEL = 'com.docker.compose.service'
+COMPOSE_DEPENDS_LABEL = 'com.docker.compose.depends_on'
+
+BULK_ACTIONS = {
+    'start': ('▶️', '启动'),
+    'stop': ('⏹️', '停止'),
+    'restart': ('🔄', '重启'),
+    'update': ('⬆️', '更新'),
+}
+
+BULK_STATUS_ICONS = {
+    'pending': '⏳', 'running': '🔄', 'done': '✅', 'skipped': '⏭️', 'failed': '❌', 'rolled_back': '↩️',
+}
+
+@dataclass
+class BulkItem:
+    """批量操作中的单个容器"""
+    container: ContainerInfo
+    status: str = 'pending'
+    error: str = ''
+
+def select_containers(snapshot, selectors):
+    """按选择器匹配容器
+
+    支持：名称或通配符（web-*）、label=键 / label=键=值、project=compose 项目名。
+    返回 (匹配的容器列表, 未匹配任何容器的选择器列表)。
+    """
+    matched = {}
+    unmatched = []
+    containers = snapshot.container_list()
+    for selector in selectors:
+        if selector.startswith('label='):
+            key, _, value = selector[len('label='):].partition('=')
+            hits = [c for c in containers if key in c.labels and (not value or c.labels[key] == value)]
+        elif selector.startswith('project='):
+            project = selector[len('project='):]
+            hits = [c for c in containers if c.labels.get(COMPOSE_PROJECT_LABEL) == project]
+        else:
+            hits = [c for c in containers if fnmatch.fnmatchcase(c.name, selector)]
+        if not hits:
+            unmatched.append(selector)
+        for container in hits:
+            matched[container.id] = container
+    return list(matched.values()), unmatched
+
+def dependency_waves(containers, reverse=False):
+    """按 compose depends_on 分层，被依赖的容器在前；reverse=True 时依赖方在前（用于停止）"""
+    by_service = {}
+    for container in containers:
+        key = (container.labels.get(COMPOSE_PROJECT_LABEL), container.labels.get(COMPOSE_SERVICE_LABEL))
+        if key[1]:
+            by_service.setdefault(key, []).append(container.id)
+
+    depends = {}
+    for container in containers:
+        project = container.labels.get(COMPOSE_PROJECT_LABEL)
+        deps = set()
+        # 格式：db:service_started:false,redis:service_healthy:true
+        for entry in (container.labels.get(COMPOSE_DEPENDS_LABEL) or '').split(','):
+            service = entry.split(':', 1)[0].strip()
+            deps.update(by_service.get((project, service), []))
+        deps.discard(container.id)
+        depends[container.id] = deps
+
+    pending = {c.id: c for c in containers}
+    waves = []
+    while pending:
+        wave = [c for c in pending.values() if not depends[c.id] & pending.keys()]
+        if not wave:
+            # 存在循环依赖，剩余容器一起处理
+            wave = list(pending.values())
+        for container in wave:
+            del pending[container.id]
+        waves.append(wave)
+    return list(reversed(waves)) if reverse else waves
+
+async def _container_action(action, container_id):
+    if action == 'start':
+        await run_docker(docker_client.api.start, container_id, call_timeout=CONTAINER_OP_TIMEOUT)
+    elif action == 'stop':
+        await run_docker(docker_client.api.stop, container_id, call_timeout=CONTAINER_OP_TIMEOUT)
+    elif action == 'restart':
+        await run_docker(docker_client.api.restart, container_id, call_timeout=CONTAINER_OP_TIMEOUT)
+
+async def bulk_container_action(action, items, on_progress=None, concurrency=None):
+    """按依赖顺序分批并发执行启动/停止/重启，结果写回各 BulkItem"""
+    by_id = {item.container.id: item for item in items}
+    semaphore = asyncio.Semaphore(concurrency or BULK_CONCURRENCY)
+
+    async def run(item):
+        async with semaphore:
+            running = item.container.status == 'running'
+            if (action == 'start' and running) or (action == 'stop' and not running):
+                item.status = 'skipped'
+                return
+            item.status = 'running'
+            try:
+                await _container_action(action, item.container.id)
+                item.status = 'done'
+            except Exception as e:
+                item.status = 'failed'
+                item.error = str(getattr(e, 'explanation', None) or e)
+                logger.warning(f"{BULK_ACTIONS[action][1]}容器 {item.container.name} 失败: {item.error}")
+            if on_progress is not None:
+                on_progress()
+
+    containers = [item.container for item in items]
+    for wave in dependency_waves(containers, reverse=(action == 'stop')):
+        await asyncio.gather(*(run(by_id[c.id]) for c in wave))
+    return items
+
+def format_bulk_summary(action, items, elapsed, finished, limit=40):
+    """渲染批量操作汇总"""
+    icon, label = BULK_ACTIONS[action]
+    counts = {status: sum(1 for item in items if item.status == status) for status in BULK_STATUS_ICONS}
+    title = f"{icon} **批量{label}{'完成' if finished else '进行中'}**"
+    lines = [
+        title,
+        f"📦 共 {len(items)} 个：✅ {counts['done']}  ❌ {counts['failed'] + counts['rolled_back']}"
+        f"  ⏭️ {counts['skipped']}  ⏳ {counts['pending'] + counts['running']}",
+        f"⏱️ 耗时：{format_duration(elapsed)}",
+        "",
+    ]
+    for item in items[:limit]:
+        line = f"{BULK_STATUS_ICONS[item.status]} {item.container.name}"
+        if item.error:
+            line += f" - {item.error[:80]}"
+        lines.append(line)
+    if len(items) > limit:
+        lines.append(f"... 另有 {len(items) - limit} 个")
+    return "\n".join(lines)
+
+async def run_bulk_command(update, context, action, selectors):
+    """解析选择器并执行批量操作，持续更新同一条汇总消息"""
+    icon, label = BULK_ACTIONS[action]
+    containers, unmatched = select_containers(await inventory.snapshot(), selectors)
+    if unmatched:
+        await update.message.reply_text(f"❌ 未找到匹配的容器: **{', '.join(unmatched)}**")
+        if not containers:
+            return
+    if not containers:
+        return
+
+    started = time.monotonic()
+    message = await update.message.reply_text(f"{icon} 正在{label} {len(containers)} 个容器...")
+    items = [BulkItem(c) for c in containers]
+    dirty = asyncio.Event()
+
+    async def refresh():
+        # 节流：最多每 BULK_EDIT_INTERVAL 秒编辑一次
+        while True:
+            await dirty.wait()
+            dirty.clear()
+            try:
+                await safe_edit(
+                    context.bot, message.chat_id, message.message_id,
+                    format_bulk_summary(action, items, time.monotonic() - started, False)
+                )
+            except Exception as e:
+                logger.warning(f"更新批量操作消息错误: {e}")
+            await asyncio.sleep(BULK_EDIT_INTERVAL)
+
+    refresher = asyncio.create_task(refresh())
+    runner = rolling_update if action == 'update' else bulk_container_action
+    names = sorted(c.name for c in containers)
+    try:
+        # 同一批容器的相同操作只执行一次；涉及相同容器的其他操作排队
+        items, attached = await operation_locks.run(
+            f"bulk:{action}:{','.join(names)}", [f"container:{name}" for name in names],
+            f"{label} {len(names)} 个容器", lambda: runner(action, items, on_progress=dirty.set),
+            on_wait=operation_waiter(update.message.reply_text)
+        )
+    finally:
+        refresher.cancel()
+    summary = format_bulk_summary(action, items, time.monotonic() - started, True)
+    await safe_edit(
+        context.bot, message.chat_id, message.message_id,
+        (OPERATION_ATTACHED_NOTE if attached else "") + summary, final=True
+    )
+
+def _recreate_config(attrs, image, image_config=None):
+    """根据旧容器的 inspect 结果生成新容器的创建参数
+
+    容器的 Config 中混有旧镜像的默认值（Env、Cmd、Entrypoint 等），
+    与 Watchtower 一样去掉和旧镜像配置（image_config）相同的部分，
+    让新镜像的默认值生效，只保留用户显式设置的值。
+    返回 (create 请求体, 创建后还需要连接的其他网络)；
+    旧版 API 创建时只能指定一个网络，其余网络在创建后再连接。
+    """
+    short_id = attrs['Id'][:12]
+    config = dict(attrs['Config'])
+    config['Image'] = image
+    image_config = image_config or {}
+    for key in ('Cmd', 'Entrypoint', 'WorkingDir', 'User', 'Healthcheck', 'StopSignal'):
+        if key in config and config[key] == image_config.get(key):
+            config.pop(key)
+    image_env = set(image_config.get('Env') or [])
+    config['Env'] = [entry for entry in config.get('Env') or [] if entry not in image_env]
+    for key in ('ExposedPorts', 'Volumes'):
+        image_keys = image_config.get(key) or {}
+        config[key] = {k: v for k, v in (config.get(key) or {}).items() if k not in image_keys}
+    image_labels = image_config.get('Labels') or {}
+    config['Labels'] = {k: v for k, v in (config.get('Labels') or {}).items() if image_labels.get(k) != v}
+    # 自动生成的主机名等于旧容器 ID 前缀，交给新容器重新生成
+    if config.get('Hostname') == short_id:
+        config.pop('Hostname')
+    config['HostConfig'] = attrs['HostConfig']
+
+    endpoints = {}
+    for name, network in ((attrs.get('NetworkSettings') or {}).get('Networks') or {}).items():
+        endpoints[name] = {
+            'Aliases': [alias for alias in network.get('Aliases') or [] if alias != short_id],
+            'IPAMConfig': network.get('IPAMConfig'),
+            'Links': network.get('Links'),
+        }
+    first = next(iter(endpoints), None)
+    if first and not config['HostConfig'].get('NetworkMode', '').startswith('container:'):
+        config['NetworkingConfig'] = {'EndpointsConfig': {first: endpoints.pop(first)}}
+    else:
+        endpoints = {}
+    return config, endpoints
+
+async def wait_until_healthy(container_id):
+    """健康检查闸门：有 HEALTHCHECK 时等待 healthy，否则要求保持运行 UPDATE_STABLE_SECONDS 秒"""
+    started = time.monotonic()
+    while True:
+        state = (await run_docker(docker_client.api.inspect_container, container_id))['State']
+        health = (state.get('Health') or {}).get('Status')
+        if not state.get('Running') or state.get('Restarting'):
+            raise RuntimeError(f"新容器未能保持运行（退出码 {state.get('ExitCode')}）")
+        if health == 'unhealthy':
+            raise RuntimeError('新容器健康检查失败')
+        if health == 'healthy' or (health is None and time.monotonic() - started >= UPDATE_STABLE_SECONDS):
+            return
+        if time.monotonic() - started > UPDATE_HEALTH_TIMEOUT:
+            raise RuntimeError(f"等待健康检查超过 {format_duration(UPDATE_HEALTH_TIMEOUT)}")
+        await asyncio.sleep(1)
+
+async def recreate_container(item):
+    """拉取新镜像并重建单个容器，失败时恢复为使用旧镜像的原容器
+
+    新容器保持原容器的运行状态：原来已停止的只创建不启动。
+    """
+    api = docker_client.api
+    attrs = await run_docker(api.inspect_container, item.container.id)
+    ref = attrs['Config']['Image']
+    if ref.startswith('sha256:') or '@' in ref:
+        item.status, item.error = 'skipped', '未使用 tag，无法更新'
+        return
+    if os.getenv('HOSTNAME') and attrs['Id'].startswith(os.getenv('HOSTNAME')):
+        item.status, item.error = 'skipped', '不能更新机器人自身'
+        return
+    if attrs['HostConfig'].get('AutoRemove'):
+        # --rm 容器停止即被删除，无法改名备份，也无法回滚
+        item.status, item.error = 'skipped', '使用了 --rm（AutoRemove），无法安全重建'
+        return
+    was_running = attrs['State'].get('Running', False)
+
+    await run_docker(api.pull, ref, call_timeout=UPDATE_PULL_TIMEOUT)
+    new_image = (await run_docker(api.inspect_image, ref))['Id']
+    if new_image == attrs['Image']:
+        item.status, item.error = 'skipped', '已是最新'
+        return
+
+    name = attrs['Name'].lstrip('/')
+    backup = f"{name}-rollback-{int(time.time())}"
+    old_image = await run_docker(api.inspect_image, attrs['Image'])
+    config, extra_networks = _recreate_config(attrs, ref, old_image.get('Config'))
+    new_id = None
+    renamed = False
+    try:
+        # 停止和改名也在回滚范围内：停止超时或改名失败时同样恢复原容器
+        if was_running:
+            await run_docker(api.stop, attrs['Id'], call_timeout=CONTAINER_OP_TIMEOUT)
+        await run_docker(api.rename, attrs['Id'], backup)
+        renamed = True
+        new_id = (await run_docker(api.create_container_from_config, config, name))['Id']
+        for network, endpoint in extra_networks.items():
+            await run_docker(api.connect_container_to_network, new_id, network, aliases=endpoint['Aliases'])
+        if was_running:
+            await run_docker(api.start, new_id, call_timeout=CONTAINER_OP_TIMEOUT)
+            await wait_until_healthy(new_id)
+    except Exception as e:
+        logger.warning(f"更新容器 {name} 失败，回滚到镜像 {attrs['Image'][7:19]}: {e}")
+        if new_id:
+            await run_docker(api.remove_container, new_id, force=True)
+        if renamed:
+            await run_docker(api.rename, attrs['Id'], name)
+        if was_running:
+            await run_docker(api.start, attrs['Id'], call_timeout=CONTAINER_OP_TIMEOUT)
+        item.status, item.error = 'rolled_back', f"已回滚：{e}"
+        return
+    await run_docker(api.remove_container, attrs['Id'])
+    item.status = 'done'
+
+async def rolling_update(action, items, on_progress=None, concurrency=None):
+    """滚动更新：按依赖顺序每批 UPDATE_PARALLELISM 个，任何一个失败则停止后续批次"""
+    by_id = {item.container.id: item for item in items}
+    ordered = [by_id[c.id] for wave in dependency_waves([item.container for item in items]) for c in wave]
+    batch_size = max(concurrency or UPDATE_PARALLELISM, 1)
+
+    async def run(item):
+        item.status = 'running'
+        if on_progress is not None:
+            on_progress()
+        try:
+            await recreate_container(item)
+        except Exception as e:
+            item.status = 'failed'
+            item.error = str(getattr(e, 'explanation', None) or e)
+            logger.warning(f"更新容器 {item.container.name} 失败: {item.error}")
+        if on_progress is not None:
+            on_progress()
+
+    for start in range(0, len(ordered), batch_size):
+        batch = ordered[start:start + batch_size]
+        await asyncio.gather(*(run(item) for item in batch))
+        if any(item.status in ('failed', 'rolled_back') for item in batch):
+            for item in ordered[start + batch_size:]:
+                item.status, item.error = 'skipped', '前一批更新失败，已中止'
+            break
+    return items
+
+class MetricRing:
+    """定长环形缓冲区，所有采样平铺存放在一个 array('d') 中"""
+
+    FIELDS = ('ts', 'cpu', 'mem', 'mem_limit', 'blk_read', 'blk_write', 'net_rx', 'net_tx')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.width = len(self.FIELDS)
+        self.data = array('d', bytes(8 * capacity * self.width))
+        self.head = 0
+        self.count = 0
+
+    def append(self, values):
+        offset = self.head * self.width
+        self.data[offset:offset + self.width] = array('d', values)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def get(self, back=0):
+        """返回倒数第 back 个采样（0 为最新），超出范围返回 None"""
+        if back >= self.count:
+            return None
+        index = (self.head - 1 - back) % self.capacity
+        offset = index * self.width
+        return dict(zip(self.FIELDS, self.data[offset:offset + self.width]))
+
+    def oldest(self):
+        return self.get(self.count - 1)
+
+def parse_stats(raw):
+    """从一次 stats 返回中提取 CPU%、内存和累计 IO 字节"""
+    cpu = raw.get('cpu_stats') or {}
+    precpu = raw.get('precpu_stats') or {}
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    online = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+    cpu_percent = cpu_delta / system_delta * online * 100 if system_delta > 0 and cpu_delta > 0 else 0.0
+
+    memory = raw.get('memory_stats') or {}
+    details = memory.get('stats') or {}
+    # 与 docker stats 一致：扣除页缓存（cgroup v1 为 cache，v2 为 inactive_file）
+    cache = details.get('total_inactive_file', details.get('inactive_file', details.get('cache', 0)))
+    mem_usage = max(memory.get('usage', 0) - cache, 0)
+
+    blk_read = blk_write = 0
+    for entry in (raw.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+        op = entry.get('op', '').lower()
+        if op == 'read':
+            blk_read += entry.get('value', 0)
+        elif op == 'write':
+            blk_write += entry.get('value', 0)
+
+    net_rx = net_tx = 0
+    for iface in (raw.get('networks') or {}).values():
+        net_rx += iface.get('rx_bytes', 0)
+        net_tx += iface.get('tx_bytes', 0)
+
+    return (time.time(), cpu_percent, mem_usage, memory.get('limit', 0), blk_read, blk_write, net_rx, net_tx)
+
+class StatsSampler:
+    """后台资源采样：为每个运行中容器跟随 stats 流，采样写入各自的环形缓冲区"""
+
+    def __init__(self, history, interval, sync_interval):
+        self.history = history
+        self.interval = interval
+        self.sync_interval = sync_interval
+        self.rings = {}
+        self.names = {}
+        self._stops = {}
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for stop in self._stops.values():
+            stop.set()
+        self._stops.clear()
+
+    async def _sync_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                snapshot = await inventory.snapshot()
+                running = {c.id: c.name for c in snapshot.containers.values() if c.status == 'running'}
+                for container_id, name in running.items():
+                    self.names[container_id] = name
+                    if container_id not in self._stops:
+                        stop = threading.Event()
+                        self._stops[container_id] = stop
+                        self.rings.setdefault(container_id, MetricRing(self.history))
+                        threading.Thread(
+                            target=self._follow, args=(loop, container_id, stop),
+                            name=f'stats-{name}', daemon=True
+                        ).start()
+                for container_id in list(self._stops):
+                    if container_id not in running:
+                        self._stops.pop(container_id).set()
+                        self.rings.pop(container_id, None)
+                        self.names.pop(container_id, None)
+            except Exception as e:
+                logger.warning(f"同步资源采样容器列表错误: {e}")
+            await asyncio.sleep(self.sync_interval)
+
+    def _follow(self, loop, container_id, stop):
+        # stats 流大约每秒返回一次，按 interval 降采样；stop 置位后在下一次返回时退出
+        last = 0.0
+        try:
+            for raw in docker_client.api.stats(container_id, stream=True, decode=True):
+                if stop.is_set():
+                    break
+                now = time.monotonic()
+                if now - last < self.interval:
+                    continue
+                last = now
+                loop.call_soon_threadsafe(self._record, container_id, parse_stats(raw))
+        except Exception as e:
+            if not stop.is_set():
+                logger.debug(f"容器 {container_id[:12]} 资源采样结束: {e}")
+        finally:
+            try:
+                loop.call_soon_threadsafe(self._forget, container_id, stop)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _record(self, container_id, sample):
+        ring = self.rings.get(container_id)
+        if ring is not None:
+            ring.append(sample)
+
+    def _forget(self, container_id, stop):
+        # 流结束（容器停止）后允许下一轮同步重新建立
+        if self._stops.get(container_id) is stop:
+            del self._stops[container_id]
+
+    def current(self):
+        """返回每个容器的最新指标及窗口内 IO 速率"""
+        results = []
+        for container_id, ring in self.rings.items():
+            latest = ring.get()
+            if latest is None:
+                continue
+            oldest = ring.oldest()
+            span = latest['ts'] - oldest['ts']
+
+            def rate(key):
+                return (latest[key] - oldest[key]) / span if span > 0 else 0.0
+
+            results.append({
+                'name': self.names.get(container_id, container_id[:12]),
+                'cpu': latest['cpu'],
+                'mem': latest['mem'],
+                'mem_limit': latest['mem_limit'],
+                'blk_read': rate('blk_read'),
+                'blk_write': rate('blk_write'),
+                'net_rx': rate('net_rx'),
+                'net_tx': rate('net_tx'),
+                'window': span,
+            })
+        return results
+
+stats_sampler = StatsSampler(STATS_HISTORY, STATS_SAMPLE_INTERVAL, STATS_SYNC_INTERVAL)
+
+def format_container_stats(entry):
+    mem = format_bytes(entry['mem'])
+    if entry['mem_limit']:
+        mem += f" / {format_bytes(entry['mem_limit'])} ({entry['mem'] / entry['mem_limit'] * 100:.1f}%)"
+    return (
+        f"📦 **{entry['name']}**\n"
+        f"   🧮 CPU：{entry['cpu']:.1f}%   🧠 内存：{mem}\n"
+        f"   💽 磁盘：读 {format_bytes(entry['blk_read'])}/s 写 {format_bytes(entry['blk_write'])}/s\n"
+        f"   🌐 网络：收 {format_bytes(entry['net_rx'])}/s 发 {format_bytes(entry['net_tx'])}/s\n"
+    )
+
+DOCKER_HUB = 'docker.io'
+
+def parse_image_ref(ref):
+    """拆分镜像引用，返回 (仓库地址, 仓库路径, tag 或摘要)
+
+    与 docker 的规则一致：第一段不含 . 或 : 且不是 localhost 时视为 Docker Hub，
+    Docker Hub 的单段名称补全为 library/ 前缀。
+    """
+    name, _, digest = ref.partition('@')
+    tag = ''
+    last = name.rsplit('/', 1)[-1]
+    if ':' in last:
+        name, tag = name.rsplit(':', 1)
+    first, sep, rest = name.partition('/')
+    if sep and ('.' in first or ':' in first or first == 'localhost'):
+        registry, repository = first, rest
+    else:
+        registry, repository = DOCKER_HUB, name
+    if registry == DOCKER_HUB and '/' not in repository:
+        repository = f'library/{repository}'
+    return registry, repository, digest or tag or 'latest'
+
+@dataclass
+class UpdateCheck:
+    """单个镜像引用的更新检查结果"""
+    ref: str
+    containers: list
+    status: str
+    local_digest: str = ''
+    remote_digest: str = ''
+    error: str = ''
+
+class RegistryClient:
+    """查询镜像仓库中 tag 当前指向的 manifest 摘要（只发 HEAD，不拉取镜像）
+
+    所有请求共用一个带连接池的 requests.Session，在独立线程池中并发执行，
+    不占用 Docker 调用池。摘要和匿名 token 按 TTL 缓存，避免触发仓库限流。
+    overrides 可把仓库映射到其他地址（如 docker.io=http://localhost:5000）。
+    """
+
+    MANIFEST_TYPES = ', '.join([
+        'application/vnd.oci.image.index.v1+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.docker.distribution.manifest.v2+json',
+    ])
+
+    def __init__(self, overrides, ttl, concurrency, timeout):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.overrides = {}
+        for entry in filter(None, (item.strip() for item in overrides.split(','))):
+            registry, _, url = entry.partition('=')
+            self.overrides[registry.strip()] = url.strip().rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='registry')
+        self._digests = {}
+        self._tokens = {}
+        self.hits = 0
+        self.misses = 0
+
+    def base_url(self, registry):
+        if registry in self.overrides:
+            return self.overrides[registry]
+        if registry == DOCKER_HUB:
+            return 'https://registry-1.docker.io'
+        return f'https://{registry}'
+
+    def _token(self, challenge):
+        """按 WWW-Authenticate: Bearer 挑战获取匿名 token（带缓存）"""
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        if not realm:
+            raise RuntimeError(f"无法解析认证要求: {challenge}")
+        key = (realm, params.get('service'), params.get('scope'))
+        cached = self._tokens.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        response = self.session.get(realm, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        token = body.get('token') or body.get('access_token')
+        self._tokens[key] = (token, time.monotonic() + max(int(body.get('expires_in', 60)) - 10, 10))
+        return token
+
+    def _head_manifest(self, registry, repository, reference):
+        url = f"{self.base_url(registry)}/v2/{repository}/manifests/{reference}"
+        headers = {'Accept': self.MANIFEST_TYPES}
+        response = self.session.head(url, headers=headers, timeout=self.timeout)
+        challenge = response.headers.get('WWW-Authenticate', '')
+        if response.status_code == 401 and challenge.lower().startswith('bearer'):
+            headers['Authorization'] = f"Bearer {self._token(challenge)}"
+            response = self.session.head(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 404:
+            raise RuntimeError('仓库中不存在该 tag')
+        response.raise_for_status()
+        digest = response.headers.get('Docker-Content-Digest')
+        if not digest:
+            raise RuntimeError('仓库未返回 Docker-Content-Digest')
+        return digest
+
+    async def digest(self, ref):
+        """返回镜像引用在仓库中的当前摘要"""
+        registry, repository, reference = parse_image_ref(ref)
+        key = (registry, repository, reference)
+        cached = self._digests.get(key)
+        if cached and cached[1] > time.monotonic():
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(self._executor, self._head_manifest, registry, repository, reference)
+        self._digests[key] = (digest, time.monotonic() + self.ttl)
+        return digest
+
+registry_client = RegistryClient(REGISTRY_OVERRIDES, REGISTRY_CACHE_TTL, REGISTRY_CONCURRENCY, REGISTRY_TIMEOUT)
+
+def local_digests(image, ref):
+    """本地镜像 RepoDigests 中属于同一仓库的摘要"""
+    registry, repository, _ = parse_image_ref(ref)
+    digests = set()
+    for entry in image.digests if image else []:
+        name, _, digest = entry.partition('@')
+        if parse_image_ref(name)[:2] == (registry, repository):
+            digests.add(digest)
+    return digests
+
+async def check_image_updates(snapshot):
+    """检查运行中容器使用的镜像在仓库中是否有更新，不拉取任何镜像"""
+    groups = OrderedDict()
+    for container in snapshot.container_list(running_only=True):
+        ref = container.image_ref
+        if not ref or ref.startswith('sha256:'):
+            # 创建时使用的 tag 已被移走，退回到镜像当前的标签
+            image = snapshot.images.get(container.image_id)
+            ref = image.tags[0] if image and image.tags else ''
+        if ref:
+            groups.setdefault((ref, container.image_id), []).append(container.name)
+
+    async def check(ref, image_id, names):
+        if '@' in ref:
+            return UpdateCheck(ref, names, 'pinned')
+        digests = local_digests(snapshot.images.get(image_id), ref)
+        if not digests:
+            return UpdateCheck(ref, names, 'local')
+        try:
+            remote = await registry_client.digest(ref)
+        except Exception as e:
+            return UpdateCheck(ref, names, 'error', error=str(e)[:200])
+        status = 'current' if remote in digests else 'stale'
+        return UpdateCheck(ref, names, status, local_digest=sorted(digests)[0], remote_digest=remote)
+
+    return await asyncio.gather(*(check(ref, image_id, names) for (ref, image_id), names in groups.items()))
+
+UPDATE_CHECK_LABELS = {
+    'stale': '🆕 有更新',
+    'error': '⚠️ 检查失败',
+    'local': '🏠 本地构建（无仓库摘要）',
+    'pinned': '📌 已固定摘要',
+}
+
+ALERT_KINDS = {
+    'died': '🔴 容器异常退出',
+    'oom': '💥 容器内存溢出',
+    'restart_loop': '🔁 容器反复重启',
+    'unhealthy': '🩺 健康检查失败',
+    'disk': '💾 磁盘空间不足',
+    'host_down': '🖥️ 主机不可达',
+}
+
+@dataclass
+class Alert:
+    kind: str
+    key: str
+    subject: str
+    detail: str = ''
+
+class AlertEngine:
+    """根据 Docker 事件和定期指标推送告警
+
+    同一个 key 在冷却期内只告警一次；告警先在 coalesce_window 秒内聚合，
+    再按类型合并成一条消息发送，避免守护进程重启时大量容器同时退出刷屏。
+    """
+
+    # 手动 stop/kill 后紧随的 die 不视为异常
+    MANUAL_STOP_GRACE = 30
+
+    def __init__(self, chat_id, coalesce_window, cooldown, restart_count, restart_window,
+                 disk_percent, disk_path, ignore):
+        self.chat_id = chat_id
+        self.coalesce_window = coalesce_window
+        self.cooldown = cooldown
+        self.restart_count = restart_count
+        self.restart_window = restart_window
+        self.disk_percent = disk_percent
+        self.disk_path = disk_path
+        self.ignore = [pattern for pattern in ignore.split(',') if pattern]
+        self.bot = None
+        self.suppressed = 0
+        self.sent = 0
+        self._pending = []
+        self._last_sent = {}
+        self._stopped_at = {}
+        self._crashed_at = {}
+        self._starts = {}
+        self._flush_handle = None
+
+    def _ignored(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.ignore)
+
+    def handle_events(self, events):
+        """清单事件监听器"""
+        for event in events:
+            if event.get('Type') != 'container':
+                continue
+            action = event.get('Action') or ''
+            attributes = (event.get('Actor') or {}).get('Attributes') or {}
+            name = attributes.get('name') or ((event.get('Actor') or {}).get('ID') or '')[:12]
+            if self._ignored(name):
+                continue
+            ts = event.get('time') or time.time()
+
+            if action in ('kill', 'stop'):
+                self._stopped_at[name] = ts
+            elif action == 'die':
+                exit_code = attributes.get('exitCode', '0')
+                manual = ts - self._stopped_at.get(name, 0) < self.MANUAL_STOP_GRACE
+                if exit_code != '0' and not manual:
+                    self._crashed_at[name] = ts
+                    self.add(Alert('died', f'died:{name}', name, f'退出码 {exit_code}'))
+            elif action == 'oom':
+                self.add(Alert('oom', f'oom:{name}', name))
+            elif action.startswith('health_status') and action.endswith('unhealthy'):
+                self.add(Alert('unhealthy', f'unhealthy:{name}', name))
+            elif action == 'start':
+                # docker restart 会同时发出 start 和 restart，只数 start；
+                # 只有非零退出（且不是手动或机器人停止）之后的启动才算崩溃重启
+                if self._crashed_at.pop(name, None) is None:
+                    continue
+                starts = self._starts.setdefault(name, deque(maxlen=self.restart_count))
+                starts.append(ts)
+                if len(starts) == self.restart_count and ts - starts[0] <= self.restart_window:
+                    self.add(Alert(
+                        'restart_loop', f'restart_loop:{name}', name,
+                        f'{format_duration(ts - starts[0])} 内启动 {self.restart_count} 次'
+                    ))
+
+    def check_disk(self):
+        """检查磁盘使用率，超过阈值时告警；返回当前使用率"""
+        usage = shutil.disk_usage(self.disk_path)
+        percent = usage.used / usage.total * 100 if usage.total else 0
+        if percent >= self.disk_percent:
+            self.add(Alert(
+                'disk', f'disk:{self.disk_path}', self.disk_path,
+                f'已用 {percent:.1f}%（剩余 {format_bytes(usage.free)}）'
+            ))
+        return percent
+
+    def add(self, alert):
+        now = time.monotonic()
+        if now - self._last_sent.get(alert.key, -self.cooldown) < self.cooldown:
+            self.suppressed += 1
+            return
+        self._last_sent[alert.key] = now
+        self._pending.append(alert)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.coalesce_window, lambda: asyncio.ensure_future(self.flush()))
+
+    def render(self, alerts):
+        lines = [f"🚨 **告警（{len(alerts)} 条）**", ""]
+        for kind, label in ALERT_KINDS.items():
+            group = [alert for alert in alerts if alert.kind == kind]
+            if not group:
+                continue
+            lines.append(f"{label}（{len(group)}）：")
+            for alert in group[:20]:
+                lines.append(f"• {alert.subject}" + (f" - {alert.detail}" if alert.detail else ""))
+            if len(group) > 20:
+                lines.append(f"• ... 另有 {len(group) - 20} 个")
+            lines.append("")
+        return "\n".join(lines).strip()
+
+    async def flush(self):
+        self._flush_handle = None
+        alerts, self._pending = self._pending, []
+        if not alerts or self.bot is None:
+            return
+        text = self.render(alerts)[:4000]
+        for attempt in range(2):
+            try:
+                await self.bot.send_message(chat_id=self.chat_id, text=text)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"发送告警失败: {e}")
+                return
+
+alert_engine = AlertEngine(
+    ALLOWED_CHAT_ID, ALERT_COALESCE_WINDOW, ALERT_COOLDOWN, ALERT_RESTART_COUNT,
+    ALERT_RESTART_WINDOW, ALERT_DISK_PERCENT, ALERT_DISK_PATH, ALERT_IGNORE
+)
+
+@dataclass
+class ScheduledTask:
+    """可由 JobQueue 定时执行的维护任务"""
+    name: str
+    description: str
+    func: object
+    spec: str = ''
+    job: object = None
+    running: bool = False
+    paused: bool = False
+    last_run: float = None
+    last_status: str = None
+    last_duration: float = None
+    last_message: str = ''
+
+class Scheduler:
+    """基于 application.job_queue 的定时维护任务
+
+    SCHEDULED_JOBS 格式：名称=every:30m 或 名称=daily:04:30，多个用逗号分隔。
+    每个任务同一时间最多运行一个实例，最近运行信息保存在历史数据库中。
+    """
+
+    def __init__(self, specs, jitter, timezone_name):
+        self.specs = specs
+        self.jitter = jitter
+        self.timezone_name = timezone_name
+        self.tasks = {}
+
+    def register(self, name, description, func):
+        self.tasks[name] = ScheduledTask(name, description, func)
+
+    def _parse_specs(self):
+        for entry in filter(None, (part.strip() for part in self.specs.split(','))):
+            name, _, spec = entry.partition('=')
+            if name not in self.tasks or ':' not in spec:
+                logger.warning(f"忽略无法识别的定时任务配置: {entry}")
+                continue
+            yield self.tasks[name], spec
+
+    async def start(self, application):
+        job_queue = application.job_queue
+        if job_queue is None:
+            logger.warning("JobQueue 不可用，定时任务已禁用")
+            return
+        for name, (last_run, status, duration, message) in (await history.load_job_states()).items():
+            if name in self.tasks:
+                task = self.tasks[name]
+                task.last_run, task.last_status, task.last_duration, task.last_message = last_run, status, duration, message
+
+        tz = pytz.timezone(self.timezone_name)
+        # 由 APScheduler 负责抖动；同一任务不并发、错过的多次触发合并为一次
+        job_kwargs = {'jitter': int(self.jitter) or None, 'max_instances': 1, 'coalesce': True}
+        for task, spec in self._parse_specs():
+            kind, _, value = spec.partition(':')
+            try:
+                if kind == 'every':
+                    interval = parse_duration(value)
+                    task.job = job_queue.run_repeating(
+                        self._callback, interval=interval, first=interval, name=task.name, job_kwargs=job_kwargs
+                    )
+                elif kind == 'daily':
+                    hour, minute = (int(part) for part in value.split(':'))
+                    task.job = job_queue.run_daily(
+                        self._callback, dtime(hour, minute, tzinfo=tz), name=task.name, job_kwargs=job_kwargs
+                    )
+                else:
+                    raise ValueError(kind)
+                task.spec = spec
+                logger.info(f"已计划定时任务 {task.name}: {spec}")
+            except ValueError:
+                logger.warning(f"定时任务 {task.name} 的计划无效: {spec}")
+
+    async def _callback(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.run(context.job.name)
+
+    async def run(self, name):
+        """执行一次任务；已在运行时跳过并返回 None"""
+        task = self.tasks[name]
+        if task.running:
+            logger.info(f"定时任务 {name} 仍在运行，跳过本次触发")
+            return None
+        task.running = True
+        job = job_tracker.create(name, task.description)
+        try:
+            message = await task.func()
+            job_tracker.finish(job, 'succeeded')
+        except Exception as e:
+            logger.error(f"定时任务 {name} 执行失败: {e}")
+            message = str(e)
+            job_tracker.finish(job, 'failed', error=message)
+        finally:
+            task.running = False
+        task.last_run = job.started_at
+        task.last_status = job.status
+        task.last_duration = job.duration
+        task.last_message = message or ''
+        await history.save_job_state(task)
+        await history.record_run(job, task.last_message)
+        return job
+
+async def scheduled_cleanup():
+    """清理悬空镜像和未使用的网络（不删除已停止的容器）"""
+    async def work():
+        before = await try_disk_usage()
+        result = await execute_cleanup(plan_cleanup(await inventory.snapshot(), containers=False, usage=before))
+        after = await try_disk_usage()
+        if before and after:
+            result.measured = max(before.layers_size - after.layers_size, 0)
+        return result
+    result, _ = await operation_locks.run('cleanup:scheduled', ('cleanup',), '定时清理', work)
+    return (
+        f"删除 {result.count('image')} 个镜像、{result.count('network')} 个网络，"
+        f"释放 {format_bytes(result.freed)}，失败 {len(result.failures)} 个"
+    )
+
+async def scheduled_disk_check():
+    usage = await disk_usage()
+    message = f"镜像层 {format_bytes(usage.layers_size)}，确定可回收 {format_bytes(usage.total_reclaimable)}"
+    if ALERTS_ENABLED:
+        percent = alert_engine.check_disk()
+        message += f"，磁盘已用 {percent:.1f}%"
+    return message
+
+async def scheduled_resync():
+    await inventory.resync()
+    return f"第 {inventory.generation} 代，{len(inventory.containers)} 个容器"
+
+async def scheduled_compact():
+    events, runs = await history.compact()
+    return f"删除 {events} 条事件、{runs} 条任务记录"
+
+async def scheduled_host_check():
+    hosts = await host_registry.check_all()
+    down = [host for host in hosts if not host.healthy]
+    if ALERTS_ENABLED:
+        for host in down:
+            alert_engine.add(Alert('host_down', f'host_down:{host.name}', host.name, host.error[:200]))
+    return f"{len(hosts) - len(down)}/{len(hosts)} 台主机正常"
+
+scheduler = Scheduler(SCHEDULED_JOBS, SCHEDULE_JITTER, BOT_TIMEZONE)
+scheduler.register('cleanup', '定时清理', scheduled_cleanup)
+scheduler.register('diskcheck', '磁盘占用检查', scheduled_disk_check)
+scheduler.register('resync', '清单重新同步', scheduled_resync)
+scheduler.register('hostcheck', '主机连通性检查', scheduled_host_check)
+scheduler.register('compact', '历史数据压缩', scheduled_compact)
+
+def format_cleanup_failures(result, limit=5):
+    """格式化失败条目（最多 limit 条）"""
+    failures = result.failures
+    if not failures:
+        return ""
+    lines = [f"\n⚠️ 删除失败：**{len(failures)}** 个"]
+    for item in failures[:limit]:
+        lines.append(f"• {item.name}: {item.error[:100]}")
+    if len(failures) > limit:
+        lines.append(f"• ... 另有 {len(failures) - limit} 个")
+    return "\n".join(lines)
 
 def auth_required(func):
     """认证装饰器"""
@@ -62,23 +3366,35 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🤖 **Watchtower 管理机器人 - 帮助手册**
 
 📊 **状态命令：**
-🔍 `/status` - 查看运行中容器状态
-📋 `/allcontainers` - 查看所有容器状态  
+🔍 `/status [@主机|@all]` - 查看运行中容器状态
+📋 `/allcontainers [条件...]` - 查看所有容器（如 status=exited sort=name）
+📈 `/stats [cpu|mem] [数量] [容器名]` - 查看资源占用排行
 ⚡ `/runonce` - 立即执行更新检查
-🔄 `/restart <容器名>` - 重启指定容器
-📜 `/logs` - 查看 Watchtower 日志
-⏰ `/schedule` - 查看定时任务设置
+🔍 `/checkupdates` - 查看哪些容器的镜像有更新（不拉取）
+⬆️ `/update [--rolling] <容器名...>` - 只更新指定容器（滚动模式带健康检查和回滚）
+📋 `/jobs [run|pause|resume <名称>]` - 查看和控制后台/定时任务
+🕘 `/history [容器名|runs] [--since 24h]` - 查询事件和更新历史
+🔄 `/restart <容器名...>` - 重启容器（支持通配符/标签/项目）
+📦 `/bulk <start|stop|restart|update> <选择器...>` - 批量操作容器
+📜 `/logs [容器名]` - 分页查看日志（默认 Watchtower）
+📡 `/follow <容器名>` - 实时跟踪容器日志
+⏹️ `/unfollow [容器名]` - 停止实时跟踪
+⏰ `/schedule [次数]` - 查看定时设置和接下来的执行时间
 
 🧹 **清理命令：**
 🔎 `/cleanup` - 扫描未使用的资源
-🗑️ `/cleanupimages` - 清理未使用的镜像
+🗑️ `/cleanupimages [all]` - 清理悬空镜像（all 含未使用的带标签镜像）
 🚮 `/cleanupcontainers` - 清理已停止的容器
 💥 `/cleanupall` - 全面清理所有资源
 ⚠️ `/cleanupforce` - 强制清理（包括构建缓存）
 
 ⚙️ **管理命令：**
-📦 `/containers` - 容器管理菜单
-🖼️ `/images` - 查看镜像列表
+📦 `/containers [关键字]` - 容器管理菜单（分页，可搜索）
+🖼️ `/images [条件...]` - 查看镜像（如 dangling=true size>500MB sort=size）
+🖥️ `/hosts` - 检查所有 Docker 主机连通性
+🧵 `/pool` - 查看 Docker 调用池状态
+📈 `/botstats` - 查看机器人自身的耗时和错误统计
+🔄 `/resync` - 强制刷新容器清单缓存
 
 ❓ **帮助命令：**
 ℹ️ `/help` - 显示此帮助信息
@@ -122,228 +3438,528 @@ async def quick_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(quick_help_text)
 
 @auth_required
-async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看运行中容器状态"""
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看运行中容器状态（支持 @主机 / @all）"""
+    try:
+        try:
+            hosts, _ = host_registry.resolve(context.args or [])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        results = await host_registry.collect(hosts, lambda host: host_containers(host, all=False))
+        multi = hosts != [host_registry.primary]
+        
+        records = []
+        for host, containers, error in results:
+            if multi:
+                records.append(format_host_heading(host, len(containers or []), error))
+            for container in containers or []:
+                status = "🟢 运行中" if container.status == "running" else "🟡 其他状态"
+                records.append("\n".join([
+                    f"📦 {container.name}",
+                    f"   📊 状态：{status}",
+                    f"   🖼️ 镜像：{container.image}",
+                    f"   🕐 创建时间：{container.created}",
+                ]))
+        if not records:
+            await update.message.reply_text("🔍 没有运行中的容器")
+            return
+        
+        await reply_chunked(update.message, "🟢 运行中容器状态：", records)
+    except Exception as e:
+        logger.error(f"获取容器状态错误: {e}")
+        await update.message.reply_text("❌ 获取容器状态时出错")
+
+@auth_required
+async def all_containers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看所有容器状态（支持过滤、排序和 @主机 / @all）"""
+    try:
+        try:
+            hosts, args = host_registry.resolve(context.args or [])
+            query = parse_container_query(args)
+            results = await host_registry.collect(hosts, lambda host: query_containers(query, host))
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ {e}\n\n"
+                f"💡 示例：`/allcontainers status=exited label=com.docker.compose.project=web sort=created`"
+            )
+            return
+        multi = hosts != [host_registry.primary]
+        containers = [container for _, found, _ in results for container in found or []]
+        if not containers and not multi:
+            await update.message.reply_text("🔍 没有找到符合条件的容器" if query else "🔍 没有找到任何容器")
+            return
+        
+        running_count = sum(1 for c in containers if c.status == "running")
+        stopped_count = len(containers) - running_count
+        
+        header = (
+            f"📊 所有容器状态（总计 {len(containers)} 个）\n"
+            f"🟢 运行中：{running_count} 个\n"
+            f"🔴 已停止：{stopped_count} 个"
+        )
+        if query:
+            header += f"\n🔎 条件：{query.describe()}"
+        records = []
+        for host, found, error in results:
+            if multi:
+                records.append(format_host_heading(host, len(found or []), error))
+            for container in found or []:
+                status_icon = "🟢" if container.status == "running" else "🔴"
+                records.append("\n".join([
+                    f"{status_icon} {container.name}",
+                    f"   📊 状态：{container.status}",
+                    f"   🖼️ 镜像：{container.image}",
+                ]))
+        
+        await reply_chunked(update.message, header, records)
+    except Exception as e:
+        logger.error(f"获取所有容器错误: {e}")
+        await update.message.reply_text("❌ 获取容器列表时出错")
+
+async def start_watchtower_job(update, context, cmd, description):
+    """在 watchtower 容器中以后台任务执行一次性命令
+
+    同一时间只允许一个；相同命令的重复请求不再执行，只在结束时收到同一结果。
+    """
+    name = f"runonce:{cmd}"
+    op = operation_locks.attach(name)
+    if op is not None:
+        message = await update.message.reply_text(
+            f"♻️ 相同的{description}正在运行，已运行 {format_duration(op.duration)}，未重复执行\n"
+            f"完成后将在此更新结果"
+        )
+        asyncio.create_task(report_attached_job(op, context.bot, message.chat_id, message.message_id))
+        return
+    
+    running = job_tracker.running('runonce')
+    if running:
+        await update.message.reply_text(
+            f"⏳ 已有{running.description}正在运行 (#{running.id})，已运行 {format_duration(running.duration)}\n"
+            f"使用 📋 `/jobs` 查看任务状态"
+        )
+        return
+    
+    job = job_tracker.create('runonce', description)
+    try:
+        # 确认 watchtower 容器存在
+        await run_docker(docker_client.api.inspect_container, 'watchtower')
+        
+        message = await update.message.reply_text(f"🔄 开始执行{description}... (#{job.id})")
+        op, _ = operation_locks.start(
+            name, ('runonce',), description,
+            lambda: run_exec_job(job, 'watchtower', cmd, context.bot, message.chat_id, message.message_id)
+        )
+        job.task = op.task
+    except docker.errors.NotFound:
+        job_tracker.finish(job, 'failed', error='未找到 watchtower 容器')
+        await update.message.reply_text("❌ 未找到 watchtower 容器")
+    except Exception as e:
+        logger.error(f"执行{description}错误: {e}")
+        if job.status == 'running' and job.task is None:
+            job_tracker.finish(job, 'failed', error=str(e))
+        await update.message.reply_text(f"❌ 执行{description}时出错")
+
+@auth_required
+async def run_once(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """立即执行更新检查（后台任务）"""
+    await start_watchtower_job(update, context, RUNONCE_COMMAND, '更新检查')
+
+@auth_required
+async def update_containers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """只更新指定容器：交给 watchtower 或直接滚动重建"""
+    args = list(context.args or [])
+    rolling = UPDATE_MODE == 'rolling'
+    if '--rolling' in args:
+        args.remove('--rolling')
+        rolling = True
+    if not args:
+        await update.message.reply_text(
+            "❌ 用法: ⬆️ `/update [--rolling] <选择器...>`\n"
+            "选择器：容器名、通配符 `web-*`、`label=键=值`、`project=项目名`"
+        )
+        return
+    
     try:
-        containers = docker_client.containers.list()
-        if not containers:
-            await update.message.reply_text("🔍 没有运行中的容器")
+        if rolling:
+            await run_bulk_command(update, context, 'update', args)
             return
         
-        message = "🟢 **运行中容器状态：**\n\n"
-        for container in containers:
-            status = "🟢 运行中" if container.status == "running" else "🟡 其他状态"
-            message += f"📦 **{container.name}**\n"
-            message += f"   📊 状态：{status}\n"
-            message += f"   🖼️ 镜像：{container.image.tags[0] if container.image.tags else 'N/A'}\n"
-            message += f"   🕐 创建时间：{container.attrs['Created'][:19]}\n\n"
-        
-        await update.message.reply_text(message)
+        containers, unmatched = select_containers(await inventory.snapshot(), args)
+        if unmatched:
+            await update.message.reply_text(f"❌ 未找到匹配的容器: **{', '.join(unmatched)}**")
+        if not containers:
+            return
+        names = ' '.join(shlex.quote(c.name) for c in containers)
+        await start_watchtower_job(update, context, f"{RUNONCE_COMMAND} {names}", f"更新 {len(containers)} 个容器")
     except Exception as e:
-        logger.error(f"获取容器状态错误: {e}")
-        await update.message.reply_text("❌ 获取容器状态时出错")
+        logger.error(f"更新容器错误: {e}")
+        await update.message.reply_text("❌ 更新容器时出错")
 
 @auth_required
-async def all_containers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看所有容器状态"""
-    try:
-        containers = docker_client.containers.list(all=True)
-        if not containers:
-            await update.message.reply_text("🔍 没有找到任何容器")
+async def jobs_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看后台任务和定时任务，支持 run/pause/resume 控制"""
+    if len(context.args) == 2 and context.args[0] in ('run', 'pause', 'resume'):
+        await control_scheduled_job(update, context.args[0], context.args[1])
+        return
+    
+    message = ""
+    scheduled = [task for task in scheduler.tasks.values() if task.job is not None]
+    if scheduled:
+        message += "⏰ **定时任务：**\n\n"
+        for task in scheduled:
+            state = '🟢 运行中' if task.running else ('⏸️ 已暂停' if task.paused else '🕐 等待')
+            message += f"**{task.name}** {task.description} ({task.spec}) {state}\n"
+            if not task.paused and task.job.next_t:
+                message += f"   ⏭️ 下次：{task.job.next_t.astimezone(pytz.timezone(BOT_TIMEZONE)).strftime('%m-%d %H:%M')}\n"
+            if task.last_run:
+                last = datetime.fromtimestamp(task.last_run).strftime('%m-%d %H:%M')
+                message += (
+                    f"   {JOB_STATUS_LABELS.get(task.last_status, task.last_status)} 上次：{last}"
+                    f"  ⏱️ {format_duration(task.last_duration or 0)}\n"
+                )
+                if task.last_message:
+                    message += f"   📝 {task.last_message[:120]}\n"
+        message += "\n💡 `/jobs run|pause|resume <名称>`\n\n"
+    
+    if operation_locks.operations:
+        message += "🔒 **进行中的操作：**\n\n"
+        for op in operation_locks.operations.values():
+            message += f"• {op.description}  ⏱️ {format_duration(op.duration)}"
+            if op.attached:
+                message += f"  ♻️ 重复请求 {op.attached} 次"
+            message += "\n"
+        message += "\n"
+    
+    if not job_tracker.jobs:
+        await update.message.reply_text(message + "📋 暂无后台任务记录")
+        return
+    
+    message += "📋 **后台任务：**\n\n"
+    for job in reversed(job_tracker.jobs):
+        started = datetime.fromtimestamp(job.started_at).strftime('%m-%d %H:%M:%S')
+        message += f"#{job.id} {job.description} {JOB_STATUS_LABELS[job.status]}\n"
+        message += f"   🕐 开始：{started}  ⏱️ {format_duration(job.duration)}\n"
+        if job.error:
+            message += f"   ⚠️ {job.error[:100]}\n"
+        message += "\n"
+    await update.message.reply_text(message)
+
+async def control_scheduled_job(update, action, name):
+    """手动执行、暂停或恢复定时任务"""
+    task = scheduler.tasks.get(name)
+    if task is None:
+        await update.message.reply_text(f"❌ 未知的定时任务: **{name}**\n可用：{', '.join(scheduler.tasks)}")
+        return
+    
+    if action == 'run':
+        if task.running:
+            await update.message.reply_text(f"⏳ 定时任务 **{name}** 正在运行中")
             return
-        
-        running_count = sum(1 for c in containers if c.status == "running")
-        stopped_count = len(containers) - running_count
-        
-        message = f"📊 **所有容器状态（总计 {len(containers)} 个）**\n"
-        message += f"🟢 运行中：{running_count} 个\n"
-        message += f"🔴 已停止：{stopped_count} 个\n\n"
-        
-        for container in containers:
-            status_icon = "🟢" if container.status == "running" else "🔴"
-            message += f"{status_icon} **{container.name}**\n"
-            message += f"   📊 状态：{container.status}\n"
-            message += f"   🖼️ 镜像：{container.image.tags[0] if container.image.tags else 'N/A'}\n\n"
-        
-        await update.message.reply_text(message)
-    except Exception as e:
-        logger.error(f"获取所有容器错误: {e}")
-        await update.message.reply_text("❌ 获取容器列表时出错")
+        await update.message.reply_text(f"▶️ 开始执行定时任务 **{name}**...")
+        job = await scheduler.run(name)
+        status = JOB_STATUS_LABELS[job.status] if job else '⏭️ 已跳过'
+        await update.message.reply_text(
+            f"{status} **{name}** ⏱️ {format_duration(job.duration) if job else '-'}\n📝 {task.last_message}"
+        )
+    elif task.job is None:
+        await update.message.reply_text(f"❌ 定时任务 **{name}** 未在 SCHEDULED_JOBS 中计划")
+    else:
+        # Job.enabled 的初始值不反映真实状态，暂停状态自行记录
+        task.paused = action == 'pause'
+        task.job.enabled = not task.paused
+        await update.message.reply_text(f"{'⏸️ 已暂停' if task.paused else '▶️ 已恢复'}定时任务 **{name}**")
 
 @auth_required
-async def run_once(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """立即执行更新检查"""
+async def restart_container(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """重启指定容器（支持多个名称、通配符、标签和 compose 项目）"""
+    if not context.args:
+        await update.message.reply_text(
+            "❌ 请指定要重启的容器名\n用法: 🔄 `/restart <容器名...>`\n"
+            "也可使用 `web-*`、`label=键=值`、`project=项目名`"
+        )
+        return
+    
     try:
-        await update.message.reply_text("🔄 开始执行更新检查...")
-        
-        # 获取 watchtower 容器
-        watchtower_container = docker_client.containers.get('watchtower')
-        
-        # 执行更新检查
-        exec_result = watchtower_container.exec_run(
-            cmd='/watchtower --run-once --cleanup',
-            detach=False
+        await run_bulk_command(update, context, 'restart', context.args)
+    except Exception as e:
+        logger.error(f"重启容器错误: {e}")
+        await update.message.reply_text("❌ 重启容器时出错")
+
+@auth_required
+async def bulk_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """批量启动/停止/重启容器"""
+    if len(context.args) < 2 or context.args[0] not in BULK_ACTIONS:
+        await update.message.reply_text(
+            "❌ 用法: 📦 `/bulk <start|stop|restart|update> <选择器...>`\n"
+            "选择器：容器名、通配符 `web-*`、`label=键=值`、`project=项目名`"
         )
-        
-        if exec_result.exit_code == 0:
-            await update.message.reply_text("✅ 更新检查已完成")
-        else:
-            await update.message.reply_text(f"⚠️ 更新检查完成，但有警告或错误:\n{exec_result.output.decode()}")
-            
+        return
+    
+    action = context.args[0]
+    try:
+        await run_bulk_command(update, context, action, context.args[1:])
+    except Exception as e:
+        logger.error(f"批量{BULK_ACTIONS[action][1]}容器错误: {e}")
+        await update.message.reply_text(f"❌ 批量{BULK_ACTIONS[action][1]}容器时出错")
+
+@auth_required
+async def watchtower_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看 Watchtower 日志（可指定其他容器）"""
+    container_name = context.args[0] if context.args else 'watchtower'
+    try:
+        page, note = await load_log_page(container_name)
+        message, reply_markup = format_log_page(container_name, page, note)
+        await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
     except docker.errors.NotFound:
-        await update.message.reply_text("❌ 未找到 watchtower 容器")
+        await update.message.reply_text(f"❌ 未找到 {container_name} 容器")
     except Exception as e:
-        logger.error(f"执行更新检查错误: {e}")
-        await update.message.reply_text("❌ 执行更新检查时出错")
+        logger.error(f"获取日志错误: {e}")
+        await update.message.reply_text("❌ 获取日志时出错")
 
 @auth_required
-async def restart_container(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """重启指定容器"""
+async def follow_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """实时跟踪容器日志"""
     if not context.args:
-        await update.message.reply_text("❌ 请指定要重启的容器名\n用法: 🔄 `/restart <容器名>`")
+        await update.message.reply_text("❌ 请指定要跟踪的容器名\n用法: 📡 `/follow <容器名>`")
         return
     
     container_name = context.args[0]
+    if container_name in follow_manager.followers:
+        await update.message.reply_text(f"ℹ️ 已在跟踪容器 **{container_name}** 的日志")
+        return
+    if len(follow_manager.followers) >= follow_manager.max_follows:
+        await update.message.reply_text(
+            f"❌ 最多同时跟踪 {follow_manager.max_follows} 个容器\n"
+            f"正在跟踪：{', '.join(follow_manager.followers)}\n"
+            f"使用 ⏹️ `/unfollow <容器名>` 停止跟踪"
+        )
+        return
+    
     try:
-        container = docker_client.containers.get(container_name)
-        await update.message.reply_text(f"🔄 正在重启容器: **{container_name}**")
-        container.restart()
-        await update.message.reply_text(f"✅ 容器 **{container_name}** 重启完成")
+        await run_docker(docker_client.api.inspect_container, container_name)
+        message = await update.message.reply_text(f"📡 **实时日志: {container_name}**\n⏳ 等待新日志...")
+        await follow_manager.start(container_name, context.bot, message.chat_id, message.message_id)
     except docker.errors.NotFound:
         await update.message.reply_text(f"❌ 未找到容器: **{container_name}**")
     except Exception as e:
-        logger.error(f"重启容器错误: {e}")
-        await update.message.reply_text(f"❌ 重启容器 **{container_name}** 时出错")
+        logger.error(f"跟踪日志错误: {e}")
+        await update.message.reply_text("❌ 跟踪日志时出错")
 
 @auth_required
-async def watchtower_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看 Watchtower 日志"""
+async def unfollow_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """停止实时跟踪日志"""
+    if not follow_manager.followers:
+        await update.message.reply_text("ℹ️ 当前没有正在跟踪的日志")
+        return
+    
+    if context.args:
+        container_name = context.args[0]
+        if await follow_manager.stop(container_name):
+            await update.message.reply_text(f"⏹️ 已停止跟踪 **{container_name}**")
+        else:
+            await update.message.reply_text(f"❌ 没有在跟踪容器: **{container_name}**")
+    else:
+        count = len(follow_manager.followers)
+        await follow_manager.stop_all()
+        await update.message.reply_text(f"⏹️ 已停止全部 {count} 个日志跟踪")
+
+@auth_required
+async def container_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看容器资源占用"""
+    if not STATS_ENABLED:
+        await update.message.reply_text("❌ 资源采样未启用（STATS_ENABLED=false）")
+        return
+    
     try:
-        watchtower_container = docker_client.containers.get('watchtower')
-        logs = watchtower_container.logs(tail=50, timestamps=True).decode('utf-8')
+        entries = stats_sampler.current()
+        if not entries:
+            await update.message.reply_text("⏳ 暂无采样数据，请稍后再试")
+            return
         
-        if len(logs) > 4000:
-            logs = logs[-4000:]  # Telegram 消息长度限制
+        args = list(context.args)
+        sort_key = 'cpu'
+        limit = 10
+        names = []
+        for arg in args:
+            if arg in ('cpu', 'mem'):
+                sort_key = arg
+            elif arg.isdigit():
+                limit = int(arg)
+            else:
+                names.append(arg)
         
-        message = f"📋 **Watchtower 最近日志:**\n```\n{logs}\n```"
-        await update.message.reply_text(message, parse_mode='Markdown')
-    except docker.errors.NotFound:
-        await update.message.reply_text("❌ 未找到 watchtower 容器")
+        if names:
+            entries = [e for e in entries if any(fnmatch.fnmatchcase(e['name'], n) for n in names)]
+            if not entries:
+                await update.message.reply_text(f"❌ 没有容器 **{', '.join(names)}** 的采样数据")
+                return
+        
+        entries.sort(key=lambda e: e[sort_key], reverse=True)
+        total_cpu = sum(e['cpu'] for e in entries)
+        total_mem = sum(e['mem'] for e in entries)
+        sort_label = 'CPU' if sort_key == 'cpu' else '内存'
+        
+        message = f"📈 **资源占用（按{sort_label}排序，前 {min(limit, len(entries))} 个）**\n"
+        message += f"🧮 总 CPU：{total_cpu:.1f}%   🧠 总内存：{format_bytes(total_mem)}\n\n"
+        for entry in entries[:limit]:
+            message += format_container_stats(entry) + "\n"
+        await update.message.reply_text(message)
     except Exception as e:
-        logger.error(f"获取日志错误: {e}")
-        await update.message.reply_text("❌ 获取日志时出错")
+        logger.error(f"获取资源占用错误: {e}")
+        await update.message.reply_text("❌ 获取资源占用时出错")
+
+HISTORY_ACTION_ICONS = {
+    'create': '🆕', 'start': '🟢', 'restart': '🔄', 'stop': '⏹️', 'die': '🔴', 'kill': '💀',
+    'oom': '💥', 'destroy': '🗑️', 'pause': '⏸️', 'unpause': '▶️', 'health_status': '🩺',
+    'pull': '⬇️', 'tag': '🏷️', 'untag': '🏷️', 'delete': '🗑️',
+}
+
+@auth_required
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查询容器事件和更新记录历史"""
+    if not history.enabled:
+        await update.message.reply_text("❌ 历史记录未启用（HISTORY_DB_PATH 为空或数据库无法打开）")
+        return
+    
+    args = list(context.args)
+    since = None
+    container = None
+    show_runs = False
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == '--since' and args:
+                since = time.time() - parse_duration(args.pop(0))
+            elif arg == 'runs':
+                show_runs = True
+            else:
+                container = arg
+    except ValueError:
+        await update.message.reply_text("❌ 用法: 🕘 `/history [容器名|runs] [--since 24h]`")
+        return
+    
+    try:
+        if show_runs:
+            rows = await history.query_runs(since=since, limit=15)
+            if not rows:
+                await update.message.reply_text("🕘 暂无更新记录")
+                return
+            records = []
+            for started, duration, status, exit_code, summary, name in rows:
+                when = datetime.fromtimestamp(started).strftime('%m-%d %H:%M:%S')
+                record = f"{JOB_STATUS_LABELS.get(status, status)} {name} {when}  ⏱️ {format_duration(duration or 0)}"
+                if summary:
+                    record += f"\n   📝 {summary[:200]}"
+                records.append(record)
+            await reply_chunked(update.message, "🕘 最近的任务记录：", records, separator="\n")
+            return
+        
+        rows = await history.query_events(container=container, since=since, limit=30)
+        if not rows:
+            await update.message.reply_text("🕘 没有符合条件的事件记录")
+            return
+        title = f"{container} 的事件" if container else "最近事件"
+        records = []
+        for ts, kind, action, name, image, detail in rows:
+            when = datetime.fromtimestamp(ts).strftime('%m-%d %H:%M:%S')
+            icon = HISTORY_ACTION_ICONS.get(action, '•')
+            line = f"{when} {icon} {action}"
+            if not container and name:
+                line += f" {name}"
+            if kind == 'image' and image:
+                line += f" {image}"
+            if detail:
+                line += f" ({detail})"
+            records.append(line)
+        await reply_chunked(update.message, f"🕘 {title}（{len(rows)} 条）：", records, separator="\n")
+    except Exception as e:
+        logger.error(f"查询历史记录错误: {e}")
+        await update.message.reply_text("❌ 查询历史记录时出错")
 
 @auth_required
 async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看定时任务设置"""
+    """查看 watchtower 定时设置并预测接下来的执行时间（/schedule [次数]）"""
+    try:
+        count = min(int(context.args[0]), 20) if context.args else 5
+    except ValueError:
+        await update.message.reply_text("❌ 用法: ⏰ `/schedule [次数]`")
+        return
+    
     try:
-        # 获取 watchtower 容器
-        watchtower_container = docker_client.containers.get('watchtower')
+        attrs = await run_docker(docker_client.api.inspect_container, 'watchtower')
+        try:
+            cron, source, tz = watchtower_schedule_config(attrs)
+        except (ValueError, pytz.UnknownTimeZoneError) as e:
+            await update.message.reply_text(f"❌ 无法解析 watchtower 的调度配置: {e}")
+            return
         
-        # 获取容器启动命令
-        command = watchtower_container.attrs['Config']['Cmd']
+        command = attrs['Config'].get('Cmd') or []
+        env = attrs['Config'].get('Env') or []
+        has_cleanup = '--cleanup' in command or 'WATCHTOWER_CLEANUP=true' in env
+        has_include_restarting = '--include-restarting' in command or 'WATCHTOWER_INCLUDE_RESTARTING=true' in env
+        has_notification_report = '--notification-report' in command or 'WATCHTOWER_NOTIFICATION_REPORT=true' in env
         
-        # 查找 schedule 参数
-        cron_expression = "未找到"
-        for i, cmd in enumerate(command):
-            if cmd == '--schedule' and i + 1 < len(command):
-                cron_expression = command[i + 1]
-                break
+        started_at = attrs['State'].get('StartedAt', '')[:19]
+        anchor = datetime.strptime(started_at, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc) if started_at else None
+        runs = cron.forecast(datetime.now(timezone.utc), tz, count, anchor=anchor)
         
-        # 解析 cron 表达式并生成可读的描述
-        cron_parts = cron_expression.split()
-        if len(cron_parts) == 6:
-            second, minute, hour, day, month, weekday = cron_parts
-            
-            # 生成可读的时间描述
-            time_description = ""
-            if hour == "*/6":
-                time_description = "🕕 每6小时执行一次"
-            elif hour == "*/12":
-                time_description = "🕛 每12小时执行一次"
-            elif hour == "*" and minute == "0":
-                time_description = "🕐 每小时执行一次"
-            else:
-                # 具体时间点
-                if hour == "0" or hour == "00":
-                    time_str = f"🌙 凌晨{minute}分{second}秒"
-                elif int(hour) < 12:
-                    time_str = f"☀️ 上午{hour}点{minute}分{second}秒"
-                elif hour == "12":
-                    time_str = f"🍚 中午{minute}分{second}秒"
-                else:
-                    time_str = f"🌆 下午{int(hour)-12}点{minute}分{second}秒"
-                
-                if day == "*" and month == "*" and weekday == "*":
-                    time_description = f"📅 每天 {time_str}"
-                else:
-                    time_description = f"⏰ 特定时间 {time_str}"
-        else:
-            time_description = f"⚙️ 自定义计划: {cron_expression}"
-        
-        # 检查其他配置选项
-        has_cleanup = '--cleanup' in command
-        has_include_restarting = '--include-restarting' in command
-        has_notification_report = '--notification-report' in command
-        
-        schedule_info = f"""
-⏰ **Watchtower 定时任务设置**
-
-📋 **当前配置：**
-{time_description}
-🔤 Cron表达式：`{cron_expression}`
-🧹 自动清理：{'✅ 启用' if has_cleanup else '❌ 禁用'}
-🔄 包含重启中容器：{'✅ 是' if has_include_restarting else '❌ 否'}
-📢 通知报告：{'✅ 启用' if has_notification_report else '❌ 禁用'}
-
-📅 **Cron 表达式说明：**
-格式：`秒 分 时 日 月 周`
-
-🕒 **常用示例：**
-- `0 0 2 * * *` = 🌙 每天凌晨2点
-- `0 30 3 * * *` = 🌙 每天凌晨3点30分  
-- `0 0 */6 * * *` = 🕕 每6小时执行
-- `0 0 */12 * * *` = 🕛 每12小时执行
-- `0 0 * * * *` = 🕐 每小时执行
-        """
-        await update.message.reply_text(schedule_info)
+        # 用最近几次更新检查的实际耗时估算每次执行会占用主机多久
+        durations = []
+        if history.enabled:
+            durations = [row[1] for row in await history.query_runs(name='runonce', limit=10) if row[1]]
+        estimate = sum(durations) / len(durations) if durations else None
+        
+        message = "⏰ **Watchtower 定时任务设置**\n\n"
+        message += "📋 **当前配置：**\n"
+        message += f"{cron.describe()}\n"
+        message += f"🔤 Cron表达式：`{cron.expression}`（{source}）\n"
+        message += f"🌍 时区：{tz.zone}\n"
+        message += f"🧹 自动清理：{'✅ 启用' if has_cleanup else '❌ 禁用'}\n"
+        message += f"🔄 包含重启中容器：{'✅ 是' if has_include_restarting else '❌ 否'}\n"
+        message += f"📢 通知报告：{'✅ 启用' if has_notification_report else '❌ 禁用'}\n\n"
+        
+        message += f"📅 **接下来 {len(runs)} 次执行：**\n"
+        for run in runs:
+            line = f"• {run.strftime('%m-%d %H:%M:%S')}"
+            if estimate:
+                line += f" ~ {(run + timedelta(seconds=estimate)).strftime('%H:%M:%S')}"
+            message += line + "\n"
+        if not runs:
+            message += "• 5 年内不会触发\n"
+        if estimate:
+            message += f"\n⏱️ 按最近 {len(durations)} 次平均耗时 {format_duration(estimate)} 估算"
+        
+        await update.message.reply_text(message)
         
     except docker.errors.NotFound:
         await update.message.reply_text("❌ 未找到 watchtower 容器")
     except Exception as e:
         logger.error(f"获取定时任务设置错误: {e}")
-        # 如果出错，返回默认信息
-        default_info = """
-⏰ **Watchtower 定时任务设置**
-
-📋 **当前配置：**
-📅 每天 🌆 下午9点21分6秒
-🔤 Cron表达式：`6 21 * * *`
-🧹 自动清理：✅ 启用
-🔄 包含重启中容器：✅ 是
-📢 通知报告：✅ 启用
-
-📅 **Cron 表达式说明：**
-`6 21 * * *` = 🌆 每天晚上9点21分6秒执行
-        """
-        await update.message.reply_text(default_info)
+        await update.message.reply_text("❌ 获取定时任务设置时出错")
 
 @auth_required
 async def cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """扫描未使用的资源"""
     try:
-        # 扫描未使用的镜像
-        images = docker_client.images.list()
-        unused_images = [img for img in images if len(img.tags) == 0 or '<none>' in img.tags[0]]
-        
-        # 扫描已停止的容器
-        stopped_containers = docker_client.containers.list(all=True, filters={'status': 'exited'})
+        # 一次 /system/df 调用得到全部占用和可回收空间
+        usage = await disk_usage()
         
         message = "🔍 **未使用资源扫描结果：**\n\n"
-        message += f"🖼️ 未使用的镜像：**{len(unused_images)}** 个\n"
-        message += f"📦 已停止的容器：**{len(stopped_containers)}** 个\n\n"
+        message += f"🖼️ 未使用的镜像：**{usage.dangling_count + usage.unused_tagged_count}** 个"
+        message += f"（悬空 {usage.dangling_count}，带标签 {usage.unused_tagged_count}）\n"
+        reclaim = format_bytes(usage.image_reclaimable)
+        if usage.image_reclaimable_max > usage.image_reclaimable:
+            reclaim += f" ~ {format_bytes(usage.image_reclaimable_max)}（含共享层）"
+        message += f"   💾 可回收：**{reclaim}** / 总计 {format_bytes(usage.layers_size)}\n"
+        message += f"📦 已停止的容器：**{usage.stopped_count}** 个\n"
+        message += f"   💾 可回收：**{format_bytes(usage.container_reclaimable)}**\n"
+        message += f"🗄️ 未使用的数据卷：**{usage.unused_volume_count}** 个\n"
+        message += f"   💾 可回收：**{format_bytes(usage.volume_reclaimable)}**\n"
+        message += f"🗂️ 构建缓存可回收：**{format_bytes(usage.cache_reclaimable)}**\n"
+        message += f"📊 合计确定可回收：**{format_bytes(usage.total_reclaimable)}**\n\n"
         message += "💡 **清理建议：**\n"
-        message += "🗑️ 使用 `/cleanupimages` 清理未使用的镜像\n"
+        message += "🗑️ 使用 `/cleanupimages` 清理悬空镜像，`/cleanupimages all` 包括未使用的带标签镜像\n"
         message += "🚮 使用 `/cleanupcontainers` 清理已停止的容器\n"
         message += "💥 使用 `/cleanupall` 全面清理所有资源"
         
@@ -358,31 +3974,39 @@ async def cleanup_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await update.message.reply_text("🧹 开始清理未使用的镜像...")
         
-        # 获取未使用的镜像
-        images = docker_client.images.list()
-        unused_images = [img for img in images if len(img.tags) == 0 or '<none>' in img.tags[0]]
+        # 获取未使用的镜像（all 参数包括没有容器使用的带标签镜像）
+        include_tagged = 'all' in context.args
+        
+        async def work():
+            before = await try_disk_usage()
+            stages = plan_cleanup(
+                await inventory.snapshot(), containers=False, networks=False,
+                include_tagged=include_tagged, usage=before
+            )
+            if not any(item.status == 'pending' for stage in stages for item in stage):
+                return None
+            result = await execute_cleanup(stages)
+            after = await try_disk_usage()
+            if before and after:
+                result.measured = max(before.layers_size - after.layers_size, 0)
+            return result
         
-        if not unused_images:
+        result, attached = await operation_locks.run(
+            'cleanup:images:all' if include_tagged else 'cleanup:images', ('cleanup',), '清理镜像', work,
+            on_wait=operation_waiter(update.message.reply_text)
+        )
+        if result is None:
             await update.message.reply_text("✅ 没有未使用的镜像需要清理")
             return
         
-        freed_space = 0
-        removed_count = 0
-        
-        for image in unused_images:
-            try:
-                size = image.attrs['Size']
-                docker_client.images.remove(image.id, force=False)
-                freed_space += size
-                removed_count += 1
-            except Exception as e:
-                logger.warning(f"无法删除镜像 {image.id}: {e}")
-        
-        freed_mb = freed_space / (1024 * 1024)
         await update.message.reply_text(
+            (OPERATION_ATTACHED_NOTE if attached else "") +
             f"✅ **镜像清理完成**\n\n"
-            f"🗑️ 已删除镜像：**{removed_count}** 个\n"
-            f"💾 释放空间：**{freed_mb:.2f} MB**"
+            f"🗑️ 已删除镜像：**{result.count('image')}** 个\n"
+            f"⏭️ 已跳过：**{result.count('image', 'skipped')}** 个\n"
+            f"💾 释放空间：**{format_bytes(result.freed)}**\n"
+            f"⏱️ 耗时：**{result.elapsed:.1f}** 秒"
+            + format_cleanup_failures(result)
         )
         
     except Exception as e:
@@ -395,22 +4019,34 @@ async def cleanup_containers(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         await update.message.reply_text("🧹 开始清理已停止的容器...")
         
-        # 获取已停止的容器
-        stopped_containers = docker_client.containers.list(all=True, filters={'status': 'exited'})
+        async def work():
+            # 获取已停止的容器
+            stages = plan_cleanup(await inventory.snapshot(), images=False, networks=False)
+            if not stages:
+                return None
+            before = await try_disk_usage()
+            result = await execute_cleanup(stages)
+            after = await try_disk_usage()
+            if before and after:
+                result.measured = max(before.container_size - after.container_size, 0)
+            return result
         
-        if not stopped_containers:
+        result, attached = await operation_locks.run(
+            'cleanup:containers', ('cleanup',), '清理容器', work,
+            on_wait=operation_waiter(update.message.reply_text)
+        )
+        if result is None:
             await update.message.reply_text("✅ 没有已停止的容器需要清理")
             return
         
-        removed_count = 0
-        for container in stopped_containers:
-            try:
-                container.remove()
-                removed_count += 1
-            except Exception as e:
-                logger.warning(f"无法删除容器 {container.name}: {e}")
-        
-        await update.message.reply_text(f"✅ **容器清理完成**\n🗑️ 已删除容器：**{removed_count}** 个")
+        await update.message.reply_text(
+            (OPERATION_ATTACHED_NOTE if attached else "") +
+            f"✅ **容器清理完成**\n"
+            f"🗑️ 已删除容器：**{result.count('container')}** 个\n"
+            f"💾 释放空间：**{format_bytes(result.freed)}**\n"
+            f"⏱️ 耗时：**{result.elapsed:.1f}** 秒"
+            + format_cleanup_failures(result)
+        )
         
     except Exception as e:
         logger.error(f"清理容器错误: {e}")
@@ -421,8 +4057,8 @@ async def cleanup_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """全面清理所有资源"""
     try:
         keyboard = [
-            [InlineKeyboardButton("✅ 确认清理", callback_data="cleanup_confirm")],
-            [InlineKeyboardButton("❌ 取消", callback_data="cleanup_cancel")]
+            [InlineKeyboardButton("✅ 确认清理", callback_data=callback_data("cleanup_confirm"))],
+            [InlineKeyboardButton("❌ 取消", callback_data=callback_data("cleanup_cancel"))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -444,8 +4080,8 @@ async def cleanup_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """强制清理（包括构建缓存）"""
     try:
         keyboard = [
-            [InlineKeyboardButton("🔥 确认强制清理", callback_data="cleanup_force_confirm")],
-            [InlineKeyboardButton("❌ 取消", callback_data="cleanup_cancel")]
+            [InlineKeyboardButton("🔥 确认强制清理", callback_data=callback_data("cleanup_force_confirm"))],
+            [InlineKeyboardButton("❌ 取消", callback_data=callback_data("cleanup_cancel"))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -463,188 +4099,630 @@ async def cleanup_force(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"强制清理错误: {e}")
         await update.message.reply_text("❌ 执行强制清理时出错")
 
+def match_container_name(name, search):
+    """菜单搜索：含通配符时按通配符匹配，否则不区分大小写的子串匹配"""
+    if any(ch in search for ch in '*?['):
+        return fnmatch.fnmatchcase(name, search)
+    return search.lower() in name.lower()
+
+async def render_container_menu(search='', page=0):
+    """渲染一页容器选择菜单，返回 (文本, 按钮, 实际页码)
+
+    只为当前页生成按钮；容器列表来自清单缓存，翻页不会访问 Docker。
+    """
+    containers = (await inventory.snapshot()).container_list()
+    if search:
+        containers = [c for c in containers if match_container_name(c.name, search)]
+    
+    page_size = CONTAINER_MENU_PAGE_SIZE
+    total_pages = max(1, (len(containers) + page_size - 1) // page_size)
+    page = max(0, min(page, total_pages - 1))
+    
+    keyboard = []
+    for container in containers[page * page_size:(page + 1) * page_size]:
+        status_icon = "🟢" if container.status == "running" else "🔴"
+        button_text = f"{status_icon} {container.name}"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callback_data('container', container.id))])
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=callback_data('menu', (search, page - 1))))
+    nav.append(InlineKeyboardButton(f"🔄 {page + 1}/{total_pages}", callback_data=callback_data('menu', (search, page))))
+    if page < total_pages - 1:
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=callback_data('menu', (search, page + 1))))
+    keyboard.append(nav)
+    
+    text = "📦 **容器管理** - 选择容器进行操作:"
+    if search:
+        text += f"\n🔎 搜索：{search}"
+    text += f"\n📄 共 {len(containers)} 个容器"
+    if not containers:
+        text += "\n\n🔍 没有匹配的容器"
+    return text, InlineKeyboardMarkup(keyboard), page
+
 @auth_required
 async def containers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """容器管理菜单"""
+    """容器管理菜单（/containers [关键字]）"""
     try:
-        containers = docker_client.containers.list(all=True)
-        
-        keyboard = []
-        for container in containers:
-            status_icon = "🟢" if container.status == "running" else "🔴"
-            button_text = f"{status_icon} {container.name}"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"container_{container.name}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("📦 **容器管理** - 选择容器进行操作:", reply_markup=reply_markup)
+        search = ' '.join(context.args or [])
+        text, reply_markup, page = await render_container_menu(search)
+        context.chat_data['container_menu'] = (search, page)
+        await update.message.reply_text(text, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"容器菜单错误: {e}")
         await update.message.reply_text("❌ 加载容器菜单时出错")
 
 @auth_required
 async def images_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看镜像列表"""
+    """查看镜像列表（支持过滤、排序和 @主机 / @all）"""
     try:
-        images = docker_client.images.list()
+        try:
+            hosts, args = host_registry.resolve(context.args or [])
+            query = parse_image_query(args)
+            results = await host_registry.collect(hosts, lambda host: query_images(query, host))
+        except ValueError as e:
+            await update.message.reply_text(
+                f"❌ {e}\n\n"
+                f"💡 示例：`/images dangling=true size>500MB sort=size`"
+            )
+            return
+        multi = hosts != [host_registry.primary]
         
-        message = "🖼️ **镜像列表：**\n\n"
-        for image in images:
-            tags = image.tags if image.tags else ['<none>']
-            for tag in tags:
-                size_mb = image.attrs['Size'] / (1024 * 1024)
-                message += f"🏷️ **{tag}**\n"
-                message += f"   💾 大小：{size_mb:.2f} MB\n"
-                message += f"   🔤 ID：{image.short_id}\n\n"
+        records = []
+        for host, images, error in results:
+            if multi:
+                records.append(format_host_heading(host, len(images or []), error, unit='个镜像'))
+            for image in images or []:
+                tags = image.tags if image.tags else ['<none>']
+                for tag in tags:
+                    size_mb = image.size / (1024 * 1024)
+                    records.append("\n".join([
+                        f"🏷️ {tag}",
+                        f"   💾 大小：{size_mb:.2f} MB",
+                        f"   🔤 ID：{image.short_id}",
+                    ]))
         
-        if len(message) > 4000:
-            message = message[:4000] + "\n... (列表过长，已截断)"
+        if not records:
+            await update.message.reply_text("🔍 没有找到符合条件的镜像" if query else "🔍 没有找到任何镜像")
+            return
         
-        await update.message.reply_text(message)
+        header = "🖼️ 镜像列表："
+        if query:
+            header += f"\n🔎 条件：{query.describe()}"
+        await reply_chunked(update.message, header, records)
     except Exception as e:
         logger.error(f"获取镜像列表错误: {e}")
         await update.message.reply_text("❌ 获取镜像列表时出错")
 
+@auth_required
+async def resync_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """强制重新同步容器清单缓存"""
+    try:
+        await inventory.resync()
+        await update.message.reply_text(
+            f"🔄 **清单已重新同步**\n\n"
+            f"🔢 版本：第 **{inventory.generation}** 代\n"
+            f"📦 容器：**{len(inventory.containers)}** 个\n"
+            f"🖼️ 镜像：**{len(inventory.images)}** 个\n"
+            f"🌐 网络：**{len(inventory.networks)}** 个"
+        )
+    except Exception as e:
+        logger.error(f"重新同步清单错误: {e}")
+        await update.message.reply_text("❌ 重新同步清单时出错")
+
+@auth_required
+async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """检查运行中容器的镜像是否有更新（只查询仓库，不拉取）"""
+    try:
+        started = time.monotonic()
+        hits = registry_client.hits
+        results = await check_image_updates(await inventory.snapshot())
+        if not results:
+            await update.message.reply_text("🔍 没有运行中的容器")
+            return
+        
+        current = sum(1 for result in results if result.status == 'current')
+        header = (
+            f"🔍 镜像更新检查（{len(results)} 个镜像）\n"
+            f"✅ 已是最新：{current} 个\n"
+            f"⏱️ 耗时 {time.monotonic() - started:.1f} 秒，缓存命中 {registry_client.hits - hits} 个"
+        )
+        records = []
+        for status, label in UPDATE_CHECK_LABELS.items():
+            for result in results:
+                if result.status != status:
+                    continue
+                lines = [f"{label}：{result.ref}", f"   📦 {', '.join(result.containers)}"]
+                if result.remote_digest:
+                    lines.append(f"   🔤 {result.local_digest[7:19]} → {result.remote_digest[7:19]}")
+                if result.error:
+                    lines.append(f"   ❌ {result.error}")
+                records.append("\n".join(lines))
+        
+        await reply_chunked(update.message, header, records)
+    except Exception as e:
+        logger.error(f"检查镜像更新错误: {e}")
+        await update.message.reply_text("❌ 检查镜像更新时出错")
+
+@auth_required
+async def hosts_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """检查所有已注册 Docker 主机的连通性"""
+    try:
+        hosts = await host_registry.check_all()
+        lines = [f"🖥️ **Docker 主机（{len(hosts)} 台）**", ""]
+        for host in hosts:
+            if host.healthy:
+                lines.append(f"🟢 **{host.name}** - {host.url}（{host.latency * 1000:.0f} ms）")
+            else:
+                lines.append(f"🔴 **{host.name}** - {host.url}\n   ❌ {host.error}")
+        lines.append("")
+        lines.append("💡 在 `/status`、`/allcontainers`、`/images` 后加 `@主机名` 或 `@all` 查询其他主机")
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"检查主机状态错误: {e}")
+        await update.message.reply_text("❌ 检查主机状态时出错")
+
+@auth_required
+async def pool_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看 Docker 调用线程池状态"""
+    stats = docker_executor.stats()
+    await update.message.reply_text(
+        f"🧵 **Docker 调用池状态**\n\n"
+        f"⚙️ 工作线程：**{stats['max_workers']}** 个\n"
+        f"⏳ 排队中：**{stats['queued']}** 个\n"
+        f"🏃 执行中：**{stats['in_flight']}** 个\n"
+        f"✅ 已完成：**{stats['completed']}** 个\n"
+        f"❌ 失败：**{stats['failed']}** 个\n"
+        f"⏱️ 超时：**{stats['timed_out']}** 个"
+    )
+
+CALLBACK_ROUTES = {}
+
+def callback_route(action, token=False):
+    """注册按钮回调：按动作名 O(1) 查表分发
+
+    token=True 的动作在调用前先把令牌解析为实际值，
+    令牌未知或已过期时统一按过期按钮处理。
+    """
+    def decorator(func):
+        CALLBACK_ROUTES[action] = (func, token)
+        return func
+    return decorator
+
+@callback_route('cleanup_confirm')
+async def on_cleanup_confirm(query, context, arg):
+    await query.edit_message_text("🔄 执行全面清理中...")
+    
+    async def work():
+        # 依次清理已停止的容器、未使用的镜像和网络
+        before = await try_disk_usage()
+        stages = plan_cleanup(await inventory.snapshot(), include_tagged=True, usage=before)
+        result = await execute_cleanup(stages)
+        after = await try_disk_usage()
+        if before and after:
+            result.measured = max(
+                before.layers_size + before.container_size - after.layers_size - after.container_size, 0
+            )
+        return result
+    
+    result, attached = await operation_locks.run(
+        'cleanup:all', ('cleanup',), '全面清理', work, on_wait=operation_waiter(query.edit_message_text)
+    )
+    
+    await query.edit_message_text(
+        (OPERATION_ATTACHED_NOTE if attached else "") +
+        f"✅ **全面清理完成**\n\n"
+        f"🗑️ 已删除容器：**{result.count('container')}** 个\n"
+        f"🗑️ 已删除镜像：**{result.count('image')}** 个\n"
+        f"🗑️ 已删除网络：**{result.count('network')}** 个\n"
+        f"💾 释放空间：**{format_bytes(result.freed)}**\n"
+        f"⏱️ 耗时：**{result.elapsed:.1f}** 秒"
+        + format_cleanup_failures(result)
+    )
+
+@callback_route('cleanup_force_confirm')
+async def on_cleanup_force_confirm(query, context, arg):
+    await query.edit_message_text("🔄 执行强制清理中...")
+    
+    async def work():
+        # 执行 docker system prune -a -f
+        result = await run_docker(docker_client.containers.prune, call_timeout=PRUNE_TIMEOUT)
+        containers_removed = result['SpaceReclaimed']
+        
+        result = await run_docker(docker_client.images.prune, filters={'dangling': False}, call_timeout=PRUNE_TIMEOUT)
+        images_removed = result['SpaceReclaimed']
+        
+        result = await run_docker(docker_client.networks.prune, call_timeout=PRUNE_TIMEOUT)
+        networks_removed = result.get('SpaceReclaimed', 0)
+        
+        result = await run_docker(docker_client.volumes.prune, call_timeout=PRUNE_TIMEOUT)
+        volumes_removed = result['SpaceReclaimed']
+        return containers_removed + images_removed + networks_removed + volumes_removed
+    
+    reclaimed, attached = await operation_locks.run(
+        'cleanup:force', ('cleanup',), '强制清理', work, on_wait=operation_waiter(query.edit_message_text)
+    )
+    total_space = reclaimed / (1024 * 1024)
+    
+    await query.edit_message_text(
+        (OPERATION_ATTACHED_NOTE if attached else "") +
+        f"✅ **强制清理完成**\n\n"
+        f"💾 总释放空间：**{total_space:.2f} MB**\n"
+        f"⚠️ **注意：** 可能删除了构建缓存和基础镜像"
+    )
+
+@callback_route('cleanup_cancel')
+async def on_cleanup_cancel(query, context, arg):
+    await query.edit_message_text("❌ 清理操作已取消")
+
+def container_display_name(container_ref):
+    """按钮令牌中保存的是容器 ID，显示时换成清单中的名称"""
+    container = inventory.containers.get(container_ref)
+    return container.name if container else container_ref
+
+@callback_route('container', token=True)
+async def on_container(query, context, container_ref):
+    container = await get_container_info(container_ref)
+    container_name = container.name
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("🔄 重启", callback_data=callback_data('restart', container.id)),
+            InlineKeyboardButton("⏹️ 停止", callback_data=callback_data('stop', container.id))
+        ],
+        [
+            InlineKeyboardButton("▶️ 启动", callback_data=callback_data('start', container.id)),
+            InlineKeyboardButton("📋 日志", callback_data=callback_data('logs', container.id))
+        ],
+        [InlineKeyboardButton("🔙 返回", callback_data=callback_data('menu', menu_state(context)))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    status_icon = "🟢" if container.status == "running" else "🔴"
+    info = f"{status_icon} **容器:** {container_name}\n📊 **状态:** {container.status}\n🖼️ **镜像:** {container.image}"
+    
+    await query.edit_message_text(info, reply_markup=reply_markup)
+
+@callback_route('restart', token=True)
+async def on_restart(query, context, container_ref):
+    container_name = container_display_name(container_ref)
+    _, attached = await operation_locks.run(
+        f"restart:{container_name}", (f"container:{container_name}",), f"{BULK_ACTIONS['restart'][1]} {container_name}",
+        lambda: _container_action('restart', container_ref), on_wait=operation_waiter(query.edit_message_text)
+    )
+    await query.edit_message_text((OPERATION_ATTACHED_NOTE if attached else "") + f"✅ 容器 **{container_name}** 重启完成")
+
+@callback_route('stop', token=True)
+async def on_stop(query, context, container_ref):
+    container_name = container_display_name(container_ref)
+    _, attached = await operation_locks.run(
+        f"stop:{container_name}", (f"container:{container_name}",), f"{BULK_ACTIONS['stop'][1]} {container_name}",
+        lambda: _container_action('stop', container_ref), on_wait=operation_waiter(query.edit_message_text)
+    )
+    await query.edit_message_text((OPERATION_ATTACHED_NOTE if attached else "") + f"✅ 容器 **{container_name}** 已停止")
+
+@callback_route('start', token=True)
+async def on_start(query, context, container_ref):
+    container_name = container_display_name(container_ref)
+    _, attached = await operation_locks.run(
+        f"start:{container_name}", (f"container:{container_name}",), f"{BULK_ACTIONS['start'][1]} {container_name}",
+        lambda: _container_action('start', container_ref), on_wait=operation_waiter(query.edit_message_text)
+    )
+    await query.edit_message_text((OPERATION_ATTACHED_NOTE if attached else "") + f"✅ 容器 **{container_name}** 已启动")
+
+async def show_log_page(query, container_ref, direction):
+    container_name = container_display_name(container_ref)
+    page, note = await load_log_page(container_name, direction)
+    message, reply_markup = format_log_page(container_name, page, note)
+    await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+@callback_route('logs', token=True)
+async def on_logs(query, context, container_name):
+    await show_log_page(query, container_name, 'latest')
+
+@callback_route('logsprev', token=True)
+async def on_logs_prev(query, context, container_name):
+    await show_log_page(query, container_name, 'older')
+
+@callback_route('logsnext', token=True)
+async def on_logs_next(query, context, container_name):
+    await show_log_page(query, container_name, 'newer')
+
+@callback_route('unfollow', token=True)
+async def on_unfollow(query, context, container_name):
+    await follow_manager.stop(container_name)
+
+@callback_route('chunk')
+async def on_chunk(query, context, arg):
+    token, _, index = arg.partition(':')
+    await show_page(query, token, int(index or 0))
+
+def menu_state(context):
+    """本聊天上次浏览的容器菜单 (搜索词, 页码)"""
+    return context.chat_data.get('container_menu', ('', 0))
+
+async def show_container_menu(query, context, search, page):
+    """把当前消息原地编辑为容器菜单的指定页"""
+    text, reply_markup, page = await render_container_menu(search, page)
+    context.chat_data['container_menu'] = (search, page)
+    await safe_edit(
+        query.get_bot(), query.message.chat_id, query.message.message_id, text, reply_markup=reply_markup
+    )
+
+@callback_route('menu', token=True)
+async def on_menu(query, context, state):
+    await show_container_menu(query, context, *state)
+
+async def refresh_stale_button(query, context):
+    """过期按钮：提示后把消息原地刷新为最新的容器菜单"""
+    await answer_callback(query, "⌛ 按钮已过期，已刷新")
+    await show_container_menu(query, context, *menu_state(context))
+
+async def answer_callback(query, text=None):
+    """回应按钮；已排队时处理器已提前回应过，过期或重复回应不影响执行操作"""
+    try:
+        await query.answer(text)
+    except BadRequest as e:
+        logger.debug(f"回应按钮失败: {e}")
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """按钮回调处理"""
     query = update.callback_query
-    await query.answer()
+    if str(update.effective_chat.id) != ALLOWED_CHAT_ID:
+        await query.answer("❌ 未经授权的访问")
+        return
     
-    data = query.data
+    action, _, arg = (query.data or '').partition(':')
     
     try:
-        if data == "cleanup_confirm":
-            await query.edit_message_text("🔄 执行全面清理中...")
-            
-            # 清理已停止的容器
-            stopped_containers = docker_client.containers.list(all=True, filters={'status': 'exited'})
-            containers_removed = 0
-            for container in stopped_containers:
-                try:
-                    container.remove()
-                    containers_removed += 1
-                except:
-                    pass
-            
-            # 清理未使用的镜像
-            images = docker_client.images.list()
-            unused_images = [img for img in images if len(img.tags) == 0 or '<none>' in img.tags[0]]
-            images_removed = 0
-            freed_space = 0
-            for image in unused_images:
-                try:
-                    size = image.attrs['Size']
-                    docker_client.images.remove(image.id, force=False)
-                    freed_space += size
-                    images_removed += 1
-                except:
-                    pass
-            
-            # 清理未使用的网络
-            networks = docker_client.networks.list()
-            unused_networks = [net for net in networks if not net.containers]
-            networks_removed = 0
-            for network in unused_networks:
-                try:
-                    if network.name not in ['bridge', 'host', 'none']:
-                        network.remove()
-                        networks_removed += 1
-                except:
-                    pass
-            
-            freed_mb = freed_space / (1024 * 1024)
-            await query.edit_message_text(
-                f"✅ **全面清理完成**\n\n"
-                f"🗑️ 已删除容器：**{containers_removed}** 个\n"
-                f"🗑️ 已删除镜像：**{images_removed}** 个\n"
-                f"🗑️ 已删除网络：**{networks_removed}** 个\n"
-                f"💾 释放空间：**{freed_mb:.2f} MB**"
-            )
-            
-        elif data == "cleanup_force_confirm":
-            await query.edit_message_text("🔄 执行强制清理中...")
-            
-            # 执行 docker system prune -a -f
-            result = docker_client.containers.prune()
-            containers_removed = result['SpaceReclaimed']
-            
-            result = docker_client.images.prune(filters={'dangling': False})
-            images_removed = result['SpaceReclaimed']
-            
-            result = docker_client.networks.prune()
-            networks_removed = result['SpaceReclaimed']
-            
-            result = docker_client.volumes.prune()
-            volumes_removed = result['SpaceReclaimed']
-            
-            total_space = (containers_removed + images_removed + networks_removed + volumes_removed) / (1024 * 1024)
-            
-            await query.edit_message_text(
-                f"✅ **强制清理完成**\n\n"
-                f"💾 总释放空间：**{total_space:.2f} MB**\n"
-                f"⚠️ **注意：** 可能删除了构建缓存和基础镜像"
-            )
-            
-        elif data == "cleanup_cancel":
-            await query.edit_message_text("❌ 清理操作已取消")
-            
-        elif data.startswith("container_"):
-            container_name = data.replace("container_", "")
-            container = docker_client.containers.get(container_name)
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 重启", callback_data=f"restart_{container_name}"),
-                    InlineKeyboardButton("⏹️ 停止", callback_data=f"stop_{container_name}")
-                ],
-                [
-                    InlineKeyboardButton("▶️ 启动", callback_data=f"start_{container_name}"),
-                    InlineKeyboardButton("📋 日志", callback_data=f"logs_{container_name}")
-                ],
-                [InlineKeyboardButton("🔙 返回", callback_data="back_containers")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            status_icon = "🟢" if container.status == "running" else "🔴"
-            info = f"{status_icon} **容器:** {container_name}\n📊 **状态:** {container.status}\n🖼️ **镜像:** {container.image.tags[0] if container.image.tags else 'N/A'}"
-            
-            await query.edit_message_text(info, reply_markup=reply_markup)
-            
-        elif data.startswith("restart_"):
-            container_name = data.replace("restart_", "")
-            container = docker_client.containers.get(container_name)
-            container.restart()
-            await query.edit_message_text(f"✅ 容器 **{container_name}** 重启完成")
-            
-        elif data.startswith("stop_"):
-            container_name = data.replace("stop_", "")
-            container = docker_client.containers.get(container_name)
-            container.stop()
-            await query.edit_message_text(f"✅ 容器 **{container_name}** 已停止")
-            
-        elif data.startswith("start_"):
-            container_name = data.replace("start_", "")
-            container = docker_client.containers.get(container_name)
-            container.start()
-            await query.edit_message_text(f"✅ 容器 **{container_name}** 已启动")
-            
-        elif data.startswith("logs_"):
-            container_name = data.replace("logs_", "")
-            container = docker_client.containers.get(container_name)
-            logs = container.logs(tail=20, timestamps=True).decode('utf-8')
-            
-            if len(logs) > 2000:
-                logs = logs[-2000:]
-                
-            message = f"📋 **{container_name} 最近日志:**\n```\n{logs}\n```"
-            await query.edit_message_text(message, parse_mode='Markdown')
-            
-        elif data == "back_containers":
-            await containers_menu(update, context)
-            
+        route = CALLBACK_ROUTES.get(action)
+        if route is None:
+            await refresh_stale_button(query, context)
+            return
+        
+        func, token = route
+        if token:
+            arg = callback_tokens.resolve(arg)
+            if arg is None:
+                await refresh_stale_button(query, context)
+                return
+        
+        await answer_callback(query)
+        started = time.monotonic()
+        try:
+            await func(query, context, arg)
+        finally:
+            metrics.observe('callback_seconds', time.monotonic() - started, action=action)
+    except docker.errors.NotFound:
+        await query.edit_message_text(
+            "❌ 容器已不存在",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 刷新列表", callback_data=callback_data('menu', menu_state(context)))]])
+        )
     except Exception as e:
         logger.error(f"按钮处理错误: {e}")
         await query.edit_message_text("❌ 操作执行时出错")
 
+# 会改动 Docker 状态的命令和按钮：同一聊天内按到达顺序逐个执行
+ORDERED_COMMANDS = {
+    'cleanup', 'cleanupimages', 'cleanupcontainers', 'cleanupall', 'cleanupforce',
+    'restart', 'bulk', 'update', 'runonce',
+}
+ORDERED_CALLBACKS = {'cleanup_confirm', 'cleanup_force_confirm', 'restart', 'stop', 'start'}
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新，但同一聊天内的破坏性操作保持顺序、互不重叠
+
+    只读命令（/status、/images、翻页等）不排队，即使有清理任务在执行也能立即响应。
+    与正在执行的更新完全相同的重复请求（连点按钮、重发命令）也不排队，
+    由 operation_locks 把它附加到进行中的操作上，而不是等前一个结束后再执行一遍。
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max(max_concurrent_updates, 1))
+        self._locks = {}
+        self._running = set()
+        self.in_flight = 0
+        self.waiting = 0
+
+    @staticmethod
+    def ordering_key(update):
+        """需要排队的更新返回其内容（按钮数据或规范化的命令），否则返回 None"""
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query is not None:
+            data = update.callback_query.data or ''
+            return data if data.partition(':')[0] in ORDERED_CALLBACKS else None
+        text = update.message.text if update.message else None
+        if not text or not text.startswith('/'):
+            return None
+        command, *args = text.split()
+        command = command[1:].split('@')[0].lower()
+        return ' '.join([command, *args]) if command in ORDERED_COMMANDS else None
+
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            key = self.ordering_key(update)
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            if key is None or (chat_id, key) in self._running:
+                await coroutine
+                return
+            entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                if entry[0].locked():
+                    self.waiting += 1
+                    metrics.inc('ordered_updates_waited_total')
+                    if update.callback_query is not None:
+                        # 排队可能超过 Telegram 回应按钮的时限，先回应再等待
+                        await answer_callback(update.callback_query, "⏳ 已排队，等待前一个操作完成")
+                    try:
+                        await entry[0].acquire()
+                    finally:
+                        self.waiting -= 1
+                else:
+                    await entry[0].acquire()
+                self._running.add((chat_id, key))
+                try:
+                    await coroutine
+                finally:
+                    self._running.discard((chat_id, key))
+                    entry[0].release()
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._locks.pop(chat_id, None)
+        finally:
+            self.in_flight -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+update_processor = ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)
+
+class MetricsServer:
+    """极简的 HTTP /metrics 端点（asyncio），供 Prometheus 抓取"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        if not self.port:
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"指标端点已启动: http://{self.host}:{self.port}/metrics")
+        except OSError as e:
+            logger.error(f"启动指标端点失败: {e}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # 读完请求头，忽略内容
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                body = render_metrics().encode()
+                status, content_type = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'not found\n'
+                status, content_type = '404 Not Found', 'text/plain'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"处理指标请求错误: {e}")
+        finally:
+            writer.close()
+
+def render_metrics():
+    """导出全部指标，附带 Docker 调用池和清单的当前状态"""
+    pool = docker_executor.stats()
+    return metrics.render({
+        'uptime_seconds': round(time.time() - metrics.started, 1),
+        'docker_pool_queued': pool['queued'],
+        'docker_pool_in_flight': pool['in_flight'],
+        'updates_in_flight': update_processor.in_flight,
+        'updates_waiting': update_processor.waiting,
+        'inventory_containers': len(inventory.containers),
+        'inventory_generation': inventory.generation,
+    })
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+def format_latency_table(series, label, limit=8, key=lambda h: h.sum):
+    """按 key 排序渲染 次数 / 平均 / p95"""
+    lines = []
+    for labels, histogram in sorted(series, key=lambda item: key(item[1]), reverse=True)[:limit]:
+        p95 = histogram.quantile(0.95)
+        p95_text = f"{p95:g}s" if p95 != float('inf') else f">{Histogram.BUCKETS[-1]}s"
+        lines.append(
+            f"• {labels[label]}：{histogram.count} 次 / 平均 {histogram.sum / histogram.count:.3f}s / p95 ≤{p95_text}"
+        )
+    return lines or ["• 暂无数据"]
+
+@auth_required
+async def bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看机器人自身的性能指标"""
+    try:
+        pool = docker_executor.stats()
+        lines = [
+            "📈 机器人运行指标",
+            f"⏱️ 已运行：{format_duration(time.time() - metrics.started)}",
+            "",
+            "🤖 命令耗时（按总耗时）：",
+            *format_latency_table(metrics.series('handler_seconds'), 'handler'),
+            "",
+            "🔘 按钮耗时：",
+            *format_latency_table(metrics.series('callback_seconds'), 'action', limit=5),
+            "",
+            "🐳 Docker 调用（按总耗时）：",
+            *format_latency_table(metrics.series('docker_call_seconds'), 'endpoint'),
+            "",
+            "✈️ Telegram 请求：",
+            *format_latency_table(metrics.series('telegram_request_seconds'), 'method', limit=5),
+            "",
+            "❌ 错误计数：",
+        ]
+        errors = sorted(metrics.counter_series('log_errors_total'), key=lambda item: item[1], reverse=True)
+        errors += [
+            ({'function': f"Docker {labels['endpoint']} ({labels['kind']})"}, value)
+            for labels, value in metrics.counter_series('docker_call_errors_total')
+        ]
+        lines += [f"• {labels['function']}：{value}" for labels, value in errors[:10]] or ["• 无"]
+        lines += [
+            "",
+            f"🧵 Docker 调用池：排队 {pool['queued']}，执行中 {pool['in_flight']}/{pool['max_workers']}，"
+            f"超时 {pool['timed_out']}",
+            f"📥 更新处理：执行中 {update_processor.in_flight}/{update_processor.max_concurrent_updates}，"
+            f"排队中的破坏性操作 {update_processor.waiting}",
+        ]
+        if METRICS_PORT:
+            lines.append(f"📊 Prometheus：http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        await reply_chunked(update.message, lines[0], ["\n".join(lines[1:])])
+    except Exception as e:
+        logger.error(f"获取机器人指标错误: {e}")
+        await update.message.reply_text("❌ 获取机器人指标时出错")
+
+async def on_startup(application: Application):
+    """启动时加载容器清单并开始跟随 Docker 事件"""
+    await history.start()
+    inventory.add_listener(history.add_events)
+    if ALERTS_ENABLED:
+        alert_engine.bot = application.bot
+        inventory.add_listener(alert_engine.handle_events)
+    try:
+        await inventory.start()
+    except Exception as e:
+        # 守护进程暂时不可用时不阻止机器人启动，首次读取时会重试
+        logger.error(f"加载容器清单失败: {e}")
+    if STATS_ENABLED:
+        await stats_sampler.start()
+    await scheduler.start(application)
+    await metrics_server.start()
+
+async def on_shutdown(application: Application):
+    """停止后台任务"""
+    await metrics_server.stop()
+    await follow_manager.stop_all('🔌 机器人已停止')
+    await stats_sampler.stop()
+    await history.stop()
+    await inventory.stop()
+
 def main():
     """主函数"""
     if not TELEGRAM_BOT_TOKEN or not ALLOWED_CHAT_ID:
@@ -652,7 +4730,15 @@ def main():
         return
     
     # 创建应用
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # 添加命令处理器
     application.add_handler(CommandHandler("start", start))
@@ -661,8 +4747,13 @@ def main():
     application.add_handler(CommandHandler("status", status))
     application.add_handler(CommandHandler("allcontainers", all_containers))
     application.add_handler(CommandHandler("runonce", run_once))
+    application.add_handler(CommandHandler("jobs", jobs_list))
+    application.add_handler(CommandHandler("history", history_command))
     application.add_handler(CommandHandler("restart", restart_container))
+    application.add_handler(CommandHandler("bulk", bulk_action))
     application.add_handler(CommandHandler("logs", watchtower_logs))
+    application.add_handler(CommandHandler("follow", follow_logs))
+    application.add_handler(CommandHandler("unfollow", unfollow_logs))
     application.add_handler(CommandHandler("schedule", schedule))
     application.add_handler(CommandHandler("cleanup", cleanup))
     application.add_handler(CommandHandler("cleanupimages", cleanup_images))
@@ -671,13 +4762,41 @@ def main():
     application.add_handler(CommandHandler("cleanupforce", cleanup_force))
     application.add_handler(CommandHandler("containers", containers_menu))
     application.add_handler(CommandHandler("images", images_list))
+    application.add_handler(CommandHandler("stats", container_stats))
+    application.add_handler(CommandHandler("pool", pool_status))
+    application.add_handler(CommandHandler("hosts", hosts_status))
+    application.add_handler(CommandHandler("checkupdates", check_updates))
+    application.add_handler(CommandHandler("update", update_containers))
+    application.add_handler(CommandHandler("resync", resync_inventory))
+    application.add_handler(CommandHandler("botstats", bot_stats))
     
     # 添加按钮回调处理器
     application.add_handler(CallbackQueryHandler(button_handler))
     
+    # 为所有处理器加上耗时统计
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            name = next(iter(handler.commands)) if isinstance(handler, CommandHandler) else 'button'
+            handler.callback = instrument_handler(name, handler.callback)
+    
     # 启动机器人
     logger.info("Watchtower Bot 启动中...")
-    application.run_polling()
+    try:
+        if WEBHOOK_URL:
+            # Webhook 模式：在本地监听，由反向代理把 HTTPS 请求转发进来
+            logger.info(f"使用 Webhook 模式: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+            )
+        else:
+            application.run_polling()
+    finally:
+        for host in host_registry.hosts.values():
+            host.executor.shutdown()
 
 if __name__ == '__main__':
     main()